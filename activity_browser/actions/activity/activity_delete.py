@@ -4,6 +4,7 @@ from PySide2 import QtWidgets
 
 from activity_browser import application
 from activity_browser.actions.base import ABAction, exception_dialogs
+from activity_browser.bwutils import AB_metadata
 from activity_browser.mod import bw2data as bd
 from activity_browser.mod.bw2data.parameters import (ActivityParameter, Group,
                                                      GroupDependency,
@@ -50,35 +51,34 @@ class ActivityDelete(ABAction):
         if choice == QtWidgets.QMessageBox.No:
             return
 
-
-
         # use the activity controller to delete multiple activities
-        for act in activities:
-            db, code = act.key
-
-            try:
-                group_name = ActivityParameter.get(
-                    (ActivityParameter.database == db)
-                    & (ActivityParameter.code == code)
-                ).group
-
-                # remove activity parameters from its group
-                parameters.remove_from_group(group_name, act)
-
-                # Also clear the group if there are no more parameters in it
-                if (
-                    not ActivityParameter.select()
-                    .where(ActivityParameter.group == group_name)
-                    .exists()
-                ):
-                    Group.delete().where(Group.name == group_name).execute()
-                    GroupDependency.delete().where(
-                        GroupDependency.group == group_name
-                    ).execute()
-            except ActivityParameter.DoesNotExist:
-                # no parameters found for this activity
-                pass
-
-            act.upstream().delete()
-
-            act.delete()
+        with AB_metadata.batch():
+            for act in activities:
+                db, code = act.key
+
+                try:
+                    group_name = ActivityParameter.get(
+                        (ActivityParameter.database == db)
+                        & (ActivityParameter.code == code)
+                    ).group
+
+                    # remove activity parameters from its group
+                    parameters.remove_from_group(group_name, act)
+
+                    # Also clear the group if there are no more parameters in it
+                    if (
+                        not ActivityParameter.select()
+                        .where(ActivityParameter.group == group_name)
+                        .exists()
+                    ):
+                        Group.delete().where(Group.name == group_name).execute()
+                        GroupDependency.delete().where(
+                            GroupDependency.group == group_name
+                        ).execute()
+                except ActivityParameter.DoesNotExist:
+                    # no parameters found for this activity
+                    pass
+
+                act.upstream().delete()
+
+                act.delete()
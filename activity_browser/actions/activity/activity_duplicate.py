@@ -3,7 +3,7 @@ from typing import Callable, List, Union
 from PySide2 import QtCore
 
 from activity_browser.actions.base import ABAction, exception_dialogs
-from activity_browser.bwutils import commontasks
+from activity_browser.bwutils import AB_metadata, commontasks
 from activity_browser.mod.bw2data import get_activity
 from activity_browser.ui.icons import qicons
 
@@ -21,6 +21,8 @@ class ActivityDuplicate(ABAction):
     def run(activity_keys: List[tuple]):
         activities = [get_activity(key) for key in activity_keys]
 
-        for activity in activities:
-            new_code = commontasks.generate_copy_code(activity.key)
-            activity.copy(new_code)
+        # update the metadata once for all copies instead of once per copy
+        with AB_metadata.batch():
+            for activity in activities:
+                new_code = commontasks.generate_copy_code(activity.key)
+                activity.copy(new_code)
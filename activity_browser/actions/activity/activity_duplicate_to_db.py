@@ -4,7 +4,7 @@ from PySide2 import QtWidgets
 
 from activity_browser import application, project_settings
 from activity_browser.actions.base import ABAction, exception_dialogs
-from activity_browser.bwutils import commontasks
+from activity_browser.bwutils import AB_metadata, commontasks
 from activity_browser.mod import bw2data as bd
 from activity_browser.ui.icons import qicons
 
@@ -38,10 +38,11 @@ class ActivityDuplicateToDB(ABAction):
         new_activity_keys = []
 
         # otherwise move all supplied activities to the db using the controller
-        for activity in activities:
-            new_code = commontasks.generate_copy_code((target_db, activity["code"]))
-            new_activity = activity.copy(code=new_code, database=target_db)
-            new_activity_keys.append(new_activity.key)
+        with AB_metadata.batch():
+            for activity in activities:
+                new_code = commontasks.generate_copy_code((target_db, activity["code"]))
+                new_activity = activity.copy(code=new_code, database=target_db)
+                new_activity_keys.append(new_activity.key)
 
         ActivityOpen.run(new_activity_keys)
 
@@ -1,6 +1,7 @@
 from typing import Any
 
 from activity_browser.actions.base import ABAction, exception_dialogs
+from activity_browser.bwutils.manager import invalidate_formula_graph
 from activity_browser.mod import bw2data as bd
 from activity_browser.mod.bw2data.parameters import ActivityParameter
 from activity_browser.ui.icons import qicons
@@ -25,6 +26,7 @@ class ExchangeModify(ABAction):
         exchange.save()
 
         if "formula" in data:
+            invalidate_formula_graph()
             cls.parameterize_exchanges(exchange.output.key)
 
     @staticmethod
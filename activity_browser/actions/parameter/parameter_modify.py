@@ -1,6 +1,8 @@
 from typing import Any
 
 from activity_browser.actions.base import ABAction, exception_dialogs
+from activity_browser.bwutils.manager import (invalidate_formula_graph,
+                                               recalculate_downstream)
 from activity_browser.mod.bw2data import parameters
 from activity_browser.ui.icons import qicons
 
@@ -22,4 +24,9 @@ class ParameterModify(ABAction):
             setattr(parameter, field, value)
         parameter.save()
 
-        parameters.recalculate()
+        if field in ("name", "formula"):
+            # the dependencies between the parameters may have changed
+            invalidate_formula_graph()
+            parameters.recalculate()
+        else:
+            recalculate_downstream(parameter)
@@ -4,6 +4,7 @@ from PySide2 import QtWidgets
 
 from activity_browser import application
 from activity_browser.actions.base import ABAction, exception_dialogs
+from activity_browser.bwutils.manager import invalidate_formula_graph
 from activity_browser.mod.bw2data.parameters import (ActivityParameter,
                                                      DatabaseParameter,
                                                      ProjectParameter,
@@ -33,6 +34,7 @@ class ParameterRename(ABAction):
         if not ok or not new_name:
             return
 
+        invalidate_formula_graph()
         try:
             if isinstance(parameter, ProjectParameter):
                 parameters.rename_project_parameter(
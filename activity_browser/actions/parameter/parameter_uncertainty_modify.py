@@ -1,7 +1,7 @@
 from typing import Any
 
 from activity_browser.actions.base import ABAction, exception_dialogs
-from activity_browser.mod import bw2data as bd
+from activity_browser.bwutils.manager import recalculate_downstream
 from activity_browser.ui.icons import qicons
 
 
@@ -18,4 +18,4 @@ class ParameterUncertaintyModify(ABAction):
     def run(parameter: Any, uncertainty_dict: dict):
         parameter.data.update(uncertainty_dict)
         parameter.save()
-        bd.parameters.recalculate()
+        recalculate_downstream(parameter)
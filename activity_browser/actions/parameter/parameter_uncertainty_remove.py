@@ -2,7 +2,7 @@ from typing import Any
 
 from activity_browser.actions.base import ABAction, exception_dialogs
 from activity_browser.bwutils import uncertainty
-from activity_browser.mod import bw2data as bd
+from activity_browser.bwutils.manager import recalculate_downstream
 from activity_browser.ui.icons import qicons
 
 
@@ -19,4 +19,4 @@ class ParameterUncertaintyRemove(ABAction):
     def run(parameter: Any):
         parameter.data.update(uncertainty.EMPTY_UNCERTAINTY)
         parameter.save()
-        bd.parameters.recalculate()
+        recalculate_downstream(parameter)
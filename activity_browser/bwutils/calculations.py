@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 from logging import getLogger
 
 from bw2calc.errors import BW2CalcError
@@ -54,7 +55,10 @@ def do_LCA_calculations(data: dict):
         log.error(f"Calculation type must be: simple or scenario. Given: {cs_name}")
         raise ValueError
 
-    mlca.calculate()
+    if calculation_type == "scenario":
+        mlca.calculate(processes=os.cpu_count() or 1)
+    else:
+        mlca.calculate()
     mc = MonteCarloLCA(cs_name)
 
     return mlca, contributions, mc
@@ -33,61 +33,58 @@ def wrap_text(string: str, max_length: int = 80) -> str:
     return "\n".join(map(fold, string.splitlines()))
 
 
+# Fields and separators of the label styles used by `format_activity_labels`,
+# "key" and "pl" are handled separately and other styles fall back to "pnl"
+LABEL_STYLES = {
+    "pnl": (["reference product", "name", "location"], "\n"),
+    "pnl_": (["reference product", "name", "location"], " | "),
+    "pnld": (["reference product", "name", "location", "database"], " | "),
+    "bio": (["name", "categories"], ",\n"),
+}
+
+
 def format_activity_label(key, style="pnl", max_length=40):
-    try:
-        act = bd.get_activity(key)
-
-        if style == "pnl":
-            label = "\n".join(
-                [
-                    act.get("reference product", ""),
-                    act.get("name", ""),
-                    str(act.get("location", "")),
-                ]
-            )
-        elif style == "pnl_":
-            label = " | ".join(
-                [
-                    act.get("reference product", ""),
-                    act.get("name", ""),
-                    str(act.get("location", "")),
-                ]
-            )
-        elif style == "pnld":
-            label = " | ".join(
-                [
-                    act.get("reference product", ""),
-                    act.get("name", ""),
-                    str(act.get("location", "")),
-                    act.get("database", ""),
-                ]
-            )
-        elif style == "pl":
-            label = ", ".join(
-                [
-                    act.get("reference product", "") or act.get("name", ""),
-                    str(act.get("location", "")),
-                ]
-            )
-        elif style == "key":
-            label = str(act.key)  # safer to use key, code does not always exist
+    return format_activity_labels([key], style=style, max_length=max_length)[0]
 
-        elif style == "bio":
-            label = ",\n".join([act.get("name", ""), str(act.get("categories", ""))])
-        else:
-            label = "\n".join(
-                [
-                    act.get("reference product", ""),
-                    act.get("name", ""),
-                    str(act.get("location", "")),
-                ]
-            )
-    except:
-        if isinstance(key, tuple):
-            return wrap_text(str("".join(key)))
+
+def format_activity_labels(keys, style="pnl", max_length=40) -> list:
+    """Format labels for many activities at once.
+
+    The labels are read from the MetaDataStore in a single pass instead of
+    loading every activity from the database.
+    """
+    keys = list(keys)
+    tuples = [k for k in keys if isinstance(k, tuple) and len(k) == 2]
+    AB_metadata.add_metadata({k[0] for k in tuples if k[0] in bd.databases})
+
+    if style == "key":
+        # safer to use key, code does not always exist
+        found = AB_metadata.key_positions(tuples) != -1
+        labels = [str(k) if f else None for k, f in zip(tuples, found)]
+    elif style == "pl":
+        # use the name if an activity has no reference product
+        products = AB_metadata.get_labels(tuples, ["reference product"])
+        names = AB_metadata.get_labels(tuples, ["name"])
+        locations = AB_metadata.get_labels(tuples, ["location"])
+        labels = [
+            None if l is None else ", ".join([p or n, l])
+            for p, n, l in zip(products, names, locations)
+        ]
+    else:
+        fields, separator = LABEL_STYLES.get(style, LABEL_STYLES["pnl"])
+        labels = AB_metadata.get_labels(tuples, fields, separator)
+    labels = dict(zip(tuples, labels))
+
+    formatted = []
+    for key in keys:
+        label = labels.get(key) if isinstance(key, tuple) else None
+        if label is not None:
+            formatted.append(wrap_text(label, max_length=max_length))
+        elif isinstance(key, tuple):
+            formatted.append(wrap_text(str("".join(key))))
         else:
-            return wrap_text(str(key))
-    return wrap_text(label, max_length=max_length)
+            formatted.append(wrap_text(str(key)))
+    return formatted
 
 
 def cleanup_deleted_bw_projects() -> None:
@@ -240,6 +237,10 @@ def generate_copy_code(key: tuple) -> str:
         if not metadata.empty
         else []
     )
+    # copies made within a metadata batch are not yet in the metadata
+    copies.extend(
+        c for _, c in AB_metadata.queued_keys(db) if code in c and "_copy" in c
+    )
     if not copies:
         return f"{code}_copy1"
     n = max((int(c.split("_copy")[1]) for c in copies))
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+import ast
+from collections import defaultdict
+from types import CodeType
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+import numpy as np
+
+from activity_browser.mod.bw2data.parameters import Interpreter, MissingName
+
+from .utils import Parameters, StaticParameters
+
+"""
+Compiled evaluation of brightway parameters and parameterized exchanges.
+
+All project, database and activity parameter formulas and the exchange
+formulas are parsed once into a graph of formulas in the order of their
+dependencies. The graph is then evaluated for columns of parameter amounts
+(samples or scenarios) at once, using the numpy functions asteval offers.
+Formulas with syntax that cannot be compiled safely, or that do not work on
+arrays (like `if ... else` or `max`), are evaluated per column.
+"""
+
+# Syntax allowed in compiled formulas, other formulas are evaluated by asteval
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.BoolOp,
+    ast.Compare,
+    ast.IfExp,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.operator,
+    ast.unaryop,
+    ast.boolop,
+    ast.cmpop,
+)
+
+
+class Formula(NamedTuple):
+    """A parsed formula, `code` is None if it has to be evaluated by asteval."""
+
+    text: str
+    code: Optional[CodeType]
+    names: frozenset
+
+    @classmethod
+    def parse(cls, text: str) -> "Formula":
+        tree = ast.parse(str(text).strip(), mode="eval")
+        names = frozenset(n.id for n in ast.walk(tree) if isinstance(n, ast.Name))
+        safe = all(isinstance(n, ALLOWED_NODES) for n in ast.walk(tree)) and all(
+            isinstance(n.func, ast.Name) and not n.keywords
+            for n in ast.walk(tree)
+            if isinstance(n, ast.Call)
+        )
+        code = compile(tree, "<formula>", "eval") if safe else None
+        return cls(text, code, names)
+
+
+class FormulaNode(NamedTuple):
+    """A parameter or exchange in the formula graph. Nodes without formula
+    take their amount from the row `source` of the evaluated amounts."""
+
+    formula: Optional[Formula]
+    symbols: Dict[str, tuple]
+    source: Optional[int] = None
+    default: float = np.nan
+
+
+class FormulaGraph(object):
+    """All parameter and exchange formulas of the project, in the order in
+    which they have to be evaluated.
+
+    Parameters are nodes keyed by their scope and name, where a scope is
+    ("project",), ("database", database) or ("activity", group, database).
+    Symbols are looked up in the scope of a formula first, then in the
+    database and the project scope, the same way `ParameterManager`
+    combines them. Exchanges are evaluated in the order of
+    `ParameterManager.indices`.
+    """
+
+    def __init__(self, initial: StaticParameters, parameters: Parameters):
+        self.interpreter = Interpreter()
+        self.functions = dict(self.interpreter.symtable)
+        self.functions["__builtins__"] = {}
+        self.inputs = {
+            (p.param_type, p.group, p.name): i for i, p in enumerate(parameters)
+        }
+        self.nodes: Dict[tuple, FormulaNode] = {}
+        # The parameter names of every scope
+        self.scopes: Dict[tuple, set] = {}
+        self.exchanges: List[tuple] = []
+
+        project = ("project",)
+        self.add_scope(project, "project", initial.project(), [])
+        for db in initial.databases:
+            self.add_scope(("database", db), db, initial.by_database(db), [project])
+        for p in initial.act_by_group_db:
+            scope = ("activity", p.group, p.database)
+            parents = [("database", p.database), project]
+            self.add_scope(scope, p.group, initial.act_by_group(p.group), parents)
+            for exc, formula in initial.exc_by_group(p.group).items():
+                key = ("exchange", p.group, p.database, exc)
+                self.add_node(key, scope, formula, parents)
+                self.exchanges.append(key)
+        self.order = self.sort()
+
+    def add_scope(
+        self, scope: tuple, group: str, data: dict, parents: List[tuple]
+    ) -> None:
+        param_type = scope[0]
+        self.scopes[scope] = set(data)
+        for name, values in data.items():
+            if values.get("formula"):
+                self.add_node(
+                    (scope, name),
+                    scope,
+                    values["formula"],
+                    parents,
+                    values.get("amount", np.nan),
+                )
+            else:
+                self.nodes[(scope, name)] = FormulaNode(
+                    None,
+                    {},
+                    self.inputs.get((param_type, group, name)),
+                    values.get("amount", np.nan),
+                )
+
+    def add_node(
+        self,
+        key: tuple,
+        scope: tuple,
+        text: str,
+        parents: List[tuple],
+        default: float = np.nan,
+    ) -> None:
+        formula = Formula.parse(text)
+        symbols, missing = {}, set()
+        for name in formula.names:
+            found = next(
+                (
+                    (s, name)
+                    for s in [scope] + parents
+                    if name in self.scopes.get(s, ())
+                ),
+                None,
+            )
+            if found is not None:
+                symbols[name] = found
+            elif name not in self.functions:
+                missing.add(name)
+        if missing:
+            raise MissingName(
+                "The following variables aren't defined:\n{}".format("|".join(missing))
+            )
+        self.nodes[key] = FormulaNode(formula, symbols, default=default)
+
+    def sort(self) -> List[tuple]:
+        """Order the nodes so every node follows the nodes it depends on."""
+        order, state = [], {}
+        for start in self.nodes:
+            if start in state:
+                continue
+            stack = [(start, iter(self.nodes[start].symbols.values()))]
+            state[start] = False
+            while stack:
+                key, dependencies = stack[-1]
+                dependency = next(dependencies, None)
+                if dependency is None:
+                    stack.pop()
+                    state[key] = True
+                    order.append(key)
+                elif dependency not in state:
+                    state[dependency] = False
+                    node = self.nodes[dependency]
+                    stack.append((dependency, iter(node.symbols.values())))
+                elif not state[dependency]:
+                    raise ValueError(
+                        "Cyclical parameter dependencies found for '{}'".format(
+                            dependency[-1]
+                        )
+                    )
+        return order
+
+    def downstream(self, keys: Iterable[tuple]) -> Set[tuple]:
+        """Return the given nodes and all nodes that depend on them."""
+        dependents = defaultdict(list)
+        for key, node in self.nodes.items():
+            for dependency in node.symbols.values():
+                dependents[dependency].append(key)
+        closure, stack = set(), [k for k in keys if k in self.nodes]
+        while stack:
+            key = stack.pop()
+            if key not in closure:
+                closure.add(key)
+                stack.extend(dependents[key])
+        return closure
+
+    def recalculate(self, keys: Iterable[tuple]) -> Dict[tuple, float]:
+        """Recalculate the formulas downstream of the given nodes, all other
+        parameters keep their current amount.
+
+        Returns the amounts of the given and downstream nodes, including the
+        parameterized exchanges.
+        """
+        closure = self.downstream(keys)
+        values = {}
+        for key in self.order:
+            node = self.nodes[key]
+            if key not in closure or node.formula is None:
+                values[key] = node.default
+                continue
+            scalars = {name: values[dep] for name, dep in node.symbols.items()}
+            values[key] = self.compute_scalar(node.formula, scalars)
+        return {key: values[key] for key in self.order if key in closure}
+
+    def set_amounts(self, amounts: Dict[tuple, float]) -> None:
+        """Set the current amount of the given nodes, as they are stored
+        after an edit or a recalculation."""
+        for key, amount in amounts.items():
+            self.nodes[key] = self.nodes[key]._replace(default=amount)
+
+    def evaluate(self, amounts: np.ndarray) -> np.ndarray:
+        """Evaluate the graph for the (parameters x columns) `amounts`, in the
+        order of `Parameters`, and return the (exchanges x columns) amounts
+        of the parameterized exchanges.
+        """
+        amounts = np.asarray(amounts, dtype=float)
+        columns = amounts.shape[1]
+        values = {}
+        for key in self.order:
+            node = self.nodes[key]
+            if node.formula is None:
+                if node.source is None:
+                    values[key] = np.full(columns, node.default, dtype=float)
+                else:
+                    values[key] = amounts[node.source]
+                continue
+            namespace = {name: values[dep] for name, dep in node.symbols.items()}
+            values[key] = self.compute(node.formula, namespace, columns)
+        if not self.exchanges:
+            return np.zeros((0, columns))
+        return np.vstack([values[key] for key in self.exchanges])
+
+    def compute(self, formula: Formula, namespace: dict, columns: int) -> np.ndarray:
+        """Evaluate a formula for all columns at once, or per column if the
+        formula does not work on arrays."""
+        if formula.code is not None:
+            try:
+                with np.errstate(divide="raise", invalid="raise"):
+                    result = eval(formula.code, self.functions, namespace)
+                return np.broadcast_to(
+                    np.asarray(result, dtype=float), (columns,)
+                ).copy()
+            except Exception:
+                pass
+        result = np.empty(columns)
+        for i in range(columns):
+            scalars = {name: float(value[i]) for name, value in namespace.items()}
+            result[i] = self.compute_scalar(formula, scalars)
+        return result
+
+    def compute_scalar(self, formula: Formula, scalars: dict) -> float:
+        if formula.code is not None:
+            try:
+                return float(eval(formula.code, self.functions, scalars))
+            except Exception as e:
+                raise ValueError(
+                    "Could not evaluate formula '{}': {}".format(formula.text, e)
+                )
+        self.interpreter.symtable.update(scalars)
+        self.interpreter.error = []
+        result = self.interpreter(formula.text)
+        if self.interpreter.error or result is None:
+            raise ValueError("Could not evaluate formula '{}'".format(formula.text))
+        return float(result)
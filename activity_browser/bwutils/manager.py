@@ -9,7 +9,9 @@ from stats_arrays import MCRandomNumberGenerator, UncertaintyBase
 from activity_browser.mod.bw2data.backends import ExchangeDataset
 from activity_browser.mod.bw2data.parameters import *
 
-from .utils import Index, Indices, Parameters, StaticParameters
+from .formulas import FormulaGraph
+from .utils import (Index, Indices, Parameters, StaticParameters,
+                    exchanges_by_id)
 
 
 class ParameterManager(object):
@@ -21,19 +23,24 @@ class ParameterManager(object):
         self.parameters: Parameters = Parameters.from_bw_parameters()
         self.initial: StaticParameters = StaticParameters()
         self.indices: Indices = self.construct_indices()
+        self.formulas = FormulaGraph(self.initial, self.parameters)
 
     def construct_indices(self) -> Indices:
         """Given that ParameterizedExchanges will always have the same order of
         indices, construct them once and reuse when needed.
         """
-        indices = Indices()
-        for p in self.initial.act_by_group_db:
-            params = self.initial.exc_by_group(p.group)
-            indices.extend(
-                Index.build_from_exchange(ExchangeDataset.get_by_id(pk))
-                for pk in params
+        ids = [
+            pk
+            for p in self.initial.act_by_group_db
+            for pk in self.initial.exc_by_group(p.group)
+        ]
+        exchanges = exchanges_by_id(ids)
+        return Indices(
+            Index.build_from_exchange(
+                exchanges.get(pk) or ExchangeDataset.get_by_id(pk)
             )
-        return indices
+            for pk in ids
+        )
 
     def recalculate_project_parameters(self) -> dict:
         data = self.initial.project()
@@ -156,12 +163,17 @@ class ParameterManager(object):
         and returns a fully-formed set of exchange amounts and indices.
 
         All parameter types are recalculated in turn before interpreting the
-        ParameterizedExchange formulas into amounts.
+        ParameterizedExchange formulas into amounts, using the compiled
+        `FormulaGraph`.
+        """
+        return self.calculate_many(self.parameters.amounts()[:, None])[:, 0]
+
+    def calculate_many(self, amounts: np.ndarray) -> np.ndarray:
+        """Recalculate all parameters and ParameterizedExchanges for every
+        column of the (parameters x columns) `amounts` in one pass, returning
+        the (exchanges x columns) exchange amounts.
         """
-        global_project = self.recalculate_project_parameters()
-        all_db = self.process_database_parameters(global_project)
-        data = self.process_exchanges(global_project, all_db)
-        return data
+        return self.formulas.evaluate(amounts)
 
     @abstractmethod
     def recalculate(self, values: List[float]) -> np.ndarray:
@@ -206,11 +218,25 @@ class ParameterManager(object):
         Side-note on presamples: Presamples was used in AB for calculating scenarios,
         presamples was superseded by this implementation. For more reading:
         https://presamples.readthedocs.io/en/latest/index.html"""
-        sample_data = [self.ps_recalculate(list(values)) for _, values in scenarios]
-        samples = np.concatenate(sample_data, axis=1)
+        samples = self.recalculate_scenarios([values for _, values in scenarios])
         indices = self.reformat_indices()
         return samples, indices
 
+    def recalculate_scenarios(self, scenarios: List[List[float]]) -> np.ndarray:
+        """Recalculate the exchanges of all parameter scenarios in one pass,
+        returning the (exchanges x scenarios) exchange amounts.
+
+        The scenarios are applied in turn like `recalculate` does: NaN values
+        keep the amount of the previous scenario and the parameters are left
+        with the amounts of the last scenario.
+        """
+        if not scenarios:
+            return np.zeros((len(self.indices), 0))
+        values = np.column_stack([np.asarray(list(v), dtype=float) for v in scenarios])
+        amounts = self.parameters.sequential_amounts(values)
+        self.parameters.update(amounts[:, -1])
+        return self.calculate_many(amounts)
+
     @staticmethod
     def has_parameterized_exchanges() -> bool:
         """Test if ParameterizedExchanges exist, no point to using this manager
@@ -320,20 +346,41 @@ class MonteCarloParameterManager(ParameterManager, Iterator):
         assert iterations > 0, "Must have a positive amount of iterations"
         if iterations == 1:
             return self.next()
-        # Construct indices, prepare sized array and sample parameter
-        # uncertainty distributions `interations` times.
-        all_data = np.empty((iterations, len(self.indices)), dtype=Indices.array_dtype)
+        # Sample parameter uncertainty distributions `interations` times.
         random_bounded_values = self.mc_generator.generate(iterations)
+        all_data, _ = self.recalculate_samples(random_bounded_values)
+        return all_data
 
-        # Now, repeatedly replace parameter amounts with sampled data and
-        # recalculate. Every processed row is added to the sized array.
-        for i in range(iterations):
-            values = random_bounded_values.take(i, axis=1)
-            self.parameters.update(values)
-            data = self.calculate()
-            all_data[i] = self.indices.mock_params(data)
+    def sample(self, iterations: int) -> (np.ndarray, np.ndarray):
+        """Sample the parameter uncertainty as `iterations` calls of `next`
+        would, but recalculate all of the samples in one pass.
 
-        return all_data
+        Returns the params array of every iteration and the
+        (parameters x iterations) sampled parameter amounts.
+        """
+        values = np.column_stack([self.mc_generator.next() for _ in range(iterations)])
+        return self.recalculate_samples(values)
+
+    def recalculate_samples(self, values: np.ndarray) -> (np.ndarray, np.ndarray):
+        """Recalculate the exchanges for every column of sampled parameter
+        `values` at once, see `sample`.
+        """
+        # Replace parameter amounts with sampled data in turn, the parameters
+        # are left with the amounts of the last sample
+        amounts = self.parameters.sequential_amounts(values)
+        self.parameters.update(amounts[:, -1])
+        data = self.calculate_many(amounts)
+
+        all_data = np.empty(
+            (amounts.shape[1], len(self.indices)), dtype=Indices.array_dtype
+        )
+        all_data[:] = self.indices.mock_params(np.zeros(len(self.indices)))
+        all_data["amount"] = data.T
+        return all_data, amounts
+
+    def reseed(self, seed: Optional[int] = None) -> None:
+        """Continue sampling from a new random stream started with `seed`."""
+        self.mc_generator.random = np.random.RandomState(seed)
 
     def next(self) -> np.ndarray:
         """Similar to `recalculate` but only performs a single sampling and
@@ -360,3 +407,113 @@ class MonteCarloParameterManager(ParameterManager, Iterator):
             if param is None:
                 continue
             data[name]["values"].append(param.amount)
+
+
+def parameter_node(parameter: ParameterBase) -> Tuple[tuple, str]:
+    """Return the `FormulaGraph` key of a brightway parameter and the name of
+    the brightway `Group` it belongs to.
+    """
+    if isinstance(parameter, ProjectParameter):
+        return (("project",), parameter.name), "project"
+    elif isinstance(parameter, DatabaseParameter):
+        return (("database", parameter.database), parameter.name), parameter.database
+    scope = ("activity", parameter.group, parameter.database)
+    return (scope, parameter.name), parameter.group
+
+
+# The FormulaGraph of a project and the parameter counts it was built for,
+# kept between parameter edits, see `formula_graph`
+_formula_graph: Optional[Tuple[tuple, FormulaGraph]] = None
+
+
+def _formula_graph_signature() -> tuple:
+    return (
+        projects.current,
+        ProjectParameter.select().count(),
+        DatabaseParameter.select().count(),
+        ActivityParameter.select().count(),
+        ParameterizedExchange.select().count(),
+    )
+
+
+def formula_graph() -> FormulaGraph:
+    """Return the `FormulaGraph` of the current project.
+
+    The graph is built once and kept until parameters or parameterized
+    exchanges are added or removed, or `invalidate_formula_graph` is called
+    after a name or formula is edited.
+    """
+    global _formula_graph
+    signature = _formula_graph_signature()
+    if _formula_graph is None or _formula_graph[0] != signature:
+        _formula_graph = (signature, FormulaGraph(StaticParameters(), Parameters()))
+    return _formula_graph[1]
+
+
+def invalidate_formula_graph() -> None:
+    """Drop the kept `FormulaGraph`, needed when names or formulas of
+    parameters or exchanges are edited."""
+    global _formula_graph
+    _formula_graph = None
+
+
+def recalculate_downstream(parameter: ParameterBase) -> None:
+    """Recalculate only the parameters and parameterized exchanges that
+    depend on the given (saved) parameter, and write them back in a single
+    transaction.
+
+    Falls back to the full brightway recalculation if other parameter groups
+    are out of date, or if the dependencies cannot be resolved by the
+    `FormulaGraph` (like activity groups depending on other groups). The
+    graph is kept between edits, see `formula_graph`.
+    """
+    key, group = parameter_node(parameter)
+    expired = {g.name for g in Group.select(Group.name).where(Group.fresh == False)}
+    if not expired.issubset({group}):
+        invalidate_formula_graph()
+        parameters.recalculate()
+        return
+    try:
+        graph = formula_graph()
+        if key not in graph.nodes:
+            invalidate_formula_graph()
+            graph = formula_graph()
+        if graph.nodes[key].formula is None:
+            graph.set_amounts({key: parameter.amount})
+        values = graph.recalculate([key])
+    except (MissingName, ValueError, KeyError):
+        invalidate_formula_graph()
+        parameters.recalculate()
+        return
+
+    exchanges = {k[3]: v for k, v in values.items() if k[0] == "exchange"}
+    groups, dbs = {group}, set()
+    with parameters.db.atomic():
+        for key, amount in values.items():
+            node = graph.nodes[key]
+            if key[0] == "exchange" or node.formula is None or amount == node.default:
+                continue
+            scope, name = key
+            if scope[0] == "project":
+                ProjectParameter.update(amount=amount).where(
+                    ProjectParameter.name == name
+                ).execute()
+            elif scope[0] == "database":
+                DatabaseParameter.update(amount=amount).where(
+                    DatabaseParameter.name == name,
+                    DatabaseParameter.database == scope[1],
+                ).execute()
+            else:
+                ActivityParameter.update(amount=amount).where(
+                    ActivityParameter.name == name,
+                    ActivityParameter.group == scope[1],
+                ).execute()
+            groups.add("project" if scope[0] == "project" else scope[1])
+        for exc in exchanges_by_id(exchanges).values():
+            exc.data["amount"] = exchanges[exc.id]
+            exc.save()
+            dbs.add(exc.output_database)
+        Group.update(fresh=True).where(Group.name << list(groups)).execute()
+    graph.set_amounts(values)
+    for db in dbs:
+        databases.set_dirty(db)
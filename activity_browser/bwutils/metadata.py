@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
 from logging import getLogger
+from typing import Optional
 
 import numpy as np
 import pandas as pd
-from bw2data.errors import UnknownObject
 
 import activity_browser.bwutils.commontasks as bc
 from activity_browser.mod import bw2data as bd
-from activity_browser.mod.bw2data.backends import ActivityDataset
+from activity_browser.mod.bw2data.backends import Activity, ActivityDataset
 
 # todo: extend store over several projects
 
@@ -33,6 +37,11 @@ class MetaDataStore(object):
     and can be indexed by (activity or biosphere key).
     The columns feature the metadata.
 
+    Low-cardinality columns are stored as pandas categoricals, rows of the
+    same database are kept together so a database can be returned as a
+    slice of the dataframe, and keys are resolved to row positions through
+    a hash index.
+
     Properties
     ----------
     index
@@ -47,12 +56,42 @@ class MetaDataStore(object):
     # add them to `self.act_fields` there and `CLASSIFICATION_SYSTEMS` below
     CLASSIFICATION_SYSTEMS = ["ISIC rev.4 ecoinvent"]
 
+    # Bump this whenever the layout of the per-database frames changes, so
+    # that caches written by an older AB version are rebuilt.
+    CACHE_VERSION = 1
+    CACHE_DIRECTORY = "ab_metadata"
+
+    # Columns with few distinct values, these are stored as categoricals
+    CATEGORICAL_COLUMNS = ["database", "location", "unit", "type", "categories"]
+
+    # Number of labels kept in memory by `get_labels`
+    LABEL_CACHE_SIZE = 100_000
+
     def __init__(self):
-        self.dataframe = pd.DataFrame()
+        self._dataframe = pd.DataFrame()
+        self._key_positions: Optional[pd.Index] = None
+        self._database_slices: Optional[dict] = None
+        self._labels = OrderedDict()
         self.databases = set()
 
+        # keys queued for an update while a batch is active, see `batch`
+        self._batch_depth = 0
+        self._queued = set()
+
         bd.projects.current_changed.connect(self.reset_metadata)
 
+    @property
+    def dataframe(self) -> pd.DataFrame:
+        return self._dataframe
+
+    @dataframe.setter
+    def dataframe(self, df: pd.DataFrame) -> None:
+        # the lookup structures are rebuilt on first use
+        self._dataframe = df
+        self._key_positions = None
+        self._database_slices = None
+        self._labels.clear()
+
     def add_metadata(self, db_names_list: list) -> None:
         """Include data from the brightway databases.
 
@@ -86,27 +125,134 @@ class MetaDataStore(object):
             log.debug(f"Adding: {db_name}")
             self.databases.add(db_name)
 
-            # make a temporary DataFrame and index it by ('database', 'code') (like all brightway activities)
-            df = pd.DataFrame(bd.Database(db_name))
-            df["key"] = df.loc[:, ["database", "code"]].apply(tuple, axis=1)
-            df.index = pd.MultiIndex.from_tuples(df["key"])
-
-            # add unpacked classifications columns if classifications are present
-            if "classifications" in df.columns:
-                df = self.unpack_classifications(df, self.CLASSIFICATION_SYSTEMS)
-
-            # In a new 'biosphere3' database, some categories values are lists
-            if "categories" in df.columns:
-                df["categories"] = df.loc[:, "categories"].apply(list_to_tuple)
+            df = self._load_from_cache(db_name)
+            if df is None:
+                df = self._build_database_frame(db_name)
+                self._write_to_cache(db_name, df)
 
             dfs.append(df)
 
         # add this metadata to already existing metadata
-        self.dataframe = pd.concat(dfs, sort=False)
-        self.dataframe.replace(
-            np.nan, "", regex=True, inplace=True
-        )  # replace 'nan' values with emtpy string
-        # print('Dimensions of the Metadata:', self.dataframe.shape)
+        self.dataframe = self._concat_frames(dfs)
+
+    def _build_database_frame(self, db_name: str) -> pd.DataFrame:
+        """Read all activities of the given database into a metadata frame."""
+        return self._build_frame(bd.Database(db_name))
+
+    def _build_frame(self, data) -> pd.DataFrame:
+        """Build a metadata frame from activity data, either a brightway
+        database or a list of activity dictionaries.
+        """
+        # make a temporary DataFrame and index it by ('database', 'code') (like all brightway activities)
+        df = pd.DataFrame(data)
+        df["key"] = list(zip(df["database"], df["code"]))
+        df.index = pd.MultiIndex.from_tuples(df["key"])
+
+        # add unpacked classifications columns if classifications are present
+        if "classifications" in df.columns:
+            df = self.unpack_classifications(df, self.CLASSIFICATION_SYSTEMS)
+
+        # In a new 'biosphere3' database, some categories values are lists
+        if "categories" in df.columns:
+            df["categories"] = df.loc[:, "categories"].apply(list_to_tuple)
+        df = df.fillna("")  # replace 'nan' values with empty string
+        return self._categorize(df)
+
+    @classmethod
+    def _categorize(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """Convert the low-cardinality columns of the frame to categoricals."""
+        for col in cls.CATEGORICAL_COLUMNS + cls.CLASSIFICATION_SYSTEMS:
+            if col in df.columns and not isinstance(
+                df[col].dtype, pd.CategoricalDtype
+            ):
+                df[col] = df[col].astype("category")
+        return df
+
+    @classmethod
+    def _concat_frames(cls, frames: list) -> pd.DataFrame:
+        """Concatenate metadata frames.
+
+        The frames themselves contain no NaN values, so only the columns that
+        are absent from some of the frames need to be filled afterwards.
+        """
+        frames = [f for f in frames if len(f.columns)]
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, sort=False)
+        partial = [c for c in df.columns if not all(c in f.columns for f in frames)]
+        for col in partial:
+            if isinstance(df[col].dtype, pd.CategoricalDtype) and "" not in df[col].cat.categories:
+                df[col] = df[col].cat.add_categories("")
+            df[col] = df[col].fillna("")
+        # categoricals with differing categories are concatenated as objects
+        return cls._categorize(df)
+
+    def _cache_path(self, db_name: str) -> str:
+        """Return the location of the on-disk metadata cache of a database
+        within the current project directory.
+        """
+        directory = os.path.join(bd.projects.dir, self.CACHE_DIRECTORY)
+        filename = hashlib.md5(db_name.encode()).hexdigest()
+        return os.path.join(directory, f"{filename}.pickle")
+
+    def _cache_signature(self, db_name: str) -> Optional[tuple]:
+        """Return the values a cached frame has to match to still be valid.
+
+        The modification time of the database changes on every write or
+        activity edit, the record count guards against writes that do
+        not update it.
+        """
+        modified = bd.databases[db_name].get("modified")
+        if not modified:
+            return None
+        return (
+            self.CACHE_VERSION,
+            str(modified),
+            bc.count_database_records(db_name),
+            tuple(self.CLASSIFICATION_SYSTEMS),
+        )
+
+    def _load_from_cache(self, db_name: str) -> Optional[pd.DataFrame]:
+        """Return the cached metadata frame of the database, or None if there
+        is no valid cache.
+        """
+        path = self._cache_path(db_name)
+        if not os.path.isfile(path):
+            return None
+        signature = self._cache_signature(db_name)
+        if signature is None:
+            return None
+        try:
+            with open(path, "rb") as infile:
+                cached = pickle.load(infile)
+        except Exception as e:
+            # unreadable caches (e.g. written by a different pandas version) are simply rebuilt
+            log.debug(f"Could not read metadata cache of {db_name}: {e}")
+            return None
+        if cached.get("signature") != signature:
+            log.debug(f"Metadata cache of {db_name} is outdated")
+            return None
+        log.debug(f"Loaded metadata of {db_name} from cache")
+        return cached["dataframe"]
+
+    def _write_to_cache(self, db_name: str, df: pd.DataFrame) -> None:
+        """Store the metadata frame of the database in the project directory."""
+        signature = self._cache_signature(db_name)
+        if signature is None:
+            return
+        path = self._cache_path(db_name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so an interrupted write never leaves a broken cache
+            with open(f"{path}.tmp", "wb") as outfile:
+                pickle.dump(
+                    {"signature": signature, "dataframe": df},
+                    outfile,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            log.warning(f"Could not write metadata cache of {db_name}: {e}")
 
     def update_metadata(self, key: tuple) -> None:
         """Update metadata when an activity has changed.
@@ -117,53 +263,99 @@ class MetaDataStore(object):
         3. An activity has been added.
            Note that duplicating activities is the same as adding a new activity.
 
+        Within a `batch` the key is only queued and the update is applied
+        together with all other queued keys when the batch ends.
+
         Parameters
         ----------
         key : tuple
             The specific activity to update in the MetaDataStore
         """
-        try:
-            act = bd.get_activity(
-                key
-            )  # if this does not work, it has been deleted (see except:).
-        except (UnknownObject, ActivityDataset.DoesNotExist):
-            # Situation 1: activity has been deleted (metadata needs to be deleted)
-            log.debug(f"Deleting activity from metadata: {key}")
-            self.dataframe.drop(key, inplace=True, errors="ignore")
-            # print('Dimensions of the Metadata:', self.dataframe.shape)
+        if self._batch_depth:
+            self._queued.add(key)
             return
+        self._apply_updates({key})
 
-        db = key[0]
-        if db not in self.databases:
-            # print('Database has not been added to metadata.')
-            self.add_metadata([db])
-        else:
-            if (
-                key in self.dataframe.index
-            ):  # Situation 2: activity has been modified (metadata needs to be updated)
-                log.debug(f"Updating activity in metadata: {key}")
-                for col in self.dataframe.columns:
-                    if col in self.CLASSIFICATION_SYSTEMS:
-                        # update classification data
-                        classification = self._unpacker(
-                            classifications=[act.get('classifications', '')],
-                            system=col)
-                        self.dataframe.at[key, col] = classification[0]
-                    else:
-                        self.dataframe.at[key, col] = act.get(col, '')
-                self.dataframe.at[key, 'key'] = act.key
-
-            else:  # Situation 3: Activity has been added to database (metadata needs to be generated)
-                log.debug(f'Adding activity to metadata: {key}')
-                df_new = pd.DataFrame([act.as_dict()], index=pd.MultiIndex.from_tuples([act.key]))
-                df_new['key'] = [act.key]
-                if act.get('classifications', False):  # add classification data if present
-                    df_new = self.unpack_classifications(df_new, self.CLASSIFICATION_SYSTEMS)
-                self.dataframe = pd.concat([self.dataframe, df_new], sort=False)
-                self.dataframe.replace(
-                    np.nan, "", regex=True, inplace=True
-                )  # replace 'nan' values with emtpy string
-            # print('Dimensions of the Metadata:', self.dataframe.shape)
+    def batch(self) -> "MetaDataBatch":
+        """Return a context manager that defers all `update_metadata` calls
+        until the (outermost) batch ends and then applies them in one pass.
+
+        .. code-block:: python
+            with AB_metadata.batch():
+                for act in activities:
+                    act.copy()
+        """
+        return MetaDataBatch(self)
+
+    def queued_keys(self, db_name: str = None) -> set:
+        """Return the keys queued for an update in the current batch,
+        optionally only those of the given database.
+        """
+        if db_name is None:
+            return set(self._queued)
+        return {key for key in self._queued if key[0] == db_name}
+
+    def flush(self) -> None:
+        """Apply all queued updates to the dataframe."""
+        keys, self._queued = self._queued, set()
+        if keys:
+            self._apply_updates(keys)
+
+    def _apply_updates(self, keys: set) -> None:
+        """Synchronize the given keys with the brightway databases in a single
+        vectorized pass.
+
+        Keys that no longer exist are dropped, existing rows are replaced in
+        place and new activities are appended.
+        """
+        # databases that are not yet in the store are read in full, this includes the changed keys
+        unknown = {key[0] for key in keys}.difference(self.databases)
+        keys = {key for key in keys if key[0] not in unknown}
+        new_dbs = [db for db in unknown if db in bd.databases]
+        if new_dbs:
+            self.add_metadata(new_dbs)
+        if not keys:
+            return
+
+        records = self._read_activities(keys)
+        deleted = [key for key in keys if key not in records]
+        log.debug(
+            f"Updating metadata: {len(records)} added or modified, {len(deleted)} deleted"
+        )
+
+        df = self.dataframe
+        if deleted:
+            df = df.drop(index=deleted, errors="ignore")
+        if not records:
+            self.dataframe = df
+            return
+
+        new = self._build_frame(list(records.values()))
+        # keep modified rows at their position and append the added rows
+        order = df.index.append(new.index[~new.index.isin(df.index)])
+        df = df.loc[~df.index.isin(new.index)]
+        self.dataframe = self._concat_frames([df, new]).reindex(order)
+
+    @staticmethod
+    def _read_activities(keys: set) -> dict:
+        """Read the data of the given keys from the database in bulk.
+
+        Returns a {key: data} dictionary, keys that do not exist are absent.
+        """
+        records = {}
+        dbs = {key[0] for key in keys}
+        codes = sorted({key[1] for key in keys})
+        # stay well below the SQLite limit of variables in a single query
+        for i in range(0, len(codes), 500):
+            query = ActivityDataset.select().where(
+                (ActivityDataset.database << dbs)
+                & (ActivityDataset.code << codes[i : i + 500])
+            )
+            for doc in query:
+                key = (doc.database, doc.code)
+                if key in keys:
+                    records[key] = Activity(doc).as_dict()
+        return records
 
     def reset_metadata(self) -> None:
         """Deletes metadata when the project is changed."""
@@ -171,20 +363,137 @@ class MetaDataStore(object):
         log.debug("Reset metadata.")
         self.dataframe = pd.DataFrame()
         self.databases = set()
+        self._queued = set()
 
     def get_existing_fields(self, field_list: list) -> list:
         """Return a list of fieldnames that exist in the current dataframe."""
         return [fn for fn in field_list if fn in self.dataframe.columns]
 
+    def key_positions(self, keys) -> np.ndarray:
+        """Return the row positions of the given keys in the dataframe, -1
+        for keys that are not in the MetaDataStore.
+        """
+        if self._key_positions is None:
+            self._key_positions = pd.Index(
+                self.dataframe["key"].to_numpy() if len(self.dataframe) else [],
+                dtype=object,
+                tupleize_cols=False,
+            )
+        keys = pd.Index(list(keys), dtype=object, tupleize_cols=False)
+        return self._key_positions.get_indexer(keys)
+
     def get_metadata(self, keys: list, columns: list) -> pd.DataFrame:
         """Return a slice of the dataframe matching row and column identifiers.
 
-        NOTE: https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html#deprecate-loc-reindex-listlike
-        From pandas version 1.0 and onwards, attempting to select a column
-        with all NaN values will fail with a KeyError.
+        A single key returns the matching row as a Series. Categorical columns
+        are returned as plain object columns, so the result can be joined,
+        grouped and filled like any other frame.
+
+        Raises
+        ------
+        KeyError
+            If any of the keys is not in the MetaDataStore
         """
-        df = self.dataframe.loc[pd.IndexSlice[keys], :]
-        return df.reindex(columns, axis="columns")
+        single = isinstance(keys, tuple)
+        positions = self.key_positions([keys] if single else keys)
+        if (positions == -1).any():
+            raise KeyError(f"Keys not found in the metadata: {keys}")
+        if single:
+            return self.dataframe.iloc[positions[0]].reindex(columns)
+        df = self.dataframe.iloc[positions].reindex(columns, axis="columns")
+        categorical = [
+            c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)
+        ]
+        return df.astype({c: object for c in categorical})
+
+    def get_labels(
+        self, keys, fields: list, separator: str = " | ", missing: str = ""
+    ) -> list:
+        """Return a label for each of the keys by joining the given fields.
+
+        Labels that are not yet known are built in one vectorized pass over
+        the dataframe and kept in a least-recently-used cache until the
+        metadata changes.
+
+        Parameters
+        ----------
+        keys : Iterable of activity keys
+        fields : Column-names to include in the label
+        separator : String used to join the fields
+        missing : String used for fields without a value
+
+        Returns
+        -------
+        list
+            The labels in the order of the keys, `None` for keys that are not
+            in the MetaDataStore
+
+        """
+        keys = list(keys)
+        fields = tuple(fields)
+        cache = self._labels
+        missing_keys = list(
+            dict.fromkeys(
+                k for k in keys if (k, fields, separator, missing) not in cache
+            )
+        )
+        if missing_keys:
+            positions = self.key_positions(missing_keys)
+            found = positions != -1
+            labels = [None] * len(missing_keys)
+            if found.any() and fields:
+                df = self.dataframe.iloc[positions[found]]
+                columns = []
+                for f in fields:
+                    if f not in df.columns:
+                        columns.append(np.full(len(df), missing, dtype=object))
+                        continue
+                    values = df[f].to_numpy(dtype=object)
+                    column = np.frompyfunc(str, 1, 1)(values)
+                    column[pd.isna(values)] = missing
+                    columns.append(column)
+                joined = columns[0]
+                for column in columns[1:]:
+                    joined = joined + separator + column
+                for i, label in zip(np.flatnonzero(found), joined):
+                    labels[i] = label
+            for key, label in zip(missing_keys, labels):
+                cache[(key, fields, separator, missing)] = label
+
+        result = []
+        for key in keys:
+            cache.move_to_end((key, fields, separator, missing))
+            result.append(cache[(key, fields, separator, missing)])
+        # evict only after the labels of these keys are taken from the cache
+        while len(cache) > self.LABEL_CACHE_SIZE:
+            cache.popitem(last=False)
+        return result
+
+    def ids_to_keys(self, ids) -> list:
+        """Translate activity ids into keys, values that are not integers are
+        returned as they are.
+
+        Ids are looked up in the dataframe first, the remaining ids are read
+        from the database in bulk.
+        """
+        ids = list(ids)
+        wanted = list({i for i in ids if isinstance(i, (int, np.integer))})
+        if not wanted:
+            return ids
+
+        found = {}
+        if "id" in self.dataframe.columns:
+            positions = pd.Index(self.dataframe["id"]).get_indexer(wanted)
+            keys = self.dataframe["key"].to_numpy()
+            found = {i: keys[p] for i, p in zip(wanted, positions) if p != -1}
+        remaining = [i for i in wanted if i not in found]
+        # stay well below the SQLite limit of variables in a single query
+        for n in range(0, len(remaining), 500):
+            query = ActivityDataset.select(
+                ActivityDataset.id, ActivityDataset.database, ActivityDataset.code
+            ).where(ActivityDataset.id << remaining[n : n + 500])
+            found.update({doc.id: (doc.database, doc.code) for doc in query})
+        return [found[i] if i in found else i for i in ids]
 
     def get_database_metadata(self, db_name: str) -> pd.DataFrame:
         """Return a slice of the dataframe matching the database.
@@ -199,14 +508,39 @@ class MetaDataStore(object):
         Returns
         -------
         pd.DataFrame
-            Slice of the metadata matching the database name
+            Slice of the metadata matching the database name, this is not
+            a copy so it should not be altered in place
 
         """
         if db_name not in self.databases:
             if bc.count_database_records(db_name) == 0:
                 return pd.DataFrame()
             self.add_metadata([db_name])
-        return self.dataframe.loc[self.dataframe["database"] == db_name].copy(deep=True)
+        db_slice = self._get_database_slices().get(db_name, slice(0, 0))
+        return self.dataframe.iloc[db_slice]
+
+    def _get_database_slices(self) -> dict:
+        """Return the {database: slice} positions of every database in the
+        dataframe, rows are regrouped per database if they are not yet.
+        """
+        if self._database_slices is not None:
+            return self._database_slices
+        if self.dataframe.empty:
+            self._database_slices = {}
+            return self._database_slices
+
+        codes, uniques = pd.factorize(self.dataframe["database"])
+        if (np.diff(codes) < 0).any():
+            # activities added during the session are appended at the end
+            self.dataframe = self.dataframe.iloc[np.argsort(codes, kind="stable")]
+            codes = np.sort(codes)
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        stops = np.r_[starts[1:], len(codes)]
+        self._database_slices = {
+            uniques[codes[start]]: slice(start, stop)
+            for start, stop in zip(starts, stops)
+        }
+        return self._database_slices
 
     @property
     def index(self):
@@ -221,16 +555,14 @@ class MetaDataStore(object):
         data = self.get_database_metadata(db_name)
         if "location" not in data.columns:
             return set()
-        locations = data["location"].unique()
-        return set(locations[locations != ""])
+        return set(data["location"].unique()).difference({""})
 
     def get_units(self, db_name: str) -> set:
         """Returns a set of units for the given database name."""
         data = self.get_database_metadata(db_name)
         if "unit" not in data.columns:
             return set()
-        units = data["unit"].unique()
-        return set(units[units != ""])
+        return set(data["unit"].unique()).difference({""})
 
     def print_convenience_information(self, db_name: str) -> None:
         """Reports how many unique locations and units the database has."""
@@ -283,4 +615,23 @@ class MetaDataStore(object):
         return system_classifications
 
 
+class MetaDataBatch(object):
+    """Context manager that queues the updates of a MetaDataStore and applies
+    them in a single pass when the outermost batch is left.
+    """
+
+    def __init__(self, store: MetaDataStore):
+        self.store = store
+
+    def __enter__(self) -> MetaDataStore:
+        self.store._batch_depth += 1
+        return self.store
+
+    def __exit__(self, *args):
+        # also apply the queue on errors, the database may have changed regardless
+        self.store._batch_depth -= 1
+        if self.store._batch_depth == 0:
+            self.store.flush()
+
+
 AB_metadata = MetaDataStore()
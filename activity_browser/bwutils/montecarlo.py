@@ -1,46 +1,46 @@
+import multiprocessing
+import shutil
+import tempfile
+import weakref
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from time import time
-from typing import Optional, Union
+from typing import Optional
 from logging import getLogger
 
 import bw2calc as bc
 import numpy as np
 import pandas as pd
-from stats_arrays import MCRandomNumberGenerator
 
 from activity_browser.mod import bw2data as bd
+from activity_browser_workers.montecarlo import (MonteCarloIterations,
+                                                 calculate_chunk, init_worker)
 
 from .manager import MonteCarloParameterManager
+from .metadata import AB_metadata
 
 log = getLogger(__name__)
 
 
-class MonteCarloLCA(object):
+class MonteCarloLCA(MonteCarloIterations):
     """A Monte Carlo LCA for multiple reference flows and methods loaded from a calculation setup."""
 
+    # Iterations are calculated in chunks of this size. Every chunk samples
+    # from its own random stream derived from the seed, so the results for a
+    # seed do not depend on the number of processes used.
+    CHUNK_SIZE = 25
+    # Smaller runs are not worth the start-up time of worker processes
+    PARALLEL_MIN_ITERATIONS = 100
+
     def __init__(self, cs_name):
         if cs_name not in bd.calculation_setups:
             raise ValueError("{} is not a known `calculation_setup`.".format(cs_name))
 
         self.cs_name = cs_name
         self.cs = bd.calculation_setups[cs_name]
-        self.seed = None
-        self.cf_rngs = {}
+        super().__init__(self.cs["inv"], self.cs["ia"])
         self.CF_rng_vectors = {}
-        self.include_technosphere = True
-        self.include_biosphere = True
-        self.include_cfs = True
-        self.include_parameters = True
-        self.param_rng = None
-        self.param_cols = ["row", "col", "type"]
-
-        self.tech_rng: Optional[Union[MCRandomNumberGenerator, np.ndarray]] = None
-        self.bio_rng: Optional[Union[MCRandomNumberGenerator, np.ndarray]] = None
-        self.cf_rng: Optional[Union[MCRandomNumberGenerator, np.ndarray]] = None
-
-        # reference flows
-        self.func_units = self.cs["inv"]
-        self.rev_fu_index = {i: fu for i, fu in enumerate(self.func_units)}
+        self.param_rng: Optional[MonteCarloParameterManager] = None
 
         # activities
         self.activity_keys = [list(fu.keys())[0] for fu in self.func_units]
@@ -51,22 +51,41 @@ class MonteCarloLCA(object):
             index: key for index, key in enumerate(self.activity_keys)
         }
 
-        # methods
-        self.methods = self.cs["ia"]
-        self.method_index = {m: i for i, m in enumerate(self.methods)}
-        self.rev_method_index = {i: m for i, m in enumerate(self.methods)}
-
-        # GSA calculation variables
-        self.A_matrices = list()
-        self.B_matrices = list()
-        self.CF_dict = defaultdict(list)
+        # GSA calculation variables, sampled values are stored on disk
+        self.sample_directory: Optional[str] = None
         self.parameter_exchanges = list()
         self.parameters = list()
         self.parameter_data = defaultdict(dict)
 
         self.results = list()
 
-        self.lca = bc.LCA(demand=self.func_units_dict, method=self.methods[0])
+    @property
+    def A_matrices(self) -> list:
+        """The technosphere matrix of every iteration, rebuilt from the
+        sampled values on disk."""
+        if self.tech_samples is None:
+            return []
+        shape = len(self.lca.product_dict), len(self.lca.activity_dict)
+        return self.tech_samples.matrices(shape)
+
+    @property
+    def B_matrices(self) -> list:
+        """The biosphere matrix of every iteration, rebuilt from the sampled
+        values on disk."""
+        if self.bio_samples is None:
+            return []
+        shape = len(self.lca.biosphere_dict), len(self.lca.activity_dict)
+        return self.bio_samples.matrices(shape)
+
+    @property
+    def CF_dict(self) -> dict:
+        """The characterization factors of every iteration per method, read
+        from the sampled values on disk."""
+        return {
+            m: list(samples.columns(slice(None)))
+            for m, samples in self.cf_samples.items()
+            if samples.chunk_paths
+        }
 
     def unify_param_exchanges(self, data: np.ndarray) -> np.ndarray:
         """Convert an array of parameterized exchanges from input/output keys
@@ -97,162 +116,216 @@ class MonteCarloLCA(object):
         return unified
 
     def load_data(self) -> None:
-        """Constructs the random number generators for all of the matrices that
-        can be altered by uncertainty.
-
-        If any of these uncertain calculations are not included, the initial
-        amounts of the 'params' matrices are used in place of generating
-        a vector
-        """
-        self.lca.load_lci_data()
-
-        self.tech_rng = (
-            MCRandomNumberGenerator(self.lca.tech_params, seed=self.seed)
-            if self.include_technosphere
-            else self.lca.tech_params["amount"].copy()
-        )
-        self.bio_rng = (
-            MCRandomNumberGenerator(self.lca.bio_params, seed=self.seed)
-            if self.include_biosphere
-            else self.lca.bio_params["amount"].copy()
-        )
-
-        if self.lca.lcia:
-            self.cf_rngs = (
-                {}
-            )  # we need as many cf_rng as impact categories, because they are of different size
-            for m in self.methods:
-                self.lca.switch_method(m)
-                self.lca.load_lcia_data()
-                self.cf_rngs[m] = (
-                    MCRandomNumberGenerator(self.lca.cf_params, seed=self.seed)
-                    if self.include_cfs
-                    else self.lca.cf_params["amount"].copy()
-                )
         # Construct the MC parameter manager
-        if self.include_parameters:
-            self.param_rng = MonteCarloParameterManager(seed=self.seed)
+        self.param_rng = None
+        super().load_data()
 
-        (
-            self.lca.activity_dict_rev,
-            self.lca.product_dict_rev,
-            self.lca.biosphere_dict_rev,
-        ) = self.lca.reverse_dict()
+    def seed_generators(self, seed: Optional[int]) -> None:
+        super().seed_generators(seed)
+        self.seed_parameters(seed)
 
-    def calculate(self, iterations=10, seed: int = None, **kwargs):
+    def seed_parameters(self, seed: Optional[int]) -> None:
+        """(Re)create the parameter manager drawing from a stream started
+        with the given seed, if parameters are included.
+        """
+        if self.include_parameters:
+            if self.param_rng is None:
+                self.param_rng = MonteCarloParameterManager(seed=seed)
+            else:
+                self.param_rng.reseed(seed)
+
+    def calculate(
+        self,
+        iterations=10,
+        seed: int = None,
+        processes: int = 1,
+        iterative: bool = False,
+        tolerance: float = None,
+        **kwargs,
+    ):
         """Main calculate method for the MC LCA class, allows fine-grained control
         over which uncertainties are included when running MC sampling.
+
+        With `iterative`, the supply of every iteration is solved with an
+        iterative solver preconditioned by the factorization of the static
+        technosphere and warm-started from the previous iteration, up to the
+        given relative `tolerance`.
+
+        With more than one process (and at least `PARALLEL_MIN_ITERATIONS`
+        iterations) the chunks of iterations are divided over worker
+        processes, each with its own LCA object. The results for a given
+        seed are the same in both cases.
         """
         start = time()
         self.iterations = iterations
         self.seed = seed or bc.utils.get_seed()
-        self.include_technosphere = kwargs.get("technosphere", True)
-        self.include_biosphere = kwargs.get("biosphere", True)
-        self.include_cfs = kwargs.get("cf", True)
-        self.include_parameters = kwargs.get("parameters", True)
-
-        self.load_data()
+        self.set_includes(**kwargs)
+        self.set_solver(iterative, tolerance)
 
         self.results = np.zeros((iterations, len(self.func_units), len(self.methods)))
+        self.reset_gsa_data()
+        self.open_sample_stores(self.new_sample_directory())
+
+        chunks = self.chunk_seeds(self.seed, iterations)
+        if (
+            processes > 1
+            and len(chunks) > 1
+            and iterations >= self.PARALLEL_MIN_ITERATIONS
+        ):
+            self._calculate_parallel(chunks, processes)
+        else:
+            self.load_data()
+            self.prepare_parameter_data()
+            offset = 0
+            for size, chunk_seed in chunks:
+                self.seed_generators(chunk_seed)
+                self.run_iterations(self.results[offset : offset + size], offset)
+                offset += size
 
-        # Reset GSA variables to empty.
-        self.A_matrices = list()
-        self.B_matrices = list()
-        self.CF_dict = defaultdict(list)
+        log.info(
+            f"Monte Carlo LCA: finished {iterations} iterations for {len(self.func_units)} reference flows and "
+            f"{len(self.methods)} methods in {np.round(time() - start, 2)} seconds."
+        )
+
+    @classmethod
+    def chunk_seeds(cls, seed: int, iterations: int) -> list:
+        """Split the iterations into chunks of `CHUNK_SIZE`, each with an
+        independent seed derived from the given seed.
+
+        Returns a list of (iterations, seed) tuples.
+        """
+        sizes = [
+            min(cls.CHUNK_SIZE, iterations - i)
+            for i in range(0, iterations, cls.CHUNK_SIZE)
+        ]
+        streams = np.random.SeedSequence(seed).spawn(len(sizes))
+        return [
+            (size, int(stream.generate_state(1)[0]))
+            for size, stream in zip(sizes, streams)
+        ]
+
+    def reset_gsa_data(self) -> None:
+        """Reset GSA variables to empty."""
         self.parameter_exchanges = list()
         self.parameters = list()
 
-        # Prepare GSA parameter schema:
+    def new_sample_directory(self) -> str:
+        """Replace the directory holding the sampled values with a new,
+        empty one that is removed together with this object.
+        """
+        if self.sample_directory:
+            shutil.rmtree(self.sample_directory, ignore_errors=True)
+        self.sample_directory = tempfile.mkdtemp(prefix="ab_montecarlo_")
+        weakref.finalize(self, shutil.rmtree, self.sample_directory, True)
+        return self.sample_directory
+
+    def prepare_parameter_data(self) -> None:
+        """Prepare GSA parameter schema."""
         if self.include_parameters:
             self.parameter_data = self.param_rng.extract_active_parameters(self.lca)
             # Add a values field to handle all the sampled parameter values.
             for k in self.parameter_data:
                 self.parameter_data[k]["values"] = []
 
-        for iteration in range(iterations):
-            tech_vector = (
-                self.tech_rng.next() if self.include_technosphere else self.tech_rng
-            )
-            bio_vector = self.bio_rng.next() if self.include_biosphere else self.bio_rng
-            if self.include_parameters:
-                # Convert the input/output keys into row/col keys, and then match them against
-                # the tech_ and bio_params
-                data = self.param_rng.next()
-                param_exchanges = self.unify_param_exchanges(data)
-
-                # Select technosphere subset from param_exchanges.
-                subset = param_exchanges[np.isin(param_exchanges["type"], [0, 1])]
-                # Create index of where to insert new values from tech_params array.
-                idx = np.argwhere(
-                    np.isin(
-                        self.lca.tech_params[self.param_cols], subset[self.param_cols]
-                    )
-                ).flatten()
-                # Construct unique array of row+col+type combinations
-                uniq = np.unique(self.lca.tech_params[idx][self.param_cols])
-                # Use the unique array to sort the subset (ensures values
-                # are inserted at the correct index)
-                sort_idx = np.searchsorted(uniq, subset[self.param_cols])
-                # Finally, insert the sorted subset amounts into the tech_vector
-                # at the correct indexes.
-                tech_vector[idx] = subset[sort_idx]["amount"]
-                # Repeat the above, but for the biosphere array.
-                subset = param_exchanges[param_exchanges["type"] == 2]
-                idx = np.argwhere(
-                    np.isin(
-                        self.lca.bio_params[self.param_cols], subset[self.param_cols]
-                    )
-                ).flatten()
-                uniq = np.unique(self.lca.bio_params[idx][self.param_cols])
-                sort_idx = np.searchsorted(uniq, subset[self.param_cols])
-                bio_vector[idx] = subset[sort_idx]["amount"]
-
-                # Store parameter data for GSA
-                self.parameter_exchanges.append(param_exchanges)
-                self.parameters.append(self.param_rng.parameters.to_gsa())
-                # Extract sampled values for parameters, store.
-                self.param_rng.retrieve_sampled_values(self.parameter_data)
-
-            self.lca.rebuild_technosphere_matrix(tech_vector)
-            self.lca.rebuild_biosphere_matrix(bio_vector)
-
-            # store matrices for GSA
-            self.A_matrices.append(self.lca.technosphere_matrix)
-            self.B_matrices.append(self.lca.biosphere_matrix)
-
-            if not hasattr(self.lca, "demand_array"):
-                self.lca.build_demand_array()
-            self.lca.lci_calculation()
-
-            # pre-calculating CF vectors enables the use of the SAME CF vector for each FU in a given run
-            cf_vectors = {}
-            for m in self.methods:
-                cf_vectors[m] = (
-                    self.cf_rngs[m].next() if self.include_cfs else self.cf_rngs[m]
-                )
-                # store CFs for GSA (in a list defaultdict)
-                self.CF_dict[m].append(cf_vectors[m])
-
-            # iterate over FUs
-            for row, func_unit in self.rev_fu_index.items():
-                self.lca.redo_lci(func_unit)  # lca calculation
-
-                # iterate over methods
-                for col, m in self.rev_method_index.items():
-                    self.lca.switch_method(m)
-                    self.lca.rebuild_characterization_matrix(cf_vectors[m])
-                    self.lca.lcia_calculation()
-                    self.results[iteration, row, col] = self.lca.score
+    def run_iterations(
+        self, results: np.ndarray, offset: int, overrides: Optional[list] = None
+    ) -> None:
+        if overrides is None and self.include_parameters:
+            overrides = self.parameter_overrides(len(results))
+        super().run_iterations(results, offset, overrides)
 
-        log.info(
-            f"Monte Carlo LCA: finished {iterations} iterations for {len(self.func_units)} reference flows and "
-            f"{len(self.methods)} methods in {np.round(time() - start, 2)} seconds."
-        )
+    def parameter_overrides(self, iterations: int) -> list:
+        """Sample the parameters for the given number of iterations and return
+        the values of the parameterized exchanges that replace the sampled
+        technosphere and biosphere values, see `run_iterations`.
 
-    @property
-    def func_units_dict(self) -> dict:
-        """Return a dictionary of reference flows (key, demand)."""
-        return {key: 1 for func_unit in self.func_units for key in func_unit}
+        The sampled parameters are stored for GSA.
+        """
+        overrides = []
+        # The parameters of all iterations are recalculated at once
+        param_data, param_amounts = self.param_rng.sample(iterations)
+        for iteration in range(iterations):
+            # Convert the input/output keys into row/col keys, and then match them against
+            # the tech_ and bio_params
+            data = param_data[iteration]
+            self.param_rng.parameters.update(param_amounts[:, iteration])
+            param_exchanges = self.unify_param_exchanges(data)
+
+            # Select technosphere subset from param_exchanges.
+            subset = param_exchanges[np.isin(param_exchanges["type"], [0, 1])]
+            # Create index of where to insert new values from tech_params array.
+            tech_idx = np.argwhere(
+                np.isin(self.lca.tech_params[self.param_cols], subset[self.param_cols])
+            ).flatten()
+            # Construct unique array of row+col+type combinations
+            uniq = np.unique(self.lca.tech_params[tech_idx][self.param_cols])
+            # Use the unique array to sort the subset (ensures values
+            # are inserted at the correct index)
+            sort_idx = np.searchsorted(uniq, subset[self.param_cols])
+            # Finally, these sorted subset amounts are inserted into the
+            # tech_vector at the correct indexes.
+            tech_values = subset[sort_idx]["amount"]
+            # Repeat the above, but for the biosphere array.
+            subset = param_exchanges[param_exchanges["type"] == 2]
+            bio_idx = np.argwhere(
+                np.isin(self.lca.bio_params[self.param_cols], subset[self.param_cols])
+            ).flatten()
+            uniq = np.unique(self.lca.bio_params[bio_idx][self.param_cols])
+            sort_idx = np.searchsorted(uniq, subset[self.param_cols])
+            bio_values = subset[sort_idx]["amount"]
+            overrides.append((tech_idx, tech_values, bio_idx, bio_values))
+
+            # Store parameter data for GSA
+            self.parameter_exchanges.append(param_exchanges)
+            self.parameters.append(self.param_rng.parameters.to_gsa())
+            # Extract sampled values for parameters, store.
+            self.param_rng.retrieve_sampled_values(self.parameter_data)
+        return overrides
+
+    def _calculate_parallel(self, chunks: list, processes: int) -> None:
+        """Divide the chunks over worker processes and merge their results
+        in the order of the chunks.
+
+        The workers are started from `activity_browser_workers`, which does
+        not import the Qt application. Parameters are sampled here, the
+        workers are given the values of the parameterized exchanges.
+        """
+        offsets = np.cumsum([0] + [size for size, _ in chunks[:-1]])
+        overrides = [None] * len(chunks)
+        # the matrix indexes are needed for parameters and to rebuild matrices
+        self.lca.load_lci_data()
+        if self.include_parameters:
+            self.param_rng = None
+            self.seed_parameters(self.seed)
+            self.prepare_parameter_data()
+            for i, (size, seed) in enumerate(chunks):
+                self.seed_parameters(seed)
+                overrides[i] = self.parameter_overrides(size)
+        work = [
+            (int(offset), size, seed, chunk_overrides)
+            for offset, (size, seed), chunk_overrides in zip(
+                offsets, chunks, overrides
+            )
+        ]
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=min(processes, len(chunks)),
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(
+                bd.projects.base_dir,
+                bd.projects.current,
+                self.func_units,
+                self.methods,
+                self.includes,
+                (self.iterative_solver, self.solver_tolerance),
+                self.sample_directory,
+            ),
+        ) as pool:
+            for (offset, size, _, _), results in zip(
+                work, pool.map(calculate_chunk, work)
+            ):
+                self.results[offset : offset + size] = results
 
     def get_results_by(self, act_key=None, method=None):
         """Get a slice or all of the results.
@@ -318,10 +391,9 @@ class MonteCarloLCA(object):
     ) -> list:
         fields = fields or ["name", "reference product", "location", "database"]
         # need to do this as the keys come from a pd.Multiindex
-        acts = (bd.get_activity(key).as_dict() for key in (k for k in key_list))
-        translated_keys = [
-            separator.join([act.get(field, "") for field in fields]) for act in acts
-        ]
+        keys = list(key_list)
+        AB_metadata.add_metadata({key[0] for key in keys})
+        translated_keys = AB_metadata.get_labels(keys, fields, separator)
         # if max_length:
         #     translated_keys = [wrap_text(k, max_length=max_length) for k in translated_keys]
         return translated_keys
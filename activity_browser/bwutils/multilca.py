@@ -1,5 +1,6 @@
 from collections import OrderedDict
-from typing import Iterable, Optional, Union
+from collections.abc import Mapping
+from typing import Callable, Iterable, Optional, Union
 from logging import getLogger
 
 import bw2analyzer as ba
@@ -7,6 +8,7 @@ import bw2calc as bc
 import numpy as np
 import pandas as pd
 from PySide2.QtWidgets import QApplication, QMessageBox
+from scipy import sparse
 
 from activity_browser.mod import bw2data as bd
 
@@ -18,6 +20,74 @@ log = getLogger(__name__)
 ca = ba.ContributionAnalysis()
 
 
+class LazyResults(Mapping):
+    """Read-only mapping of results that are calculated when they are first
+    requested.
+
+    At most `maxsize` results are kept in memory, the least recently used
+    result is dropped first and recalculated when it is requested again.
+    """
+
+    def __init__(self, keys: Iterable, calculate: Callable, maxsize: int = 32):
+        self._keys = dict.fromkeys(keys)
+        self._calculate = calculate
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def __getitem__(self, key):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if key not in self._keys:
+            raise KeyError(key)
+        value = self._calculate(key)
+        self._cache[key] = value
+        if len(self._cache) > self._maxsize:
+            self._cache.popitem(last=False)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class LazyContributions(object):
+    """Stand-in for a dense (reference flows, methods, flows) contribution
+    array of which only the requested slices are calculated.
+
+    `by_reference_flow` returns the (methods x flows) slice for a reference
+    flow index and `by_method` the (reference flows x flows) slice for a
+    method index.
+    """
+
+    def __init__(
+        self,
+        shape: tuple,
+        by_reference_flow: Callable[[int], np.ndarray],
+        by_method: Callable[[int], np.ndarray],
+        maxsize: int = 32,
+    ):
+        self.shape = shape
+        calculate = {0: by_reference_flow, 1: by_method}
+        keys = [(0, i) for i in range(shape[0])] + [(1, i) for i in range(shape[1])]
+        self._slices = LazyResults(
+            keys, lambda key: calculate[key[0]](key[1]), maxsize
+        )
+
+    def take(self, index: int, axis: int) -> np.ndarray:
+        if axis not in (0, 1):
+            raise ValueError(f"Contributions can only be taken along axis 0 or 1: {axis}")
+        return self._slices[(axis, index)]
+
+    def __getitem__(self, item: tuple) -> np.ndarray:
+        return self.take(item[0], 0)[item[1:]]
+
+
 class MLCA(object):
     """Wrapper class for performing LCA calculations with many reference flows and impact categories.
 
@@ -101,6 +171,14 @@ class MLCA(object):
     func_key_list: list
         A derivative of `func_key_dict` containing just the keys
 
+    With `lazy_results` set, only the scaling factors and inventories per
+    reference flow are stored. `inventories`, `characterized_inventories` and
+    both contribution arrays are then calculated when they are requested and
+    only the most recently used results are kept (see `RESULT_CACHE_SIZE`).
+    With only `lazy_inventories` set, the contributions are stored and only
+    `inventories` and `characterized_inventories` are left to subclasses to
+    calculate on demand.
+
     Raises
     ------
     ValueError
@@ -108,6 +186,14 @@ class MLCA(object):
 
     """
 
+    # Calculate the detailed results on demand instead of storing all of them
+    lazy_results = True
+    # Without lazy results, store the contributions but calculate the
+    # (characterized) inventories on demand, see `SuperstructureMLCA`
+    lazy_inventories = False
+    # Number of results kept in memory by the lazy results
+    RESULT_CACHE_SIZE = 32
+
     def __init__(self, cs_name: str):
         try:
             cs = bd.calculation_setups[cs_name]
@@ -147,6 +233,7 @@ class MLCA(object):
         for method in self.methods:
             self.lca.switch_method(method)
             self.method_matrices.append(self.lca.characterization_matrix)
+        self.characterization_stack = self._stack_method_matrices()
 
         self.lca_scores = np.zeros((len(self.func_units), len(self.methods)))
 
@@ -167,21 +254,25 @@ class MLCA(object):
         # Inventory multiplied by scaling (relative impact on environment) per impact category.
         self.characterized_inventories = dict()
 
-        # Summarized contributions for EF and processes.
-        self.elementary_flow_contributions = np.zeros(
-            (
-                len(self.func_units),
-                len(self.methods),
-                self.lca.biosphere_matrix.shape[0],
+        # Summarized contributions for EF and processes, these are created
+        # after calculation for lazy results.
+        self.elementary_flow_contributions = None
+        self.process_contributions = None
+        if not self.lazy_results:
+            self.elementary_flow_contributions = np.zeros(
+                (
+                    len(self.func_units),
+                    len(self.methods),
+                    self.lca.biosphere_matrix.shape[0],
+                )
             )
-        )
-        self.process_contributions = np.zeros(
-            (
-                len(self.func_units),
-                len(self.methods),
-                self.lca.technosphere_matrix.shape[0],
+            self.process_contributions = np.zeros(
+                (
+                    len(self.func_units),
+                    len(self.methods),
+                    self.lca.technosphere_matrix.shape[0],
+                )
             )
-        )
 
         self.func_unit_translation_dict = {}
         for fu in self.func_units:
@@ -202,21 +293,94 @@ class MLCA(object):
         }
         self.func_key_list = list(self.func_unit_translation_dict.keys())
 
+    def _stack_method_matrices(self) -> sparse.csr_matrix:
+        """Stack the characterization factors of all methods into a single
+        sparse (methods x biosphere) matrix.
+
+        Characterization matrices are diagonal, so every method becomes one
+        row holding the diagonal of its matrix.
+        """
+        return sparse.csr_matrix(
+            np.vstack([cf.diagonal() for cf in self.method_matrices])
+        )
+
     def _construct_lca(self):
         return bc.LCA(demand=self.func_units_dict, method=self.methods[0])
 
     def _perform_calculations(self):
         """Isolates the code which performs calculations to allow subclasses
         to either alter the code or redo calculations after matrix substitution.
+
+        All reference flows are solved together against a single
+        factorization of the technosphere matrix.
         """
-        for row, func_unit in enumerate(self.func_units):
-            # Do the LCA for the current reference flow
+        demands = self._build_demand_matrix()
+        supply = self._solve_demands(demands)
+        self._store_results(demands, supply)
+
+    def _build_demand_matrix(self) -> np.ndarray:
+        """Return the demand of every reference flow as a column of a dense
+        (products x reference flows) matrix.
+        """
+        demands = np.zeros(
+            (self.lca.technosphere_matrix.shape[0], len(self.func_units))
+        )
+        for col, func_unit in enumerate(self.func_units):
             try:
-                self.lca.redo_lci(func_unit)
+                self.lca.build_demand_array(func_unit)
             except:
                 # bw25 compatibility
                 key = list(func_unit.keys())[0]
-                self.lca.redo_lci({bd.get_activity(key).id: func_unit[key]})
+                self.lca.build_demand_array({bd.get_activity(key).id: func_unit[key]})
+            demands[:, col] = self.lca.demand_array
+        return demands
+
+    def _solve_demands(self, demands: np.ndarray) -> np.ndarray:
+        """Solve the technosphere for all columns of `demands` in a single
+        multi right-hand side call, returning the supply of every activity
+        as a (activities x reference flows) matrix.
+
+        The technosphere matrix is factorized first if this was not yet done.
+        """
+        if not hasattr(self.lca, "solver"):
+            self.lca.decompose_technosphere()
+        try:
+            supply = np.asarray(self.lca.solver(demands))
+        except Exception:
+            supply = None
+        if supply is None or supply.shape != demands.shape:
+            # the solver only accepts a single right-hand side (e.g. umfpack)
+            supply = np.column_stack([self.lca.solver(d) for d in demands.T])
+        return supply
+
+    def _store_results(
+        self, demands: np.ndarray, supply: np.ndarray, scenario: Optional[int] = None
+    ) -> None:
+        """Store the results of all reference flows from the solved supply.
+
+        Inventories and scores are calculated as dense blocks over all
+        reference flows. When a `scenario` is given, it is added to the keys
+        and indexes of the stored results.
+
+        Parameters
+        ----------
+        demands : The (products x reference flows) demand matrix
+        supply : The (activities x reference flows) supply matrix
+        scenario : Index of the scenario these results belong to
+        """
+        biosphere = self.lca.biosphere_matrix
+        tech_diagonal = self.lca.technosphere_matrix.diagonal()
+        # Life cycle inventory (biosphere x reference flows)
+        inventory = biosphere @ supply
+        # Characterized biosphere of all methods (methods x activities)
+        characterized_biosphere = self.characterization_stack @ biosphere
+        scores = characterized_biosphere @ supply
+        # results of a scenario are stored with the scenario index appended
+        scenario_index = () if scenario is None else (scenario,)
+
+        for row, func_unit in enumerate(self.func_units):
+            key = str(func_unit) if scenario is None else (str(func_unit), scenario)
+            supply_array = supply[:, row]
 
             # Now update the:
             # - Scaling factors
@@ -224,34 +388,88 @@ class MLCA(object):
             # - Life cycle inventory
             # - Life-cycle inventory (disaggregated by contributing process)
             # for current reference flow
-            self.scaling_factors.update({str(func_unit): self.lca.supply_array})
+            self.scaling_factors.update({key: supply_array})
             self.technosphere_flows.update(
-                {
-                    str(func_unit): np.multiply(
-                        self.lca.supply_array, self.lca.technosphere_matrix.diagonal()
-                    )
-                }
+                {key: np.multiply(supply_array, tech_diagonal)}
+            )
+            self.inventory.update({key: inventory[:, row]})
+            # Scores and contributions of all methods at once
+            index = (row, slice(None), *scenario_index)
+            self.lca_scores[index] = scores[:, row]
+            if self.lazy_results:
+                continue
+
+            self.elementary_flow_contributions[index] = (
+                self.characterization_stack.multiply(inventory[:, row]).toarray()
             )
-            self.inventory.update(
-                {str(func_unit): np.array(self.lca.inventory.sum(axis=1)).ravel()}
+            self.process_contributions[index] = (
+                characterized_biosphere.multiply(supply_array).toarray()
             )
-            self.inventories.update({str(func_unit): self.lca.inventory})
+            if self.lazy_inventories:
+                continue
 
-            # Now, for each method, take the current reference flow and do inventory analysis
+            lci = biosphere @ sparse.diags(supply_array)
+            self.inventories.update({key: lci})
             for col, cf_matrix in enumerate(self.method_matrices):
-                self.lca.characterization_matrix = cf_matrix
-                self.lca.lcia_calculation()
-                self.lca_scores[row, col] = self.lca.score
-                self.characterized_inventories[row, col] = (
-                    self.lca.characterized_inventory.copy()
-                )
-                self.elementary_flow_contributions[row, col] = np.array(
-                    self.lca.characterized_inventory.sum(axis=1)
-                ).ravel()
-                self.process_contributions[row, col] = (
-                    self.lca.characterized_inventory.sum(axis=0)
+                self.characterized_inventories[(row, col, *scenario_index)] = (
+                    cf_matrix @ lci
                 )
 
+        if self.lazy_results:
+            self._store_lazy_results(supply, inventory, characterized_biosphere)
+
+        # leave the LCA object in the state of the last calculation
+        self.lca.demand_array = demands[:, -1]
+        self.lca.supply_array = supply[:, -1]
+        self.lca.inventory = biosphere @ sparse.diags(supply[:, -1])
+        self.lca.characterization_matrix = self.method_matrices[-1]
+        self.lca.lcia_calculation()
+
+    def _store_lazy_results(
+        self,
+        supply: np.ndarray,
+        inventory: np.ndarray,
+        characterized_biosphere: sparse.csr_matrix,
+    ) -> None:
+        """Replace the detailed results by objects that calculate them on
+        demand from the supply and inventory of all reference flows.
+        """
+        biosphere = self.lca.biosphere_matrix
+        rows = {str(func_unit): row for row, func_unit in enumerate(self.func_units)}
+        size = self.RESULT_CACHE_SIZE
+
+        def lci(key: str) -> sparse.csr_matrix:
+            return biosphere @ sparse.diags(supply[:, rows[key]])
+
+        def characterized_lci(index: tuple) -> sparse.csr_matrix:
+            row, col = index
+            return self.method_matrices[col] @ lci(str(self.func_units[row]))
+
+        self.inventories = LazyResults(rows, lci, size)
+        self.characterized_inventories = LazyResults(
+            [
+                (row, col)
+                for row in range(len(self.func_units))
+                for col in range(len(self.methods))
+            ],
+            characterized_lci,
+            size,
+        )
+        self.elementary_flow_contributions = LazyContributions(
+            (len(self.func_units), len(self.methods), biosphere.shape[0]),
+            lambda row: self.characterization_stack.multiply(
+                inventory[:, row]
+            ).toarray(),
+            lambda col: inventory.T * self.characterization_stack[col].toarray(),
+            size,
+        )
+        self.process_contributions = LazyContributions(
+            (len(self.func_units), len(self.methods), supply.shape[0]),
+            lambda row: characterized_biosphere.multiply(supply[:, row]).toarray(),
+            lambda col: supply.T * characterized_biosphere[col].toarray(),
+            size,
+        )
+
     def calculate(self):
         self._perform_calculations()
 
@@ -479,21 +697,21 @@ class Contributions(object):
         fields = (
             fields if fields else ["name", "reference product", "location", "database"]
         )
-        keys = (
-            k for k in key_list
-        )  # need to do this as the keys come from a pd.Multiindex
+        keys = list(key_list)  # need to do this as the keys come from a pd.Multiindex
+        lookup = [
+            k for k in keys if not (mask and k in mask) and not isinstance(k, str)
+        ]
+        # fields without a value read 'nan', as they did when formatted with str()
+        labels = AB_metadata.get_labels(lookup, fields, separator, missing="nan")
+        labels = dict(zip(lookup, labels))
         translated_keys = []
         for k in keys:
             if mask and k in mask:
                 translated_keys.append(k)
             elif isinstance(k, str):
                 translated_keys.append(k)
-            elif k in AB_metadata.index:
-                translated_keys.append(
-                    separator.join(
-                        [str(l) for l in list(AB_metadata.get_metadata(k, fields))]
-                    )
-                )
+            elif labels[k] is not None:
+                translated_keys.append(labels[k])
             else:
                 translated_keys.append(separator.join([i for i in k if i != ""]))
         if max_length:
@@ -895,4 +1113,4 @@ class Contributions(object):
 
 
 def ids_to_keys(index_list):
-    return [bd.get_activity(i).key if isinstance(i, int) else i for i in index_list]
+    return AB_metadata.ids_to_keys(index_list)
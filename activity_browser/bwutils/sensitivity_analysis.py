@@ -5,17 +5,19 @@
 # Moment-Independent measure based on Monte Carlo simulation LCA results.
 # see: https://salib.readthedocs.io/en/latest/api.html#delta-moment-independent-measure
 # =============================================================================
+import multiprocessing
 import os
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from time import time
 from logging import getLogger
 
 import bw2calc as bc
 import numpy as np
 import pandas as pd
-from SALib.analyze import delta
 
 from activity_browser.mod import bw2data as bd
+from activity_browser_workers.sensitivity import delta_analysis
 
 from ..settings import ab_settings
 from .montecarlo import MonteCarloLCA, perform_MonteCarlo_LCA
@@ -31,10 +33,12 @@ except ImportError:
 log = getLogger(__name__)
 
 
-def get_lca(fu, method):
-    """Calculates a non-stochastic LCA and returns a the LCA object."""
+def get_lca(fu, method, factorize=False):
+    """Calculates a non-stochastic LCA and returns a the LCA object.
+    With `factorize` the technosphere matrix is decomposed, so the LCA object
+    can be reused for graph traversal."""
     lca = bc.LCA(fu, method=method)
-    lca.lci()
+    lca.lci(factorize=factorize)
     lca.lcia()
     log.info(f"Non-stochastic LCA score: {lca.score}")
 
@@ -46,11 +50,25 @@ def get_lca(fu, method):
     return lca
 
 
-def filter_technosphere_exchanges(fu, method, cutoff=0.05, max_calc=1e4):
+class PreparedGraphTraversal(GraphTraversal):
+    """GraphTraversal that reuses an LCA object with a decomposed technosphere
+    matrix, instead of building a new one. The LCA has to be calculated
+    for the demand and method that are traversed."""
+
+    def __init__(self, lca):
+        self.lca = lca
+
+    def build_lca(self, demand, method):
+        return self.lca, self.lca.supply_array, self.lca.score
+
+
+def filter_technosphere_exchanges(fu, method, cutoff=0.05, max_calc=1e4, lca=None):
     """Use brightway's GraphTraversal to identify the relevant
-    technosphere exchanges in a non-stochastic LCA."""
+    technosphere exchanges in a non-stochastic LCA. A given (factorized) `lca`
+    is reused by the traversal, see `PreparedGraphTraversal`."""
     start = time()
-    res = GraphTraversal().calculate(fu, method, cutoff=cutoff, max_calc=max_calc)
+    traversal = GraphTraversal() if lca is None else PreparedGraphTraversal(lca)
+    res = traversal.calculate(fu, method, cutoff=cutoff, max_calc=max_calc)
 
     # get all edges
     technosphere_exchange_indices = []
@@ -90,9 +108,22 @@ def filter_biosphere_exchanges(lca, cutoff=0.005):
     return biosphere_exchange_indices
 
 
-def get_exchanges(lca, indices, biosphere=False, only_uncertain=True):
+def get_activity(key, activities=None):
+    """Return the activity of the key, from the `activities` cache if given."""
+    if activities is None:
+        return bd.get_activity(key)
+    if key not in activities:
+        activities[key] = bd.get_activity(key)
+    return activities[key]
+
+
+def get_exchanges(
+    lca, indices, biosphere=False, only_uncertain=True, cache=None, activities=None
+):
     """Get actual exchange objects from indices.
     By default get only exchanges that have uncertainties.
+    The exchanges of an index are kept in the `cache` dictionary if given,
+    activities in the `activities` dictionary.
 
     Returns
     -------
@@ -103,16 +134,23 @@ def get_exchanges(lca, indices, biosphere=False, only_uncertain=True):
     """
     exchanges = list()
     for i in indices:
+        if cache is not None and (biosphere, i) in cache:
+            exchanges.extend(cache[(biosphere, i)])
+            continue
         if biosphere:
-            from_act = bd.get_activity(lca.biosphere_dict_rev[i[0]])
+            from_act = get_activity(lca.biosphere_dict_rev[i[0]], activities)
         else:  # technosphere
-            from_act = bd.get_activity(lca.activity_dict_rev[i[0]])
-        to_act = bd.get_activity(lca.activity_dict_rev[i[1]])
+            from_act = get_activity(lca.activity_dict_rev[i[0]], activities)
+        to_act = get_activity(lca.activity_dict_rev[i[1]], activities)
 
+        found = list()
         for exc in to_act.exchanges():
             if exc.input == from_act.key:
-                exchanges.append(exc)
+                found.append(exc)
                 # continue  # if there was always only one max exchange between two activities
+        if cache is not None:
+            cache[(biosphere, i)] = found
+        exchanges.extend(found)
 
     # in theory there should be as many exchanges as indices, but since
     # multiple exchanges are possible between two activities, the number of
@@ -148,13 +186,18 @@ def drop_no_uncertainty_exchanges(excs, indices):
     return excs_no, indices_no
 
 
-def get_exchanges_dataframe(exchanges, indices, biosphere=False):
-    """Returns a Dataframe from the exchange data and a bit of additional information."""
+def get_exchanges_dataframe(exchanges, indices, biosphere=False, activities=None):
+    """Returns a Dataframe from the exchange data and a bit of additional information.
+    The exchanges are copied, as they can be shared between reference flows and
+    impact categories, see `get_exchanges`."""
 
+    rows = list()
     for exc, i in zip(exchanges, indices):
-        from_act = bd.get_activity(exc.get("input"))
-        to_act = bd.get_activity(exc.get("output"))
+        from_act = get_activity(exc.get("input"), activities)
+        to_act = get_activity(exc.get("output"), activities)
 
+        exc = dict(exc)
+        rows.append(exc)
         exc.update(
             {
                 "index": i,
@@ -191,10 +234,10 @@ def get_exchanges_dataframe(exchanges, indices, biosphere=False):
                 }
             )
 
-    return pd.DataFrame(exchanges)
+    return pd.DataFrame(rows)
 
 
-def get_CF_dataframe(lca, only_uncertain_CFs=True):
+def get_CF_dataframe(lca, only_uncertain_CFs=True, activities=None):
     """Returns a dataframe with the metadata for the characterization factors
     (in the biosphere matrix). Filters non-stochastic CFs if desired (default)."""
     data = dict()
@@ -202,7 +245,7 @@ def get_CF_dataframe(lca, only_uncertain_CFs=True):
         if only_uncertain_CFs and row["uncertainty_type"] <= 1:
             continue
         cf_index = row["row"]
-        bio_act = bd.get_activity(lca.biosphere_dict_rev[cf_index])
+        bio_act = get_activity(lca.biosphere_dict_rev[cf_index], activities)
 
         data.update({params_index: bio_act.as_dict()})
 
@@ -237,33 +280,20 @@ def get_parameters_DF(mc):
         return pd.DataFrame()  # return emtpy df
 
 
-def get_exchange_values(matrix, indices):
-    """Get technosphere exchanges values from a list of exchanges
-    (row and column information)"""
-    return [matrix[i] for i in indices]
-
-
-def get_X(matrix_list, indices):
+def get_X(samples, indices):
     """Get the input data to the GSA, i.e. A and B matrix values for each
-    model run."""
-    X = np.zeros((len(matrix_list), len(indices)))
-    for row, M in enumerate(matrix_list):
-        X[row, :] = get_exchange_values(M, indices)
-    return X
+    model run, read from the sampled values stored by the Monte Carlo LCA."""
+    return samples.cells(indices)
 
 
 def get_X_CF(mc, dfcf, method):
     """Get the characterization factors used for each model run. Only those CFs
     that are in the dfcf dataframe will be returned (i.e. by default only the
     CFs that have uncertainties."""
-    # get all CF inputs
-    CF_data = np.array(mc.CF_dict[method])  # has the same shape as the Xa and Xb below
-
-    # reduce this to uncertain CFs only (if this was done for the dfcf)
-    params_indices = dfcf.index.values
-
-    # if params_indices:
-    return CF_data[:, params_indices]
+    # reduce the CF inputs to uncertain CFs only (if this was done for the dfcf),
+    # this has the same shape as the Xa and Xb below
+    params_indices = dfcf.index.values.astype(int)
+    return mc.cf_samples[method].columns(params_indices)
 
 
 def get_X_P(dfp):
@@ -287,18 +317,38 @@ class GlobalSensitivityAnalysis(object):
     Builds on top of Monte Carlo Simulation results.
     """
 
+    # Attributes that make up the GSA of one reference flow and impact category
+    RESULT_ATTRIBUTES = (
+        "act_number",
+        "method_number",
+        "fu",
+        "activity",
+        "method",
+        "metadata",
+        "X",
+        "Y",
+        "names",
+        "problem",
+        "Si",
+        "dfgsa",
+        "df_final",
+    )
+
     def __init__(self, mc):
         self.update_mc(mc)
         self.act_number = int()
         self.method_number = int()
         self.cutoff_technosphere = float()
         self.cutoff_biosphere = float()
+        # GSA of every (reference flow, impact category), see `perform_GSA_batch`
+        self.results = dict()
 
     def update_mc(self, mc):
         "Update the Monte Carlo Simulation object (and results)."
         try:
             assert isinstance(mc, MonteCarloLCA)
             self.mc = mc
+            self.results = dict()
         except AssertionError:
             raise AssertionError(
                 "mc should be an instance of MonteCarloLCA, but instead it is a {}.".format(
@@ -317,6 +367,112 @@ class GlobalSensitivityAnalysis(object):
         start = time()
 
         # set FU and method
+        if not self.set_reference(
+            act_number, method_number, cutoff_technosphere, cutoff_biosphere
+        ):
+            return None
+
+        # get non-stochastic LCA object with reverse dictionaries
+        self.lca = get_lca(self.fu, self.method)
+
+        self.prepare_inputs()
+
+        # perform delta analysis
+        time_delta = time()
+        self.Si = delta_analysis(self.problem, self.X, self.Y)
+        log.info(
+            "Delta analysis took {} seconds".format(
+                np.round(time() - time_delta, 2),
+            )
+        )
+
+        self.build_results()
+
+        log.info("GSA took {} seconds".format(np.round(time() - start, 2)))
+
+    def perform_GSA_batch(
+        self,
+        cutoff_technosphere=0.01,
+        cutoff_biosphere=0.01,
+        processes=1,
+    ):
+        """Perform GSA for every reference flow and impact category of the
+        Monte Carlo Simulation.
+
+        The non-stochastic LCA of a reference flow is factorized once and reused
+        by the graph traversals of all impact categories, activities and exchanges
+        are only looked up once. With more than one process the delta analyses are
+        performed in worker processes, started from `activity_browser_workers`
+        which does not import the Qt application.
+
+        The results are stored in `results`, use `select` to make one of them
+        the current GSA.
+        """
+        start = time()
+        self.results = dict()
+        cache, activities = dict(), dict()
+        error = None
+        for act_number in range(len(self.mc.cs["inv"])):
+            lca = None
+            for method_number in range(len(self.mc.cs["ia"])):
+                if not self.set_reference(
+                    act_number, method_number, cutoff_technosphere, cutoff_biosphere
+                ):
+                    return None
+                if lca is None:
+                    lca = get_lca(self.fu, self.method, factorize=True)
+                else:
+                    lca.switch_method(self.method)
+                    lca.lcia_calculation()
+                self.lca = lca
+                try:
+                    self.prepare_inputs(
+                        traversal_lca=lca, cache=cache, activities=activities
+                    )
+                except Exception as e:
+                    log.warning(
+                        f"GSA failed for reference flow {act_number} and impact "
+                        f"category {method_number}: {e}"
+                    )
+                    error = e
+                    continue
+                self.Si = self.dfgsa = self.df_final = None
+                self.results[(act_number, method_number)] = self.result()
+        if not self.results:
+            if error is not None:
+                raise error
+            return None
+
+        # perform delta analyses
+        time_delta = time()
+        tasks = [(r["problem"], r["X"], r["Y"]) for r in self.results.values()]
+        if processes > 1 and len(tasks) > 1:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(
+                max_workers=min(processes, len(tasks)), mp_context=context
+            ) as pool:
+                analyses = list(pool.map(delta_analysis, *zip(*tasks)))
+        else:
+            analyses = [delta_analysis(*task) for task in tasks]
+        log.info(
+            "{} delta analyses took {} seconds".format(
+                len(tasks), np.round(time() - time_delta, 2)
+            )
+        )
+
+        for key, Si in zip(list(self.results), analyses):
+            self.select(*key)
+            self.Si = Si
+            self.build_results()
+            self.results[key] = self.result()
+
+        log.info("Batch GSA took {} seconds".format(np.round(time() - start, 2)))
+
+    def set_reference(
+        self, act_number, method_number, cutoff_technosphere, cutoff_biosphere
+    ):
+        """Set the reference flow and impact category to analyse, returns
+        False if that failed."""
         try:
             self.act_number = act_number
             self.method_number = method_number
@@ -331,16 +487,22 @@ class GlobalSensitivityAnalysis(object):
             traceback.print_exc()
             # todo: QMessageBox.warning(self, 'Could not perform Delta analysis', str(e))
             log.error("Initializing the GSA failed.")
-            return None
+            return False
 
         log.info(
             f"-- GSA --\n Project: {bd.projects.current} CS: {self.mc.cs_name} "
             f"Activity: {self.activity} Method: {self.method}",
         )
+        return True
 
-        # get non-stochastic LCA object with reverse dictionaries
-        self.lca = get_lca(self.fu, self.method)
+    def prepare_inputs(self, traversal_lca=None, cache=None, activities=None):
+        """Filter the exchanges of the non-stochastic LCA and build the input
+        (X) and output (Y) of the delta analysis.
 
+        A factorized `traversal_lca` is reused by the graph traversal, the
+        `cache` and `activities` dictionaries keep exchanges and activities
+        between calls, see `perform_GSA_batch`.
+        """
         # =============================================================================
         #   Filter exchanges and get metadata DataFrames
         # =============================================================================
@@ -348,23 +510,35 @@ class GlobalSensitivityAnalysis(object):
         # technosphere
         if self.mc.include_technosphere:
             self.t_indices = filter_technosphere_exchanges(
-                self.fu, self.method, cutoff=cutoff_technosphere, max_calc=1e4
+                self.fu,
+                self.method,
+                cutoff=self.cutoff_technosphere,
+                max_calc=1e4,
+                lca=traversal_lca,
+            )
+            self.t_exchanges, self.t_indices = get_exchanges(
+                self.lca, self.t_indices, cache=cache, activities=activities
+            )
+            self.dft = get_exchanges_dataframe(
+                self.t_exchanges, self.t_indices, activities=activities
             )
-            self.t_exchanges, self.t_indices = get_exchanges(self.lca, self.t_indices)
-            self.dft = get_exchanges_dataframe(self.t_exchanges, self.t_indices)
             if not self.dft.empty:
                 dfs.append(self.dft)
 
         # biosphere
         if self.mc.include_biosphere:
             self.b_indices = filter_biosphere_exchanges(
-                self.lca, cutoff=cutoff_biosphere
+                self.lca, cutoff=self.cutoff_biosphere
             )
             self.b_exchanges, self.b_indices = get_exchanges(
-                self.lca, self.b_indices, biosphere=True
+                self.lca,
+                self.b_indices,
+                biosphere=True,
+                cache=cache,
+                activities=activities,
             )
             self.dfb = get_exchanges_dataframe(
-                self.b_exchanges, self.b_indices, biosphere=True
+                self.b_exchanges, self.b_indices, biosphere=True, activities=activities
             )
             if not self.dfb.empty:
                 dfs.append(self.dfb)
@@ -372,11 +546,10 @@ class GlobalSensitivityAnalysis(object):
         # characterization factors
         if self.mc.include_cfs:
             self.dfcf = get_CF_dataframe(
-                self.lca, only_uncertain_CFs=True
+                self.lca, only_uncertain_CFs=True, activities=activities
             )  # None if no stochastic CFs
             if not self.dfcf.empty:
                 dfs.append(self.dfcf)
-
         # parameters
         # todo: if parameters, include df, but remove exchanges from T and B (skipped for now)
         self.dfp = get_parameters_DF(self.mc)  # Empty df if no parameters
@@ -394,10 +567,10 @@ class GlobalSensitivityAnalysis(object):
         # Get X (Technosphere, Biosphere and CF values)
         X_list = list()
         if self.mc.include_technosphere and self.t_indices:
-            self.Xa = get_X(self.mc.A_matrices, self.t_indices)
+            self.Xa = get_X(self.mc.tech_samples, self.t_indices)
             X_list.append(self.Xa)
         if self.mc.include_biosphere and self.b_indices:
-            self.Xb = get_X(self.mc.B_matrices, self.b_indices)
+            self.Xb = get_X(self.mc.bio_samples, self.b_indices)
             X_list.append(self.Xb)
         if self.mc.include_cfs and not self.dfcf.empty:
             self.Xc = get_X_CF(self.mc, self.dfcf, self.method)
@@ -437,15 +610,8 @@ class GlobalSensitivityAnalysis(object):
         # print('Names:', len(self.names))
         self.problem = get_problem(self.X, self.names)
 
-        # perform delta analysis
-        time_delta = time()
-        self.Si = delta.analyze(self.problem, self.X, self.Y, print_to_console=False)
-        log.info(
-            "Delta analysis took {} seconds".format(
-                np.round(time() - time_delta, 2),
-            )
-        )
-
+    def build_results(self):
+        """Put the results of the delta analysis into dataframes."""
         # put GSA results in to dataframe
         self.dfgsa = pd.DataFrame(self.Si, index=self.names).sort_values(
             by="delta", ascending=False
@@ -457,7 +623,19 @@ class GlobalSensitivityAnalysis(object):
         self.df_final.reset_index(inplace=True)
         self.df_final["pedigree"] = [str(x) for x in self.df_final["pedigree"]]
 
-        log.info("GSA took {} seconds".format(np.round(time() - start, 2)))
+    def result(self):
+        """Return the GSA of the current reference flow and impact category."""
+        return {name: getattr(self, name) for name in self.RESULT_ATTRIBUTES}
+
+    def select(self, act_number, method_number):
+        """Make the GSA of the given reference flow and impact category of the
+        last batch the current one, returns False if there is none."""
+        result = self.results.get((act_number, method_number))
+        if result is None:
+            return False
+        for name, value in result.items():
+            setattr(self, name, value)
+        return True
 
     def get_save_name(self):
         save_name = (
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-from .dataframe import (scenario_names_from_df, scenario_replace_databases,
-                        superstructure_from_arrays)
+from .cache import (file_digest, load_validated_scenarios,
+                    store_validated_scenarios)
+from .dataframe import (ScenarioProduct, scenario_names_from_df,
+                        scenario_replace_databases, superstructure_from_arrays)
 from .excel import get_sheet_names, import_from_excel
 from .file_dialogs import ABPopup
 from .file_imports import ABCSVImporter, ABFeatherImporter, ABFileImporter
@@ -1,9 +1,14 @@
+from typing import Iterable
+
 import numpy as np
 import pandas as pd
 
 from activity_browser.mod import bw2data as bd
 from activity_browser.mod.bw2data.backends import ActivityDataset
 
+from ..metadata import AB_metadata
+from ..utils import QUERY_SIZE
+
 FROM_ACT = pd.Index(
     ["from activity name", "from reference product", "from location", "from database"]
 )
@@ -15,8 +20,6 @@ TO_ACT = pd.Index(
         "to database",
     ]
 )
-FROM_BIOS = pd.Index(["from activity name", "from categories", "from database"])
-TO_BIOS = pd.Index(["to activity name", "to categories", "to database"])
 FROM_ALL = pd.Index(
     [
         "from activity name",
@@ -38,21 +41,10 @@ TO_ALL = pd.Index(
     ]
 )
 
-
-def process_ad_namedtuple(row) -> tuple:
-    """Take a given ActivityDataset namedtuple and return two hashable tuples.
-
-    Allows for matching on name/product/location
-    """
-    match = (row.name, row.product, row.location)
-    key = (row.database, row.code)
-    return match, key
-
-
-def process_ad_flow(row) -> tuple:
-    match = (row.name, row.data.get("categories", None))
-    key = (row.database, row.code)
-    return match, key
+# Metadata fields on which activities and biosphere flows are matched, in
+# the order of the FROM_ALL / TO_ALL columns
+ACTIVITY_FIELDS = ["name", "reference product", "location"]
+FLOW_FIELDS = ["name", "categories"]
 
 
 def construct_ad_data(row) -> tuple:
@@ -98,78 +90,93 @@ def data_from_index(index: tuple) -> dict:
     }
 
 
-def get_relevant_activities(df: pd.DataFrame, part: str = "from") -> dict:
-    """Build a dictionary of (name, product, location) -> (database, key) pairs."""
-    select = FROM_ACT if part == "from" else TO_ACT
-    sub = df.loc[:, select]
-    sub = sub[sub.iloc[:, 3] != bd.config.biosphere]  # Exclude biosphere exchanges
-    if sub.empty:
-        return {}
-
-    names, products, locations, dbs = list(map(set, sub.iloc[:, 0:4].values.T))
-    #    names, products, locations, dbs = sub.iloc[:, 0:4].apply(set, axis=0)
-    query = (
-        ActivityDataset.select(
-            ActivityDataset.name,
-            ActivityDataset.product,
-            ActivityDataset.location,
-            ActivityDataset.database,
-            ActivityDataset.code,
-        )
-        .where(
-            (ActivityDataset.name.in_(names))
-            & (ActivityDataset.product.in_(products))
-            & (ActivityDataset.location.in_(locations))
-            & (ActivityDataset.database.in_(dbs))
-        )
-        .namedtuples()
-    )
-    activities = dict(map(process_ad_namedtuple, query.iterator()))
-    return activities
-
-
-def get_relevant_flows(df: pd.DataFrame, part: str = "from") -> dict:
-    """Determines if all activities from the given 'from' or 'to' chunk"""
-    select = FROM_BIOS if part == "from" else TO_BIOS
-    sub = df.loc[:, select]
-    sub = sub[sub.iloc[:, 2] == bd.config.biosphere]  # Use only biosphere exchanges
-    if sub.empty:
-        return {}
-
-    names, categories, dbs = list(map(set, sub.iloc[:, 0:3].values.T))
-    #    names, categories, dbs = sub.iloc[:, 0:3].apply(set, axis=0)
-    query = (
-        ActivityDataset.select(
-            ActivityDataset.name,
-            ActivityDataset.data,
-            ActivityDataset.database,
-            ActivityDataset.code,
-        )
-        .where((ActivityDataset.name.in_(names)) & (ActivityDataset.database.in_(dbs)))
-        .namedtuples()
+def activity_data_from_keys(keys: set) -> dict:
+    """Read the activities of all given keys with a single query per
+    database, returning the SUPERSTRUCTURE data of every key, see
+    `construct_ad_data`.
+    """
+    codes = {}
+    for db_name, code in keys:
+        codes.setdefault(db_name, []).append(code)
+    data = {}
+    for db_name, db_codes in codes.items():
+        for i in range(0, len(db_codes), QUERY_SIZE):
+            query = ActivityDataset.select().where(
+                ActivityDataset.database == db_name,
+                ActivityDataset.code << db_codes[i : i + QUERY_SIZE],
+            )
+            data.update(construct_ad_data(row) for row in query)
+    for key in set(keys).difference(data):
+        # Raises the same DoesNotExist error as `data_from_index`
+        ActivityDataset.get(database=key[0], code=key[1])
+    return data
+
+
+def data_from_indices(indices: Iterable[tuple]) -> pd.DataFrame:
+    """Build the SUPERSTRUCTURE rows of all given 'Index' tuples at once,
+    see `data_from_index`.
+    """
+    indices = list(indices)
+    from_keys = [tuple(index[0]) for index in indices]
+    to_keys = [tuple(index[1]) for index in indices]
+    data = activity_data_from_keys(set(from_keys).union(to_keys))
+    df = pd.concat(
+        [
+            pd.DataFrame([data[key] for key in from_keys], columns=FROM_ALL[:-1]),
+            pd.DataFrame([data[key] for key in to_keys], columns=TO_ALL[:-1]),
+        ],
+        axis=1,
     )
-    flows = dict(map(process_ad_flow, query.iterator()))
-    return flows
+    df["from key"] = pd.Series(from_keys, dtype=object)
+    df["to key"] = pd.Series(to_keys, dtype=object)
+    df["flow type"] = [index[2] if len(index) > 2 else np.NaN for index in indices]
+    return df
 
 
-def match_fields_for_key(df: pd.DataFrame, matchbook: dict) -> pd.Series:
-    def build_match(row):
-        if row.iat[4] == bd.config.biosphere:
-            match = (row.iat[0], row.iat[3])
-        else:
-            match = (row.iat[0], row.iat[1], row.iat[2])
-        return matchbook.get(match, np.NaN)
+def field_index(databases: set, fields: list) -> pd.Series:
+    """Build an index of the given metadata fields to the key of every
+    activity in the databases, from the metadata store.
 
-    return df.apply(build_match, axis=1)
+    When several activities share the same fields, the last one is used.
+    """
+    frames = [AB_metadata.get_database_metadata(db) for db in databases]
+    frames = [f for f in frames if not f.empty and set(fields).issubset(f.columns)]
+    if not frames:
+        return pd.Series([], index=pd.MultiIndex.from_tuples([], names=fields), dtype=object)
+    data = pd.concat([f.loc[:, fields + ["key"]] for f in frames]).astype(object)
+    data = data.drop_duplicates(fields, keep="last")
+    return pd.Series(data["key"].to_numpy(), index=pd.MultiIndex.from_frame(data[fields]))
+
+
+def match_fields_for_key(df: pd.DataFrame) -> pd.Series:
+    """Find the keys for a FROM_ALL or TO_ALL part of the superstructure.
+
+    Biosphere flows are matched on name and categories, all other
+    activities on name, reference product and location. Candidates are the
+    activities of all databases of the matched rows, rows without a match
+    get a NaN key.
+    """
+    biosphere = (df.iloc[:, 4] == bd.config.biosphere).to_numpy()
+    keys = np.full(len(df), np.nan, dtype=object)
+    for mask, columns, fields in [
+        (biosphere, [0, 3], FLOW_FIELDS),
+        (~biosphere, [0, 1, 2], ACTIVITY_FIELDS),
+    ]:
+        if not mask.any():
+            continue
+        sub = df.iloc[np.flatnonzero(mask)]
+        index = field_index(set(sub.iloc[:, 4]), fields)
+        positions = index.index.get_indexer(
+            pd.MultiIndex.from_frame(sub.iloc[:, columns].astype(object))
+        )
+        found = positions >= 0
+        keys[np.flatnonzero(mask)[found]] = index.to_numpy()[positions[found]]
+    return pd.Series(keys, index=df.index, dtype=object)
 
 
 def fill_df_keys_with_fields(df: pd.DataFrame) -> pd.DataFrame:
-    matches = get_relevant_flows(df, "from")
-    matches.update(get_relevant_activities(df, "from"))
-    df["from key"] = match_fields_for_key(df.loc[:, FROM_ALL], matches)
-    matches = get_relevant_flows(df, "to")
-    matches.update(get_relevant_activities(df, "to"))
-    df["to key"] = match_fields_for_key(df.loc[:, TO_ALL], matches)
+    df["from key"] = match_fields_for_key(df.loc[:, FROM_ALL])
+    df["to key"] = match_fields_for_key(df.loc[:, TO_ALL])
     return df
 
 
@@ -177,7 +184,7 @@ def get_activities_from_keys(
     df: pd.DataFrame, db: str = bd.config.biosphere
 ) -> pd.DataFrame:
     """
-    Uses the BW SQL database to generate a list of Activities from the input dataframe.
+    Uses the metadata of the database to find the Activities from the input dataframe.
     Returns a pandas dataframe that contains any keys that do not identify to an Activity in BW.
 
     parameters
@@ -188,38 +195,14 @@ def get_activities_from_keys(
     """
     data_f = df.loc[(df["from database"] == db)]
     data_t = df.loc[(df["to database"] == db)]
-    flows = set()
-    if not data_f.empty:
-        f_db, f_keys = zip(
-            *data_f.loc[:, "from key"]
-        )  # extract just the key, avoiding the database
-        fqry = (
-            ActivityDataset.select(ActivityDataset.code, ActivityDataset.database)
-            .where(
-                (ActivityDataset.database == db)
-                & (ActivityDataset.code.in_(set(f_keys)))
-            )
-            .namedtuples()
-        )  # produces an iterator for the activities
-        flows.update(set(map(lambda row: (row.database, row.code), fqry.iterator())))
-    if not data_t.empty:
-        t_db, t_keys = zip(*data_t.loc[:, "to key"])  # look at the above code block
-        tqry = (
-            ActivityDataset.select(ActivityDataset.code, ActivityDataset.database)
-            .where(
-                (ActivityDataset.database == db)
-                & (ActivityDataset.code.in_(set(t_keys)))
-            )
-            .namedtuples()
-        )
-
-        flows.update(set(map(lambda row: (row.database, row.code), tqry.iterator())))
+    if data_f.empty and data_t.empty:
+        return df.iloc[0:0]
+    # keys of all activities in the database
+    flows = set(AB_metadata.get_database_metadata(db).get("key", []))
     absent = pd.concat(
         [
-            data_f.loc[
-                ~(data_f["from key"].isin(flows)) & (data_f["from database"] == db)
-            ],
-            data_t.loc[~(data_t["to key"].isin(flows)) & (data_t["to database"] == db)],
+            data_f.loc[~(data_f["from key"].isin(flows))],
+            data_t.loc[~(data_t["to key"].isin(flows))],
         ],
         ignore_index=False,
         axis=0,
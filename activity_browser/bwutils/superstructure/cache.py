@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+from logging import getLogger
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+
+from activity_browser.mod import bw2data as bd
+
+from ...settings import ab_settings
+from .. import commontasks as bc
+
+log = getLogger(__name__)
+
+"""
+Cache of scenario files.
+
+Scenario files are stored as dataframes in the AB data directory, under a
+hash of the contents of the file and the options they are read with. A
+file that has been read is not parsed again. Once a scenario (flow
+exchange) file has also been checked and indexed, reopening it skips
+reading and validating it, for as long as the databases it refers to are
+unchanged.
+
+The contents of a file are only hashed again when its size or modification
+time changed. The least recently used entries are removed once the cache
+grows beyond CACHE_SIZE bytes.
+"""
+
+CACHE_VERSION = 1
+CACHE_DIRECTORY = "scenario_cache"
+# Maximum number of bytes of all cached scenario files together
+CACHE_SIZE = 2 * 2**30
+# Number of bytes of a scenario file that are hashed at once
+BLOCK_SIZE = 2**20
+# Number of (path, size, modification time) digests that are remembered
+DIGEST_INDEX_SIZE = 1000
+
+
+def _cache_directory() -> str:
+    return os.path.join(ab_settings.data_dir, CACHE_DIRECTORY)
+
+
+def _cache_path(digest: str) -> str:
+    return os.path.join(_cache_directory(), f"{digest}.pickle")
+
+
+def _index_path() -> str:
+    return os.path.join(_cache_directory(), "digests.index")
+
+
+def _read_index() -> OrderedDict:
+    try:
+        with open(_index_path(), "rb") as infile:
+            return pickle.load(infile)
+    except Exception:
+        return OrderedDict()
+
+
+def _write_index(index: OrderedDict) -> None:
+    while len(index) > DIGEST_INDEX_SIZE:
+        index.popitem(last=False)
+    path = _index_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as outfile:
+            pickle.dump(index, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        log.debug(f"Could not write scenario digest index: {e}")
+
+
+def content_digest(path: Union[str, Path]) -> str:
+    """Return a hash of the contents of a file.
+
+    The hash is remembered with the size and modification time of the file,
+    it is only calculated again when one of them changed.
+    """
+    stat = os.stat(path)
+    source = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    index = _read_index()
+    if source in index:
+        return index[source]
+    digest = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    index[source] = digest.hexdigest()
+    _write_index(index)
+    return index[source]
+
+
+def file_digest(path: Union[str, Path], *options) -> str:
+    """Return a hash of the contents of a scenario file and the options it
+    is read with.
+    """
+    digest = hashlib.sha1(content_digest(path).encode())
+    for option in options:
+        digest.update(repr(option).encode())
+    return digest.hexdigest()
+
+
+def _cache_signature(databases: set) -> Optional[tuple]:
+    """Return the values a cached dataframe has to match to still be valid,
+    the project and the modification time and record count of every
+    database it refers to.
+    """
+    signature = []
+    for db_name in sorted(databases):
+        if db_name not in bd.databases:
+            return None
+        modified = bd.databases[db_name].get("modified")
+        if not modified:
+            return None
+        signature.append(
+            (db_name, str(modified), bc.count_database_records(db_name))
+        )
+    return CACHE_VERSION, bd.projects.current, tuple(signature)
+
+
+def _load(digest: str) -> Optional[dict]:
+    path = _cache_path(digest)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "rb") as infile:
+            cached = pickle.load(infile)
+        # mark the entry as recently used
+        os.utime(path)
+    except Exception as e:
+        log.debug(f"Could not read scenario cache {digest}: {e}")
+        return None
+    return cached
+
+
+def _store(digest: str, cached: dict) -> None:
+    path = _cache_path(digest)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so an interrupted write never leaves a broken cache
+        with open(f"{path}.tmp", "wb") as outfile:
+            pickle.dump(cached, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        log.warning(f"Could not write scenario cache {digest}: {e}")
+        return
+    evict_scenario_cache()
+
+
+def evict_scenario_cache(size: int = CACHE_SIZE) -> None:
+    """Remove the least recently used entries until the cache takes at most
+    `size` bytes.
+    """
+    try:
+        with os.scandir(_cache_directory()) as entries:
+            files = [
+                (entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+                for entry in entries
+                if entry.name.endswith(".pickle")
+            ]
+    except OSError:
+        return
+    total = sum(file_size for _, file_size, _ in files)
+    for _, file_size, path in sorted(files):
+        if total <= size:
+            break
+        try:
+            os.remove(path)
+            total -= file_size
+        except OSError as e:
+            log.debug(f"Could not remove scenario cache {path}: {e}")
+
+
+def load_validated_scenarios(digest: str) -> Optional[pd.DataFrame]:
+    """Return the validated dataframe of a scenario file, or None if there is
+    no valid cache.
+    """
+    cached = _load(digest)
+    if cached is None:
+        return None
+    if cached.get("signature") != _cache_signature(cached.get("databases", set())):
+        log.debug(f"Scenario cache {digest} is outdated")
+        return None
+    return cached["dataframe"]
+
+
+def store_validated_scenarios(digest: str, df: pd.DataFrame) -> None:
+    """Store the validated dataframe of a scenario file in the AB data
+    directory.
+    """
+    databases = set(df.loc[:, "from database"]).union(df.loc[:, "to database"])
+    signature = _cache_signature(databases)
+    if signature is None:
+        return
+    _store(
+        digest, {"signature": signature, "databases": databases, "dataframe": df}
+    )
+
+
+def load_read_scenarios(digest: str) -> Optional[pd.DataFrame]:
+    """Return the dataframe a scenario file was read into, or None if it is
+    not cached.
+    """
+    cached = _load(digest)
+    if cached is None or cached.get("version") != CACHE_VERSION:
+        return None
+    return cached.get("read")
+
+
+def store_read_scenarios(digest: str, df: pd.DataFrame) -> None:
+    """Store the dataframe a scenario file was read into."""
+    _store(digest, {"version": CACHE_VERSION, "read": df})
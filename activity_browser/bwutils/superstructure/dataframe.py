@@ -1,17 +1,20 @@
 # -*- coding: utf-8 -*-
 import ast
+import copy
 import sys
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 import numpy as np
 import pandas as pd
 from PySide2.QtCore import Qt
 from PySide2.QtWidgets import QApplication, QPushButton
 
+from activity_browser_workers.scenarios import ScenarioCombiner
+
 from ..errors import ScenarioDatabaseNotFoundError
 from ..metadata import AB_metadata
 from ..utils import Index
-from .activities import data_from_index
+from .activities import data_from_indices
 from .file_dialogs import ABPopup
 from .utils import SUPERSTRUCTURE
 
@@ -33,8 +36,8 @@ def superstructure_from_arrays(
     else:
         names = pd.Index(["scenario{}".format(i + 1) for i in range(samples.shape[1])])
 
-    # Construct superstructure from indices
-    superstructure = pd.DataFrame(map(data_from_index, indices), columns=SUPERSTRUCTURE)
+    # Construct superstructure from indices, reading all activities at once
+    superstructure = data_from_indices(indices).loc[:, SUPERSTRUCTURE]
     # Construct scenarios from samples
     scenarios = pd.DataFrame(samples, columns=names)
 
@@ -42,24 +45,108 @@ def superstructure_from_arrays(
     return df
 
 
+class ScenarioProduct(object):
+    """Virtual (flows x scenarios) dataframe of the product combination of
+    several scenario files.
+
+    Only the values of the separate files are kept, so memory grows with the
+    sum of the files instead of with their product. The values of a combined
+    scenario are built from the columns of the files when they are asked
+    for with `column`, `to_frame` builds the full dataframe.
+
+    Parameters
+    ----------
+    index: the index of the combined flows, after merging the technosphere
+        flows to self, see `SuperstructureManager.merge_flows_to_self`
+    columns: the names of the combined scenarios
+    combinations: (scenarios x files) array with the position of the column
+        of every file that makes up a combined scenario
+    owned: per file, the positions in the union of the file indexes of the
+        flows that take their values from that file ('last one wins')
+    blocks: per file, the (owned flows x file scenarios) values
+    keep: positions in the union of the flows that are not merged
+    technosphere: positions in the union of the technosphere flows to self
+    production: positions in the union of the production flows these are
+        merged with, -1 where there is none
+    defaults: production amounts of the merged flows without production flow
+    """
+
+    def __init__(
+        self,
+        index: pd.MultiIndex,
+        columns: pd.Index,
+        combinations: np.ndarray,
+        owned: List[np.ndarray],
+        blocks: List[np.ndarray],
+        keep: np.ndarray,
+        technosphere: np.ndarray,
+        production: np.ndarray,
+        defaults: np.ndarray,
+    ):
+        self.index = index
+        self.columns = columns
+        self.combiner = ScenarioCombiner(
+            combinations, owned, blocks, keep, technosphere, production, defaults
+        )
+        # Positions of the flows of the view in the combined flows
+        self.selection = np.arange(len(index))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.index), len(self.columns)
+
+    @property
+    def empty(self) -> bool:
+        return 0 in self.shape
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def column(self, position: int) -> np.ndarray:
+        """Return the values of the combined scenario at `position`."""
+        return self.combiner.column(position)[self.selection]
+
+    def take(self, positions: np.ndarray) -> "ScenarioProduct":
+        """Return a view of the flows at the given positions."""
+        view = copy.copy(self)
+        view.selection = self.selection[positions]
+        view.index = self.index[positions]
+        return view
+
+    def to_frame(self) -> pd.DataFrame:
+        """Build the full dataframe of all of the combined scenarios."""
+        data = np.empty(self.shape)
+        for i in range(self.shape[1]):
+            data[:, i] = self.column(i)
+        return pd.DataFrame(data, index=self.index, columns=self.columns)
+
+
 def arrays_from_indexed_superstructure(
-    df: pd.DataFrame,
-) -> Tuple[np.ndarray, np.ndarray]:
+    df: Union[pd.DataFrame, ScenarioProduct],
+) -> Tuple[np.ndarray, Union[np.ndarray, ScenarioProduct]]:
+    """Return the indexes of the flows and their scenario values, the values
+    of a `ScenarioProduct` are kept virtual.
+    """
     result = np.zeros(df.shape[0], dtype=object)
     for i, data in enumerate(df.index.to_flat_index()):
         result[i] = Index.build_from_dict(
             {"input": data[0], "output": data[1], "flow type": data[2]}
         )
+    if isinstance(df, ScenarioProduct):
+        return result, df
     return result, df.to_numpy(dtype=float)
 
 
 def filter_databases_indexed_superstructure(
-    df: pd.DataFrame, include: set
-) -> pd.DataFrame:
+    df: Union[pd.DataFrame, ScenarioProduct], include: set
+) -> Union[pd.DataFrame, ScenarioProduct]:
     """Filters the given superstructure so that only indexes where the output
     database is in the `include` set are valid.
     """
-    return df.loc[[x[1][0] in include for x in df.index.to_flat_index()], :]
+    mask = [x[1][0] in include for x in df.index.to_flat_index()]
+    if isinstance(df, ScenarioProduct):
+        return df.take(np.flatnonzero(mask))
+    return df.loc[mask, :]
 
 
 def scenario_columns(df: pd.DataFrame) -> pd.Index:
@@ -4,12 +4,20 @@ from pathlib import Path
 from typing import Optional, Union
 from logging import getLogger
 
+import numpy as np
 import pandas as pd
 
 from ..errors import *
+from .cache import file_digest, load_read_scenarios, store_read_scenarios
 
 log = getLogger(__name__)
 
+# Matches textual keys like "('database', 'code')"
+KEY_PATTERN = (
+    r"^\s*\(\s*(?P<dq>['\"])(?P<database>.*?)(?P=dq)\s*,"
+    r"\s*(?P<cq>['\"])(?P<code>.*)(?P=cq)\s*\)\s*$"
+)
+
 
 class ABFileImporter(ABC):
     """
@@ -41,6 +49,10 @@ class ABFileImporter(ABC):
 
     ABScenarioColumnsErrorIfNA = {"from key", "flow type", "to key"}
     ABStandardBiosphereColumns = {"from categories", "to categories"}
+    ABKeyColumns = ("from key", "to key")
+
+    # Number of rows of a scenario file that are read and prepared at once
+    CHUNK_SIZE = 100_000
 
     def __init__(self):
         pass
@@ -186,6 +198,40 @@ class ABFileImporter(ABC):
         ABFileImporter.production_process_check(data, scenario_names)
         ABFileImporter.check_for_calculation_errors(data)
 
+    @staticmethod
+    def parse_keys(keys: pd.Series) -> pd.Series:
+        """Convert textual keys like "('database', 'code')" into tuples.
+
+        Keys are matched as a whole column, only keys with quotes or escapes
+        inside their fields are evaluated one by one. Empty keys are kept
+        as NaN.
+        """
+        text = keys.astype(object)
+        parts = text.str.extract(KEY_PATTERN)
+        simple = parts["database"].notna()
+        for field in ("database", "code"):
+            simple &= ~parts[field].str.contains(r"['\"\\]", na=True)
+        values = list(zip(parts["database"], parts["code"]))
+        for i in np.flatnonzero(~simple.to_numpy()):
+            key = text.iat[i]
+            values[i] = np.nan if pd.isna(key) else ast.literal_eval(key)
+        return pd.Series(values, index=keys.index, dtype=object)
+
+    @staticmethod
+    def keys_to_tuples(data: pd.DataFrame) -> pd.DataFrame:
+        """Convert the (list-like) keys in the key columns into tuples."""
+        for column in ABFileImporter.ABKeyColumns:
+            if column in data:
+                data[column] = pd.Series(
+                    [
+                        tuple(k) if isinstance(k, (list, tuple, np.ndarray)) else k
+                        for k in data[column]
+                    ],
+                    index=data.index,
+                    dtype=object,
+                )
+        return data
+
     @staticmethod
     def scenario_names(data: pd.DataFrame) -> list:
         return list(
@@ -205,9 +251,7 @@ class ABFeatherImporter(ABFileImporter):
     def read_file(path: Optional[Union[str, Path]], **kwargs):
         df = pd.read_feather(path)
         # ... execute code
-        df.loc[:, "from key"] = df.loc[:, "from key"].apply(tuple)
-        df.loc[:, "to key"] = df.loc[:, "to key"].apply(tuple)
-        return df
+        return ABFileImporter.keys_to_tuples(df)
 
 
 class ABCSVImporter(ABFileImporter):
@@ -216,16 +260,40 @@ class ABCSVImporter(ABFileImporter):
 
     @staticmethod
     def read_file(path: Optional[Union[str, Path]], **kwargs):
+        """Read a scenario file in chunks, converting the keys of every chunk
+        into tuples.
+
+        Reading in chunks bounds the memory used to parse the keys, the
+        chunks are concatenated so the whole file is still held in memory.
+        The result is stored in the scenario cache, which is read instead of
+        the file as long as the contents of the file are unchanged.
+        """
         if "separator" in kwargs:
             separator = kwargs["separator"]
         else:
             separator = ";"
-        df = pd.read_csv(
+        digest = file_digest(path, "read", separator)
+        df = load_read_scenarios(digest)
+        if df is not None:
+            log.info(f"Read scenario file {Path(path).name} from cache")
+            return df
+
+        with pd.read_csv(
             path,
             compression="infer",
             sep=separator,
             index_col=False,
-            converters={"from key": ast.literal_eval, "to key": ast.literal_eval},
-        )
-        # ... execute code
+            dtype=dict.fromkeys(ABFileImporter.ABKeyColumns, object),
+            chunksize=ABFileImporter.CHUNK_SIZE,
+        ) as reader:
+            chunks = [ABCSVImporter.prepare_chunk(chunk) for chunk in reader]
+        df = pd.concat(chunks, ignore_index=True)
+        store_read_scenarios(digest, df)
         return df
+
+    @staticmethod
+    def prepare_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+        for column in ABFileImporter.ABKeyColumns:
+            if column in chunk:
+                chunk[column] = ABFileImporter.parse_keys(chunk[column])
+        return chunk
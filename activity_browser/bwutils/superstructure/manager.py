@@ -9,15 +9,16 @@ from pandas.api.types import is_numeric_dtype
 from PySide2.QtCore import Qt
 from PySide2.QtWidgets import QApplication, QPushButton
 
-from activity_browser.mod import bw2data as bd
+from activity_browser.mod.bw2data.backends import ExchangeDataset
 
 from ..errors import (CriticalScenarioExtensionError, ImportCanceledError,
                       ScenarioExchangeDataNonNumericError,
                       ScenarioExchangeDataNotFoundError,
                       ScenarioExchangeNotFoundError,
                       UnalignableScenarioColumnsWarning)
+from ..utils import QUERY_SIZE
 from .activities import fill_df_keys_with_fields, get_activities_from_keys
-from .dataframe import scenario_columns
+from .dataframe import ScenarioProduct, scenario_columns
 from .file_dialogs import ABPopup
 from .utils import SUPERSTRUCTURE, _time_it_, guess_flow_type
 
@@ -39,7 +40,7 @@ class SuperstructureManager(object):
 
     def combined_data(
         self, kind: str = "product", skip_checks: bool = False
-    ) -> pd.DataFrame:
+    ) -> Union[pd.DataFrame, ScenarioProduct]:
         """
         Combines multiple superstructures using logic specified by the first argument (kind).
 
@@ -62,7 +63,8 @@ class SuperstructureManager(object):
 
         Returns
         -------
-        A single pandas dataframe built from the separate dataframes held in the objects frame variable
+        A single pandas dataframe built from the separate dataframes held in the objects frame variable, or a
+        ScenarioProduct for the 'product' combination of multiple dataframes
         """
         if not self.is_multiple:
             df = next(iter(self.frames))
@@ -75,12 +77,11 @@ class SuperstructureManager(object):
         combo_idx = self._combine_indexes()
 
         if kind == "product":
+            # The combined scenarios are built when they are used
             combo_cols = self._combine_columns()
-            df = SuperstructureManager.product_combine_frames(
+            return SuperstructureManager.product_combine_frames(
                 self.frames, combo_idx, combo_cols, skip_checks
             )
-            # Flatten the columns again for later processing.
-            df.columns = df.columns.to_flat_index()
         elif kind == "addition":
             # Find the intersection subset of scenarios.
             cols = self._combine_columns_intersect()
@@ -159,56 +160,74 @@ class SuperstructureManager(object):
     def product_combine_frames(
         data: List[pd.DataFrame],
         index: pd.MultiIndex,
-        cols: pd.MultiIndex,
+        cols: pd.Index,
         skip_checks: bool = False,
-    ) -> pd.DataFrame:
-        """Iterate through the dataframes, filling data into the combined
-        dataframe with duplicate indexes being resolved using a 'last one wins'
+    ) -> ScenarioProduct:
+        """Combine the dataframes into a virtual product of their scenario
+        columns, with duplicate indexes being resolved using a 'last one wins'
         logic.
 
+        The combined scenarios are not built here, only the values of every
+        dataframe are kept, see `ScenarioProduct`.
+
         Parameters
         ----------
         data: A List of dataframes, each dataframe corresponding to a dataframe from a single scenario difference file
         index: The combined Multi-index for the final merged dataframe
-        cols: A Multi-index object that contains all of the levels (scenario names) from the different scenario files)
-        this is used to create a combined set of scenario names
+        cols: The names of the combined scenarios, in the order of the product of the scenario columns of the
+        dataframes
         skip_checks: a boolean that triggers the use of duplicate checks (not required when removing scenario files)
 
         Returns
         -------
-        A pandas dataframe constructed from the combined inputs to the class self.frames variable
+        A ScenarioProduct constructed from the combined inputs to the class self.frames variable
         """
-
-        def combine(one, two):
-            """Should hopefully provide a failsafe approach to combining the different scenario combinations,
-            by using a simple vector - vector assignment approach.
-            """
-            for col_two in SUPERSTRUCTURE.symmetric_difference(two.columns):
-                for idx in one.columns:
-                    if col_two in idx:
-                        one.loc[two.index, idx] = two.loc[:, col_two]
-
-        base_scenario_data = pd.DataFrame([], index=index, columns=SUPERSTRUCTURE)
-        scenarios_data = pd.DataFrame([], index=index, columns=cols)
         if not skip_checks:
-            tmp_df = SuperstructureManager.check_duplicates(data)
-            for idx, f in enumerate(tmp_df):
+            data = SuperstructureManager.check_duplicates(data)
+            for f in data:
                 SuperstructureManager.check_scenario_exchange_values(
                     f, scenario_columns(f)
                 )
-                combine(scenarios_data, f)
-                base_scenario_data.loc[f.index, :] = f.loc[:, SUPERSTRUCTURE]
         else:
-            for idx, f in enumerate(data):
-                f = SuperstructureManager.remove_duplicates(f)
-                combine(scenarios_data, f)
-                base_scenario_data.loc[f.index, :] = f.loc[:, SUPERSTRUCTURE]
-
-        scenarios_data.columns = cols.to_flat_index()
-        df = pd.concat([base_scenario_data, scenarios_data], axis=1)
-        df = SuperstructureManager.merge_flows_to_self(df)
-        #        df.replace(np.nan, 0, inplace=True)
-        return df
+            data = [SuperstructureManager.remove_duplicates(f) for f in data]
+
+        # Find the dataframe and row every flow of the combined index takes its values from
+        owner = np.full(len(index), -1)
+        source = np.zeros(len(index), dtype=np.int64)
+        for i, f in enumerate(data):
+            positions = index.get_indexer(f.index)
+            owner[positions] = i
+            source[positions] = np.arange(len(f))
+        owned, blocks = [], []
+        for i, f in enumerate(data):
+            rows = np.flatnonzero(owner == i)
+            values = f.loc[:, scenario_columns(f)].to_numpy(dtype=float)
+            owned.append(rows)
+            blocks.append(values[source[rows]])
+        combinations = np.array(
+            list(itertools.product(*(range(b.shape[1]) for b in blocks))),
+            dtype=np.int64,
+        ).reshape(-1, len(data))
+
+        keep, technosphere, production, merged = (
+            SuperstructureManager.self_referential_flows(index)
+        )
+        missing = production < 0
+        defaults = np.full(len(production), np.nan)
+        defaults[missing] = SuperstructureManager.production_amounts(
+            merged[missing]
+        )
+        return ScenarioProduct(
+            index=index[keep].append(merged),
+            columns=cols,
+            combinations=combinations,
+            owned=owned,
+            blocks=blocks,
+            keep=keep,
+            technosphere=technosphere,
+            production=production,
+            defaults=defaults,
+        )
 
     @staticmethod
     def addition_combine_frames(
@@ -261,6 +280,82 @@ class SuperstructureManager(object):
 
         return df
 
+    @staticmethod
+    def self_referential_flows(
+        index: pd.MultiIndex,
+    ) -> (np.ndarray, np.ndarray, np.ndarray, pd.MultiIndex):
+        """Locate the technosphere flows to self in a superstructure index and
+        the production flows they are merged with, see `merge_flows_to_self`.
+
+        Returns
+        -------
+        The positions of the flows that are not merged, the positions of the
+        technosphere flows to self, the positions of their production flows
+        (-1 where there is none) and the index of the merged production flows
+        """
+        inputs = index.get_level_values(0)
+        outputs = index.get_level_values(1)
+        flows = index.get_level_values(2)
+        to_self = np.fromiter(
+            (i == o for i, o in zip(inputs, outputs)), dtype=bool, count=len(index)
+        )
+        technosphere = np.flatnonzero(to_self & (flows == "technosphere"))
+        merged = pd.MultiIndex.from_arrays(
+            [
+                inputs[technosphere],
+                outputs[technosphere],
+                ["production"] * len(technosphere),
+            ],
+            names=["input", "output", "flow"],
+        )
+        # the production flows to self, of which the last one wins
+        candidates = np.flatnonzero(to_self & (flows == "production"))
+        matched = index[candidates].isin(merged)
+        unique = candidates[~index[candidates].duplicated(keep="last")]
+        found = index[unique].get_indexer(merged)
+        production = np.where(found >= 0, unique[found], -1)
+
+        keep = np.ones(len(index), dtype=bool)
+        keep[technosphere] = False
+        keep[candidates[matched]] = False
+        return np.flatnonzero(keep), technosphere, production, merged
+
+    @staticmethod
+    def production_amounts(index: pd.MultiIndex) -> np.ndarray:
+        """Return the default production amount of the input activities of
+        the given production flows, from the respective brightway database.
+
+        The production exchanges of all activities are read with a single
+        query per database, activities without production exchange produce 1.
+        """
+        # WARNING: this way of getting the production amount only works for processes with
+        # 1 reference flow (because we just take the first production exchange)
+        # Once AB has support for multiple reference flows, we need to adjust this code to match the
+        # right flow -something with looping over the flows and getting the right product or something-.
+        keys = index.get_level_values(0)
+        codes = {}
+        for db_name, code in set(keys):
+            codes.setdefault(db_name, []).append(code)
+        amounts = {}
+        for db_name, db_codes in codes.items():
+            for i in range(0, len(db_codes), QUERY_SIZE):
+                query = (
+                    ExchangeDataset.select(
+                        ExchangeDataset.output_code, ExchangeDataset.data
+                    )
+                    .where(
+                        ExchangeDataset.output_database == db_name,
+                        ExchangeDataset.output_code << db_codes[i : i + QUERY_SIZE],
+                        ExchangeDataset.type == "production",
+                    )
+                    .order_by(ExchangeDataset.id)
+                )
+                for exc in query:
+                    amounts.setdefault(
+                        (db_name, exc.output_code), exc.data.get("amount", 1)
+                    )
+        return np.array([amounts.get(key, 1) for key in keys], dtype=float)
+
     @staticmethod
     @_time_it_
     def merge_flows_to_self(df: pd.DataFrame) -> pd.DataFrame:
@@ -276,78 +371,33 @@ class SuperstructureManager(object):
         -------
         A pandas dataframe with the changes made to the scenario dataframe for these self referential flows
         """
-        self_referential_production_flows = df.loc[
-            df.apply(
-                lambda x: (
-                    True
-                    if x["from key"] == x["to key"] and x["flow type"] == "technosphere"
-                    else False
-                ),
-                axis=1,
-            ),
-            :,
-        ].copy()
-        self_referential_production_flows.index = pd.MultiIndex.from_arrays(
-            [
-                self_referential_production_flows.index.get_level_values(0),
-                self_referential_production_flows.index.get_level_values(1),
-                self_referential_production_flows.index.get_level_values(2).str.replace(
-                    "technosphere", "production"
-                ),
-            ],
-            names=["input", "output", "flow"],
+        keep, technosphere, production, merged = (
+            SuperstructureManager.self_referential_flows(df.index)
         )
-        scenario_cols = df.columns.difference(SUPERSTRUCTURE)
-        prod_indexes = self_referential_production_flows.loc[
-            self_referential_production_flows.index.isin(df.index)
-        ].index
-        self_referential_production_flows.loc[prod_indexes, scenario_cols] = df.loc[
-            df.index.isin(self_referential_production_flows.index), scenario_cols
-        ]
-        self_referential_production_flows.loc[prod_indexes, "flow type"] = "production"
-
-        # TODO use metadata for the default production values
-        for idx in self_referential_production_flows.loc[
-            ~self_referential_production_flows.index.isin(df.index)
-        ].index:
-
-            # this flow to self does not have a similar 'production' flow to self.
-            # find the default production value and add it as a 'production' flow
-
-            # WARNING: this way of getting the production amount only works for processes with
-            # 1 reference flow (because we just take index 0 from list of production exchanges)
-            # Once AB has support for multiple reference flows, we need to adjust this code to match the
-            # right flow -something with looping over the flows and getting the right product or something-.
-            prod_amt = list(bd.get_activity(idx[0]).production())[0].get("amount", 1)
-            # make a new df to edit the production, add the correct values/indices where needed
-            # and concat to the main df
-            self_referential_production_flows.loc[idx, ["flow type"]] = "production"
-            self_referential_production_flows.loc[idx, scenario_cols] = prod_amt
-        if len(self_referential_production_flows) > 0:
-            tech_idxs = [
-                (x[0], x[1], "technosphere")
-                for x in self_referential_production_flows.index
-            ]
-
-            denominator = (
-                self_referential_production_flows.loc[:, scenario_cols]
-                + df.loc[tech_idxs, scenario_cols].values
-            )
-            self_referential_production_flows.loc[:, scenario_cols] = (
-                self_referential_production_flows.loc[:, scenario_cols] / denominator
-            )
-            # if we did divide by 0 then replace these nans by 0
-            self_referential_production_flows.loc[:, scenario_cols] = (
-                self_referential_production_flows.loc[:, scenario_cols].where(
-                    ~denominator.isin([0]), 0
-                )
+        if len(technosphere) == 0:
+            return df
+        scenario_cols = df.columns.difference(SUPERSTRUCTURE, sort=False)
+        values = df.loc[:, scenario_cols].to_numpy(dtype=float)
+
+        found = production >= 0
+        production_values = np.empty((len(technosphere), len(scenario_cols)))
+        production_values[found] = values[production[found]]
+        production_values[~found] = SuperstructureManager.production_amounts(
+            merged[~found]
+        )[:, None]
+        denominator = production_values + values[technosphere]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # if we did divide by 0 then use 0
+            production_values = np.where(
+                denominator == 0, 0, production_values / denominator
             )
 
-            # drop the 'technosphere' flows
-            df = df.drop(tech_idxs)
-            df = df.drop(prod_indexes)
-            df = pd.concat([df, self_referential_production_flows], axis=0)
-        return df
+        # the merged flows take the fields of the technosphere flows
+        flows = df.iloc[technosphere].copy()
+        flows.index = merged
+        flows.loc[:, "flow type"] = "production"
+        flows.loc[:, scenario_cols] = production_values
+        return pd.concat([df.iloc[keep], flows], axis=0)
 
     @staticmethod
     def remove_duplicates(df: pd.DataFrame) -> pd.DataFrame:
@@ -380,8 +430,8 @@ class SuperstructureManager(object):
             df.loc[unknown_flows, "flow type"] = df.loc[
                 unknown_flows, EXCHANGE_KEYS
             ].apply(guess_flow_type, axis=1)
-        return pd.MultiIndex.from_tuples(
-            df.loc[:, INDEX_KEYS].apply(tuple, axis=1),
+        return pd.MultiIndex.from_arrays(
+            [df.loc[:, key] for key in INDEX_KEYS],
             names=["input", "output", "flow"],
         )
 
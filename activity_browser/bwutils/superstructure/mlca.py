@@ -1,40 +1,58 @@
 # -*- coding: utf-8 -*-
-from typing import Iterable, Optional
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional, Union
 
 import numpy as np
 import pandas as pd
 from PySide2.QtWidgets import QPushButton
+from scipy import sparse
 
 from activity_browser.mod import bw2data as bd
+from activity_browser_workers.scenarios import (ScenarioValues, SharedArray,
+                                                init_worker, solve_scenarios)
 
-from ..commontasks import format_activity_label
+from ..commontasks import format_activity_labels
 from ..errors import ScenarioExchangeNotFoundError
-from ..multilca import MLCA, Contributions
+from ..multilca import MLCA, Contributions, LazyResults
 from ..utils import Index
-from .dataframe import (arrays_from_indexed_superstructure,
+from .dataframe import (ScenarioProduct, arrays_from_indexed_superstructure,
                         filter_databases_indexed_superstructure,
                         scenario_names_from_df)
 from .file_dialogs import ABPopup
 
-try:
-    from bw2calc.matrices import TechnosphereBiosphereMatrixBuilder as MB
-except ModuleNotFoundError:
-    pass  # removed in bw25
-
 
 class SuperstructureMLCA(MLCA):
     """Subclass of the `MLCA` class which adds another dimension in the form
     of scenarios.
     """
 
+    # The contributions of all scenarios are stored (see `ContributionStore`),
+    # the inventories are calculated on demand from the supply of a scenario
+    lazy_results = False
+    lazy_inventories = True
+    # Number of scenario technosphere factorizations kept in memory
+    FACTORIZATION_CACHE_SIZE = 4
+    # Minimum number of scenarios for which worker processes are started
+    PARALLEL_MIN_SCENARIOS = 8
+    # Maximum size in bytes of the contribution arrays kept in memory, larger
+    # contributions are stored on disk, see `ContributionStore`
+    CONTRIBUTION_MEMORY_LIMIT = 2 * 1024**3
+
     matrices = {
         "biosphere": "biosphere_matrix",
         "technosphere": "technosphere_matrix",
         "production": "technosphere_matrix",
     }
 
-    def __init__(self, cs_name: str, df: pd.DataFrame):
-        assert isinstance(df, pd.DataFrame), (
+    def __init__(self, cs_name: str, df: Union[pd.DataFrame, ScenarioProduct]):
+        assert isinstance(df, (pd.DataFrame, ScenarioProduct)), (
             "Check if you have provided at least 1 reference flow, 1 impact category "
             "and 1 scenario file. "
         )
@@ -45,17 +63,6 @@ class SuperstructureMLCA(MLCA):
 
         super().__init__(cs_name)
 
-        # Scenarios overwrite the lca.xxx_matrix. For supporting absent values
-        # in scenario files defaults are required, to prevent these from being
-        # overwritten duplicates are required...
-        self.default_technosphere_matrix = self.lca.technosphere_matrix.copy()
-        self.default_biosphere_matrix = self.lca.biosphere_matrix.copy()
-        self.defaults = {
-            "technosphere": "default_technosphere_matrix",
-            "production": "default_technosphere_matrix",
-            "biosphere": "default_biosphere_matrix",
-        }
-
         # Filter dataframe for keys that do not occur in the LCA matrix.
         df = filter_databases_indexed_superstructure(df, self.all_databases)
         assert not df.empty, "Filtering unused flows removed all of the scenario data."
@@ -78,31 +85,47 @@ class SuperstructureMLCA(MLCA):
             ],
         )
         self.indices_to_matrix()
+        # Scenarios overwrite the values of the lca.xxx_matrix in place
+        self.scenario_data = self.prepare_scenario_data()
 
         # Construct an index dictionary similar to fu_index and method_index
         self._current_index = 0
+        # The scenario currently written into the LCA matrices
+        self.applied_scenario: Optional[int] = None
+        self.factorizations = OrderedDict()
         self.scenario_index = {k: i for i, k in enumerate(self.scenario_names)}
 
         # Rebuild numpy arrays with scenario dimension included.
         self.lca_scores = np.zeros(
             (len(self.func_units), len(self.methods), self.total)
         )
-        self.elementary_flow_contributions = np.zeros(
-            (
+        shapes = {
+            "elementary_flow_contributions": (
                 len(self.func_units),
                 len(self.methods),
                 self.total,
                 self.lca.biosphere_matrix.shape[0],
-            )
-        )
-        self.process_contributions = np.zeros(
-            (
+            ),
+            "process_contributions": (
                 len(self.func_units),
                 len(self.methods),
                 self.total,
                 self.lca.technosphere_matrix.shape[0],
-            )
-        )
+            ),
+        }
+        size = sum(np.prod(shape, dtype=np.int64) for shape in shapes.values()) * 8
+        self.contribution_directory: Optional[str] = None
+        if size > self.CONTRIBUTION_MEMORY_LIMIT:
+            self.contribution_directory = tempfile.mkdtemp(prefix="ab_contributions_")
+            weakref.finalize(self, shutil.rmtree, self.contribution_directory, True)
+        for name, shape in shapes.items():
+            if self.contribution_directory:
+                contributions = ContributionStore(
+                    shape, self.contribution_directory, name
+                )
+            else:
+                contributions = np.zeros(shape)
+            setattr(self, name, contributions)
 
     @property
     def current(self) -> int:
@@ -114,15 +137,44 @@ class SuperstructureMLCA(MLCA):
         self._current_index = current if current < self.total else 0
 
     def next_scenario(self):
-        self.update_matrices()
+        self.apply_scenario(self.current)
         self.current += 1
 
     def set_scenario(self, index: int) -> None:
         """Set the current scenario index given a new index to go to"""
-        steps = self._get_steps_to_index(index)
-        # self.current = steps[-1] + 1  # Walk the steps to the new index
-        for _ in steps:
-            self.next_scenario()
+        if index < 0:
+            raise ValueError("Negative indexes are not allowed")
+        elif index >= self.total:
+            raise ValueError("Given index is not possible for current scenario dataset")
+        self.apply_scenario(index)
+        self.current = index
+
+    def apply_scenario(self, index: int) -> None:
+        """Write the values of the given scenario directly into the LCA
+        matrices.
+
+        Every scenario replaces the same matrix cells, so no other scenarios
+        have to be applied first. A cached factorization of the scenario's
+        technosphere matrix is restored if there is one.
+        """
+        if index == self.applied_scenario:
+            return
+        self.update_matrices(index)
+        self.applied_scenario = index
+        if index in self.factorizations:
+            self.factorizations.move_to_end(index)
+            self.lca.solver = self.factorizations[index]
+
+    def cache_factorization(self) -> None:
+        """Keep the factorization of the technosphere matrix of the applied
+        scenario, dropping the least recently used ones.
+        """
+        if self.applied_scenario is None or not hasattr(self.lca, "solver"):
+            return
+        self.factorizations[self.applied_scenario] = self.lca.solver
+        self.factorizations.move_to_end(self.applied_scenario)
+        while len(self.factorizations) > self.FACTORIZATION_CACHE_SIZE:
+            self.factorizations.popitem(last=False)
 
     def indices_to_matrix(self) -> None:
         def convert(idx: Index) -> tuple:
@@ -160,100 +212,230 @@ class SuperstructureMLCA(MLCA):
             except Exception as e:
                 continue
 
-    def update_matrices(self) -> None:
-        """A Simplified version of the `PackagesDataLoader.update_matrices` method.
-        In this case, we expect to only replace technosphere and biosphere
-        values, leaving out characterization factor values.
+    def prepare_scenario_data(self) -> dict:
+        """Prepare the scenario values of every LCA matrix for `update_matrices`.
+
+        Returns a dictionary of matrix names with the positions of the
+        scenario exchanges in the `data` array of the (CSR) matrix and their
+        (exchanges x scenarios) values. Inputs are made negative and absent
+        values are replaced by the values of the matrix as it is built from
+        the databases. Exchanges that do not occur in a matrix are added to
+        it as explicit zeros.
+
+        The values of a `ScenarioProduct` stay virtual, see `ScenarioValues`.
         """
-        kinds = set([idx[2] for idx in self.indices])
         types = np.array([idx[2] for idx in self.indices])
-        for kind in kinds:
-            idx = self.matrix_indices[types == kind]
-            sample = self.values[types == kind, self.current]
-            # Previously filtered sample and idx for NaN values in samples.
-            # Currently replaces sample NaN values with defaults from the databases
-            if np.isnan(sample).any():
-                default = getattr(self, self.defaults[kind])
-                na_idx = idx[np.isnan(sample)]
-                if kind == "technosphere":
-                    sample[np.isnan(sample)] = np.multiply(
-                        default[na_idx["row"], na_idx["col"]].tolist()[0], -1
-                    )
-                else:
-                    sample[np.isnan(sample)] = default[
-                        na_idx["row"], na_idx["col"]
-                    ].tolist()[0]
+        data = {}
+        for name in dict.fromkeys(self.matrices.values()):
+            kinds = [kind for kind, matrix in self.matrices.items() if matrix == name]
+            mask = np.isin(types, kinds)
             try:
-                matrix = getattr(self.lca, self.matrices[kind])
+                matrix = getattr(self.lca, name)
             except AttributeError:
                 # This LCA doesn't have this matrix
                 continue
+            if not mask.any():
+                continue
+            idx = self.matrix_indices[mask]
+            matrix, positions = self._data_positions(matrix, idx)
+            setattr(self.lca, name, matrix)
+
+            signs = np.where(idx["type"] == 1, -1.0, 1.0)
+            if isinstance(self.values, ScenarioProduct):
+                values = ScenarioValues(
+                    self.values.combiner,
+                    self.values.selection[mask],
+                    signs,
+                    matrix.data[positions],
+                )
+                data[name] = (positions, values)
+                continue
+            values = self.values[mask] * signs[:, None]
+            missing = np.isnan(values)
+            defaults = np.broadcast_to(matrix.data[positions][:, None], values.shape)
+            values[missing] = defaults[missing]
+            # Columns are contiguous, as a scenario is applied column-wise
+            data[name] = (positions, np.asfortranarray(values))
+        return data
 
-            if self.matrices[kind] == "technosphere_matrix":
+    @staticmethod
+    def _data_positions(
+        matrix: sparse.spmatrix, idx: np.ndarray
+    ) -> (sparse.csr_matrix, np.ndarray):
+        """Return the matrix in canonical CSR format with an entry for every
+        (row, col) of `idx`, and the positions of these entries in its
+        `data` array.
+        """
+        matrix = sparse.csr_matrix(matrix)
+        matrix.sum_duplicates()
+        width = matrix.shape[1]
+        wanted = idx["row"].astype(np.int64) * width + idx["col"]
+
+        def entry_keys(m: sparse.csr_matrix) -> np.ndarray:
+            rows = np.repeat(np.arange(m.shape[0], dtype=np.int64), np.diff(m.indptr))
+            return rows * width + m.indices
+
+        keys = entry_keys(matrix)
+        missing = np.setdiff1d(wanted, keys)
+        if missing.size:
+            coo = matrix.tocoo()
+            matrix = sparse.csr_matrix(
+                (
+                    np.concatenate([coo.data, np.zeros(missing.size)]),
+                    (
+                        np.concatenate([coo.row, missing // width]),
+                        np.concatenate([coo.col, missing % width]),
+                    ),
+                ),
+                shape=matrix.shape,
+            )
+            matrix.sum_duplicates()
+            keys = entry_keys(matrix)
+        return matrix, np.searchsorted(keys, wanted)
+
+    def update_matrices(self, index: Optional[int] = None) -> None:
+        """A Simplified version of the `PackagesDataLoader.update_matrices` method.
+        In this case, we expect to only replace technosphere and biosphere
+        values, leaving out characterization factor values.
+
+        The values of the scenario at `index` are used, which defaults to
+        the current scenario.
+        """
+        index = self.current if index is None else index
+        for name, (positions, values) in self.scenario_data.items():
+            getattr(self.lca, name).data[positions] = values[:, index]
+            if name == "technosphere_matrix" and hasattr(self.lca, "solver"):
                 # Remove existing matrix factorization
                 # because changing technosphere
-                if hasattr(self.lca, "solver"):
-                    delattr(self.lca, "solver")
+                delattr(self.lca, "solver")
 
-            # TODO: Check if this doesnt break stuff
-            # TODO: Update: It does..
-            try:
-                if kind == "technosphere":
-                    MB.fix_supply_use(idx, sample)
-            except:
-                # removed in BW25
-                mask = np.where(idx["type"] == 1)
-                sample[mask] = -1 * sample[mask]
-            matrix[
-                idx["row"],
-                idx["col"],
-            ] = sample
+    def calculate(self, processes: int = 1):
+        """Calculate the results of all scenarios.
+
+        With more than one process (and at least `PARALLEL_MIN_SCENARIOS`
+        scenarios that change the technosphere) the technosphere of the
+        scenarios is factorized and solved in worker processes.
+        """
+        self.processes = processes
+        super().calculate()
 
     def _perform_calculations(self):
         """Near copy of `MLCA` class, but includes a loop for all scenarios."""
+        demands = self._build_demand_matrix()
+        supplies = None
+        processes = getattr(self, "processes", 1)
+        if (
+            processes > 1
+            and self.total >= self.PARALLEL_MIN_SCENARIOS
+            and "technosphere_matrix" in self.scenario_data
+        ):
+            supplies = self._solve_parallel(demands, processes)
         for ps_col in range(self.total):
-            self.next_scenario()
-            for row, func_unit in enumerate(self.func_units):
-                try:
-                    self.lca.redo_lci(func_unit)
-                except:
-                    # bw25 compatibility requires activity id instead of activity key
-                    key = list(func_unit.keys())[0]
-                    self.lca.redo_lci({bd.get_activity(key).id: func_unit[key]})
-
-                self.scaling_factors.update(
-                    {(str(func_unit), ps_col): self.lca.supply_array}
-                )
-                self.technosphere_flows.update(
-                    {
-                        (str(func_unit), ps_col): np.multiply(
-                            self.lca.supply_array,
-                            self.lca.technosphere_matrix.diagonal(),
-                        )
-                    }
-                )
-                self.inventory.update(
-                    {
-                        (str(func_unit), ps_col): np.array(
-                            self.lca.inventory.sum(axis=1)
-                        ).ravel()
-                    }
+            self.apply_scenario(ps_col)
+            if supplies is None:
+                supply = self._solve_demands(demands)
+                self.cache_factorization()
+            else:
+                supply = supplies[:, :, ps_col]
+            self._store_results(demands, supply, ps_col)
+        self._store_lazy_inventories()
+        self.current = 0
+
+    def scenario_biosphere(self, index: int) -> sparse.csr_matrix:
+        """Return the biosphere matrix with the values of the given scenario."""
+        matrix = self.lca.biosphere_matrix
+        if "biosphere_matrix" not in self.scenario_data:
+            return matrix
+        positions, values = self.scenario_data["biosphere_matrix"]
+        matrix = matrix.copy()
+        matrix.data[positions] = values[:, index]
+        return matrix
+
+    def _store_lazy_inventories(self) -> None:
+        """Replace the inventories of all reference flows and scenarios by
+        objects that calculate them on demand, from the stored supply and the
+        biosphere matrix of the scenario.
+        """
+        scenarios = range(self.total)
+
+        def lci(key: tuple) -> sparse.csr_matrix:
+            return self.scenario_biosphere(key[1]) @ sparse.diags(
+                self.scaling_factors[key]
+            )
+
+        def characterized_lci(index: tuple) -> sparse.csr_matrix:
+            row, col, scenario = index
+            return self.method_matrices[col] @ lci(
+                (str(self.func_units[row]), scenario)
+            )
+
+        self.inventories = LazyResults(
+            itertools.product(map(str, self.func_units), scenarios),
+            lci,
+            self.RESULT_CACHE_SIZE,
+        )
+        self.characterized_inventories = LazyResults(
+            itertools.product(
+                range(len(self.func_units)), range(len(self.methods)), scenarios
+            ),
+            characterized_lci,
+            self.RESULT_CACHE_SIZE,
+        )
+
+    def _solve_parallel(self, demands: np.ndarray, processes: int) -> np.ndarray:
+        """Solve the demands of all scenarios in worker processes, returning
+        the (activities x reference flows x scenarios) supply.
+
+        The technosphere matrix, the scenario values and the demands
+        are shared with the workers once through shared memory, the workers
+        write the supply of their scenarios into a shared result array.
+        Virtual scenario values are shared as the arrays they are built from.
+
+        The workers are started from `activity_browser_workers`, which does
+        not import the Qt application, and factorize with the same solver
+        as bw2calc.
+        """
+        positions, values = self.scenario_data["technosphere_matrix"]
+        matrix = self.lca.technosphere_matrix
+        arrays = {
+            "data": matrix.data,
+            "indices": matrix.indices,
+            "indptr": matrix.indptr,
+            "positions": positions,
+            "demands": demands,
+            "supplies": np.zeros((matrix.shape[1], demands.shape[1], self.total)),
+        }
+        if isinstance(values, ScenarioValues):
+            arrays.update({f"values {k}": v for k, v in values.arrays().items()})
+        else:
+            arrays["values"] = values
+        shared = {}
+        try:
+            for name, array in arrays.items():
+                shared[name] = SharedArray.create(array)
+            # smaller slices of scenarios even out the work of the processes
+            slices = [
+                s.tolist()
+                for s in np.array_split(
+                    np.arange(self.total), min(self.total, processes * 4)
                 )
-                self.inventories.update({(str(func_unit), ps_col): self.lca.inventory})
-
-                for col, cf_matrix in enumerate(self.method_matrices):
-                    self.lca.characterization_matrix = cf_matrix
-                    self.lca.lcia_calculation()
-                    self.lca_scores[row, col, ps_col] = self.lca.score
-                    self.characterized_inventories[(row, col, ps_col)] = (
-                        self.lca.characterized_inventory.copy()
-                    )
-                    self.elementary_flow_contributions[row, col, ps_col] = np.array(
-                        self.lca.characterized_inventory.sum(axis=1)
-                    ).ravel()
-                    self.process_contributions[row, col, ps_col] = (
-                        self.lca.characterized_inventory.sum(axis=0)
-                    )
+            ]
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(
+                max_workers=min(processes, self.total),
+                mp_context=context,
+                initializer=init_worker,
+                initargs=(
+                    {name: array.spec for name, array in shared.items()},
+                    matrix.shape,
+                ),
+            ) as pool:
+                list(pool.map(solve_scenarios, slices))
+            return shared["supplies"].array.copy()
+        finally:
+            for array in shared.values():
+                array.close()
+                array.unlink()
 
     def update_lca_calculation_for_sankey(
         self, scenario_index: int, func_unit: str, method_index: int
@@ -267,7 +449,7 @@ class SuperstructureMLCA(MLCA):
         @param method_index: Index of the method for which the calculation must be performed
         """
         self.current = scenario_index
-        self.update_matrices()
+        self.apply_scenario(scenario_index)
         try:
             self.lca.redo_lci(func_unit)
         except:
@@ -276,7 +458,9 @@ class SuperstructureMLCA(MLCA):
             self.lca.redo_lci({bd.get_activity(key).id: func_unit[key]})
         self.lca.characterization_matrix = self.method_matrices[method_index]
         self.lca.lcia_calculation()
-        self.lca.decompose_technosphere()
+        if not hasattr(self.lca, "solver"):
+            self.lca.decompose_technosphere()
+            self.cache_factorization()
 
     def get_results_for_method(self, index: int = 0) -> pd.DataFrame:
         """Overrides the parent and returns a dataframe with the scenarios
@@ -285,28 +469,11 @@ class SuperstructureMLCA(MLCA):
         data = self.lca_scores[:, index, :]
         return pd.DataFrame(data, index=self.func_key_list, columns=self.scenario_names)
 
-    def _get_steps_to_index(self, index: int) -> list:
-        """Determine how many steps to take when given the index we want
-         to land on.
-
-        We can only iterate through the presample arrays in one direction, so
-         if we go from 2 to 1 we need to calculate the amount of steps to loop
-         around to 1.
-        """
-        if index < 0:
-            raise ValueError("Negative indexes are not allowed")
-        elif index >= self.total:
-            raise ValueError("Given index is not possible for current scenario dataset")
-        if index < self.current:
-            return [*range(self.current, self.total), *range(index)]
-        else:
-            return list(range(self.current, index))
-
     def lca_scores_to_dataframe(self) -> pd.DataFrame:
         """Returns a dataframe of LCA scores using FU labels as index and
         the product of methods and scenarios as columns.
         """
-        labels = [format_activity_label(k, style="pnld") for k in self.fu_activity_keys]
+        labels = format_activity_labels(self.fu_activity_keys, style="pnld")
         methods = [", ".join(m) for m in self.methods]
         df = pd.DataFrame(
             data=[],
@@ -323,6 +490,51 @@ class SuperstructureMLCA(MLCA):
         return df
 
 
+class ContributionStore(object):
+    """Stand-in for a dense (reference flows, methods, scenarios, flows)
+    contribution array that is too large to be kept in memory.
+
+    The contributions of every scenario are stored as float32 in their own
+    memory-mapped `.npy` file in `directory`. Items are indexed like the
+    dense array with a (reference flow, method, scenario) tuple and are
+    returned as float64.
+    """
+
+    def __init__(self, shape: tuple, directory: str, name: str):
+        self.shape = shape
+        self.directory = directory
+        self.name = name
+        self._scenarios = {}
+
+    def scenario(self, index: int) -> np.memmap:
+        """Return the (reference flows, methods, flows) contributions of a
+        scenario.
+        """
+        if index not in self._scenarios:
+            rows, cols, _, flows = self.shape
+            self._scenarios[index] = np.lib.format.open_memmap(
+                os.path.join(self.directory, f"{self.name}_{index:06d}.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(rows, cols, flows),
+            )
+        return self._scenarios[index]
+
+    def __setitem__(self, item: tuple, value: np.ndarray) -> None:
+        row, col, scenario = item
+        self.scenario(scenario)[row, col] = value
+
+    def __getitem__(self, item: tuple) -> np.ndarray:
+        row, col, scenario = item
+        if isinstance(scenario, (int, np.integer)):
+            return np.array(self.scenario(scenario)[row, col], dtype=np.float64)
+        # The scenario axis follows the reference flow and method axes kept
+        axis = sum(not isinstance(i, (int, np.integer)) for i in (row, col))
+        return np.stack(
+            [self[row, col, s] for s in range(self.shape[2])[scenario]], axis=axis
+        )
+
+
 class SuperstructureContributions(Contributions):
     mlca: SuperstructureMLCA
 
@@ -5,8 +5,8 @@ from typing import Iterable, List, NamedTuple, Optional
 import numpy as np
 
 from activity_browser.mod import bw2data as bd
-from activity_browser.mod.bw2data.backends import (ActivityDataset,
-                                                   ExchangeDataset)
+from activity_browser.mod.bw2data.backends import (Activity, ActivityDataset,
+                                                   Exchange, ExchangeDataset)
 from activity_browser.mod.bw2data.parameters import (ActivityParameter,
                                                      DatabaseParameter,
                                                      ParameterizedExchange,
@@ -21,6 +21,9 @@ for a significant amount of repeated logic or heavy IO calls to be avoided by ei
 holding values in memory or allowing simple shortcuts to retrieve them. 
 """
 
+# Maximum number of activity codes or exchange ids in a single database query
+QUERY_SIZE = 500
+
 
 class Parameter(NamedTuple):
     name: str
@@ -159,6 +162,20 @@ class Parameters(UserList):
         """
         return {k: data[k] for k in data.keys() & needed}
 
+    def amounts(self) -> np.ndarray:
+        return np.array([p.amount for p in self.data], dtype=float)
+
+    def sequential_amounts(self, values: np.ndarray) -> np.ndarray:
+        """Return the (parameters x columns) amounts of the parameters after
+        each column of `values` is passed to `update` in turn, so NaN values
+        keep the amount of the previous column.
+        """
+        amounts = np.column_stack([self.amounts(), np.asarray(values, dtype=float)])
+        # Position of the last known amount in every column
+        last = np.where(np.isnan(amounts), 0, np.arange(amounts.shape[1]))
+        np.maximum.accumulate(last, axis=1, out=last)
+        return np.take_along_axis(amounts, last, axis=1)[:, 1:]
+
     def update(self, values: Iterable[float]) -> None:
         """Replace parameters in the list if their linked value is not
         NaN.
@@ -250,3 +267,79 @@ class StaticParameters(object):
     @staticmethod
     def prune_result_data(data: dict) -> dict:
         return {k: v.get("amount") for k, v in data.items()}
+
+
+class ParameterActivities(object):
+    """Holds the activities of the given keys and their exchanges with a
+    formula, as well as the input activities of those exchanges.
+
+    Everything is read with a few bulk queries when the object is created,
+    build it once for every sync of the parameter views instead of reading
+    each activity and exchange separately.
+    """
+
+    def __init__(self, keys: Iterable[tuple]):
+        keys = set(keys)
+        self._activities = self.load_activities(keys)
+        self._exchanges = {}
+        for db_name, codes in self.codes_by_database(self._activities).items():
+            for i in range(0, len(codes), QUERY_SIZE):
+                query = (
+                    ExchangeDataset.select()
+                    .where(
+                        ExchangeDataset.output_database == db_name,
+                        ExchangeDataset.output_code << codes[i : i + QUERY_SIZE],
+                    )
+                    .order_by(ExchangeDataset.id)
+                )
+                for exc in query:
+                    if "formula" in exc.data:
+                        key = (exc.output_database, exc.output_code)
+                        self._exchanges.setdefault(key, []).append(Exchange(exc))
+        inputs = {
+            exc["input"] for excs in self._exchanges.values() for exc in excs
+        }
+        self._activities.update(self.load_activities(inputs - set(self._activities)))
+
+    @staticmethod
+    def codes_by_database(keys: Iterable[tuple]) -> dict:
+        codes = {}
+        for db_name, code in keys:
+            codes.setdefault(db_name, []).append(code)
+        return codes
+
+    @classmethod
+    def load_activities(cls, keys: Iterable[tuple]) -> dict:
+        activities = {}
+        for db_name, codes in cls.codes_by_database(keys).items():
+            for i in range(0, len(codes), QUERY_SIZE):
+                query = ActivityDataset.select().where(
+                    ActivityDataset.database == db_name,
+                    ActivityDataset.code << codes[i : i + QUERY_SIZE],
+                )
+                activities.update(
+                    ((act.database, act.code), Activity(act)) for act in query
+                )
+        return activities
+
+    def activity(self, key: tuple) -> Optional[Activity]:
+        """Return the activity of the key, or None if it does not exist."""
+        return self._activities.get(tuple(key))
+
+    def exchanges(self, key: tuple) -> List[Exchange]:
+        """Return the exchanges with a formula of the activity of the key."""
+        return self._exchanges.get(tuple(key), [])
+
+
+def exchanges_by_id(ids: Iterable[int]) -> dict:
+    """Read the exchanges of the given ids in bulk, returns a dictionary of
+    the exchange id and the `ExchangeDataset`.
+    """
+    ids = list(ids)
+    exchanges = {}
+    for i in range(0, len(ids), QUERY_SIZE):
+        query = ExchangeDataset.select().where(
+            ExchangeDataset.id << ids[i : i + QUERY_SIZE]
+        )
+        exchanges.update((exc.id, exc) for exc in query)
+    return exchanges
@@ -4,6 +4,7 @@
 Each of these classes is either a parent for - or a sub-LCA results tab.
 """
 
+import os
 from collections import namedtuple
 from typing import List, Optional, Union
 from logging import getLogger
@@ -1385,7 +1386,12 @@ class MonteCarloTab(NewAnalysisTab):
 
         QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
         try:
-            self.parent.mc.calculate(iterations=iterations, seed=seed, **includes)
+            self.parent.mc.calculate(
+                iterations=iterations,
+                seed=seed,
+                processes=os.cpu_count() or 1,
+                **includes,
+            )
             signals.monte_carlo_finished.emit()
             self.update_mc()
         except (
@@ -1554,6 +1560,8 @@ class GSATab(NewAnalysisTab):
 
     def connect_signals(self):
         self.button_run.clicked.connect(self.calculate_gsa)
+        self.combobox_fu.currentIndexChanged.connect(self.select_gsa)
+        self.combobox_methods.currentIndexChanged.connect(self.select_gsa)
         signals.monte_carlo_finished.connect(self.monte_carlo_finished)
 
     def add_GSA_ui_elements(self):
@@ -1604,6 +1612,14 @@ class GSATab(NewAnalysisTab):
         )
         self.checkbox_export_data_automatically.setChecked(False)
 
+        # calculate all reference flows and impact categories at once
+        self.checkbox_all = QCheckBox("All reference flows and impact categories")
+        self.checkbox_all.setToolTip(
+            "Run the GSA for every reference flow and impact category, the results"
+            " are shown for the selected ones"
+        )
+        self.checkbox_all.setChecked(False)
+
         # # exclude Pedigree
         # self.checkbox_pedigree = QCheckBox('Include Pedigree uncertainties')
         # self.checkbox_pedigree.setChecked(True)
@@ -1614,6 +1630,7 @@ class GSATab(NewAnalysisTab):
         self.hlayout_row2.addWidget(self.label_cutoff_biosphere)
         self.hlayout_row2.addWidget(self.cutoff_biosphere)
         self.hlayout_row2.addWidget(self.checkbox_export_data_automatically)
+        self.hlayout_row2.addWidget(self.checkbox_all)
         # self.hlayout_row2.addWidget(self.checkbox_pedigree)
         self.hlayout_row2.addStretch(1)
 
@@ -1645,6 +1662,8 @@ class GSATab(NewAnalysisTab):
         )
 
     def monte_carlo_finished(self):
+        # results of earlier runs belong to the previous simulation
+        self.GSA.results = dict()
         self.button_run.setEnabled(True)
         self.widget_settings.show()
         self.label_monte_carlo_first.hide()
@@ -1658,12 +1677,22 @@ class GSATab(NewAnalysisTab):
 
         try:
             QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-            self.GSA.perform_GSA(
-                act_number=act_number,
-                method_number=method_number,
-                cutoff_technosphere=cutoff_technosphere,
-                cutoff_biosphere=cutoff_biosphere,
-            )
+            if self.checkbox_all.isChecked():
+                self.GSA.perform_GSA_batch(
+                    cutoff_technosphere=cutoff_technosphere,
+                    cutoff_biosphere=cutoff_biosphere,
+                    processes=os.cpu_count() or 1,
+                )
+                if not self.GSA.select(act_number, method_number):
+                    self.GSA.df_final = None
+            else:
+                self.GSA.results = dict()
+                self.GSA.perform_GSA(
+                    act_number=act_number,
+                    method_number=method_number,
+                    cutoff_technosphere=cutoff_technosphere,
+                    cutoff_biosphere=cutoff_biosphere,
+                )
             # self.update_mc()
         except Exception as e:  # Catch any error...
             log.error(e)
@@ -1685,20 +1714,37 @@ class GSATab(NewAnalysisTab):
 
         self.update_gsa()
 
-    def update_gsa(self, cs_name=None):
+    def select_gsa(self):
+        """Show the GSA of the selected reference flow and impact category if
+        it was calculated in the last run of all of them."""
+        if self.GSA.select(
+            self.combobox_fu.currentIndex(), self.combobox_methods.currentIndex()
+        ):
+            self.show_gsa()
+
+    def show_gsa(self):
         self.df = getattr(self.GSA, "df_final", None)
         if self.df is None:
-            return
+            return False
         self.update_table()
         self.table.show()
         self.export_widget.show()
 
         self.table.table_name = "gsa_output_" + self.GSA.get_save_name()
+        return True
+
+    def update_gsa(self, cs_name=None):
+        if not self.show_gsa():
+            return
 
         if self.checkbox_export_data_automatically.isChecked():
             log.info("EXPORTING DATA")
-            self.GSA.export_GSA_input()
-            self.GSA.export_GSA_output()
+            current = (self.GSA.act_number, self.GSA.method_number)
+            for key in self.GSA.results or [current]:
+                self.GSA.select(*key)
+                self.GSA.export_GSA_input()
+                self.GSA.export_GSA_output()
+            self.GSA.select(*current)
 
     def update_plot(self, method):
         pass
@@ -11,11 +11,13 @@ from activity_browser.mod import bw2data as bd
 from ...bwutils.errors import *
 from ...bwutils.superstructure import (SUPERSTRUCTURE, ABCSVImporter,
                                        ABFeatherImporter, ABPopup,
-                                       SuperstructureManager, _time_it_,
-                                       edit_superstructure_for_string,
-                                       import_from_excel,
+                                       ScenarioProduct, SuperstructureManager,
+                                       _time_it_, edit_superstructure_for_string,
+                                       file_digest, import_from_excel,
+                                       load_validated_scenarios,
                                        scenario_names_from_df,
-                                       scenario_replace_databases)
+                                       scenario_replace_databases,
+                                       store_validated_scenarios)
 from ...ui.icons import qicons
 from ...ui.style import header, horizontal_line, style_group_box
 from ...ui.tables import (CSActivityTable, CSList, CSMethodsTable,
@@ -517,21 +519,21 @@ class ScenarioImportPanel(BaseRightTab):
             filter="Excel (*.xlsx *.xls);; CSV (*.csv)",
         )
         print("Saving scenario dataframe to file: ", filepath)
-        scenarios = self._scenario_dataframe.columns.difference(
-            ["input", "output", "flow"]
-        )
+        scenario_df = self._scenario_dataframe
+        if isinstance(scenario_df, ScenarioProduct):
+            # the combined scenarios are only built in full for saving
+            scenario_df = scenario_df.to_frame()
+        scenarios = scenario_df.columns.difference(["input", "output", "flow"])
         superstructure = SUPERSTRUCTURE.tolist()
         cols = superstructure + scenarios.tolist()
 
-        savedf = pd.DataFrame(index=self._scenario_dataframe.index, columns=cols)
+        savedf = pd.DataFrame(index=scenario_df.index, columns=cols)
         for table in self.tables:
             indices = savedf.index.intersection(table.scenario_df.index)
             savedf.loc[indices, superstructure] = table.scenario_df.loc[
                 indices, superstructure
             ]
-            savedf.loc[indices, scenarios] = self._scenario_dataframe.loc[
-                indices, scenarios
-            ]
+            savedf.loc[indices, scenarios] = scenario_df.loc[indices, scenarios]
         if filepath.endswith(".xlsx") or filepath.endswith(".xls"):
             savedf.to_excel(filepath, index=False)
             return
@@ -588,69 +590,15 @@ class ScenarioImportWidget(QtWidgets.QWidget):
             try:
                 path = dialog.path
                 idx = dialog.import_sheet.currentIndex()
-                file_type_suffix = dialog.path.suffix
                 separator = dialog.field_separator.currentData()
                 log.debug("separator == '{}'".format(separator))
                 QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
-                log.info("Loading Scenario file. This may take a while for large files")
-                # Try and read as a superstructure file
-                # Choose a different routine for reading the file dependent on file type
-                if file_type_suffix == ".feather":
-                    df = ABFeatherImporter.read_file(path)
-                elif file_type_suffix.startswith(".xls"):
-                    df = import_from_excel(path, idx)
-                else:
-                    df = ABCSVImporter.read_file(path, separator=separator)
-                # Read in the file as a scenario flow table if the file is arranged as one
-                if len(df.columns.intersection(SUPERSTRUCTURE)) >= 12:
-                    if df is None:
-                        QtWidgets.QApplication.restoreOverrideCursor()
-                        return
-                    self.sync_superstructure(df)
-                # Read the file as a parameter scenario file if it is correspondingly arranged
-                elif len(df.columns.intersection({"Name", "Group"})) == 2:
-                    # Try and read as parameter scenario file.
-                    log.info(
-                        "Superstructure: Attempting to read as parameter scenario file."
-                    )
-
-                    if not df["Group"].dtype == object:
-                        df["Group"] = df["Group"].astype(str)
-
-                    include_default = True
-                    if "default" not in df.columns:
-                        query = QtWidgets.QMessageBox.question(
-                            self,
-                            "Default column not found",
-                            "Attempt to load and include the 'default' scenario column?",
-                            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
-                            QtWidgets.QMessageBox.No,
-                        )
-                        if query == QtWidgets.QMessageBox.No:
-                            include_default = False
-                    signals.parameter_scenario_sync.emit(
-                        self.index, df, include_default
-                    )
-                else:
-                    # this is a wrong file type
-                    msg = (
-                        "The Activity-Browser is attempting to import a scenario file.<p>During the attempted import"
-                        " another file type was detected. Please check the file type of the attempted import, if it is"
-                        " a scenario file make sure it contains a valid format.</p>"
-                        "<p>A flow exchange scenario file requires the following headers:<br>"
-                        + edit_superstructure_for_string(sep=", ", fhighlight='"')
-                        + "</p>"
-                        "<p>A parameter scenario file requires the following:<br>"
-                        + edit_superstructure_for_string(
-                            ["name", "group"], sep=", ", fhighlight='"'
-                        )
-                        + "</p>"
-                    )
-                    critical = ABPopup.abCritical(
-                        "Wrong file type", msg, QtWidgets.QPushButton("Cancel")
-                    )
-                    QtWidgets.QApplication.restoreOverrideCursor()
-                    critical.exec_()
+                digest = file_digest(path, idx, separator)
+                df = load_validated_scenarios(digest)
+                if df is not None:
+                    log.info("Loading validated scenario file from the cache")
+                    self.set_superstructure(df)
+                elif not self.read_scenario_file(path, idx, separator, digest):
                     return
             except CriticalScenarioExtensionError as e:
                 # Triggered when combining different scenario files by extension leads to no scenario columns
@@ -676,13 +624,80 @@ class ScenarioImportWidget(QtWidgets.QWidget):
             self._parent.save_button(True)
             QtWidgets.QApplication.restoreOverrideCursor()
 
+    def read_scenario_file(self, path, idx: int, separator: str, digest: str) -> bool:
+        """Read a scenario file as a flow exchange or a parameter scenario
+        file, returns False if the file is of neither type.
+        """
+        log.info("Loading Scenario file. This may take a while for large files")
+        # Try and read as a superstructure file
+        # Choose a different routine for reading the file dependent on file type
+        if path.suffix == ".feather":
+            df = ABFeatherImporter.read_file(path)
+        elif path.suffix.startswith(".xls"):
+            df = import_from_excel(path, idx)
+        else:
+            df = ABCSVImporter.read_file(path, separator=separator)
+        # Read in the file as a scenario flow table if the file is arranged as one
+        if len(df.columns.intersection(SUPERSTRUCTURE)) >= 12:
+            if df is None:
+                QtWidgets.QApplication.restoreOverrideCursor()
+                return False
+            self.sync_superstructure(df, digest)
+        # Read the file as a parameter scenario file if it is correspondingly arranged
+        elif len(df.columns.intersection({"Name", "Group"})) == 2:
+            # Try and read as parameter scenario file.
+            log.info("Superstructure: Attempting to read as parameter scenario file.")
+
+            if not df["Group"].dtype == object:
+                df["Group"] = df["Group"].astype(str)
+
+            include_default = True
+            if "default" not in df.columns:
+                query = QtWidgets.QMessageBox.question(
+                    self,
+                    "Default column not found",
+                    "Attempt to load and include the 'default' scenario column?",
+                    QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+                    QtWidgets.QMessageBox.No,
+                )
+                if query == QtWidgets.QMessageBox.No:
+                    include_default = False
+            signals.parameter_scenario_sync.emit(self.index, df, include_default)
+        else:
+            # this is a wrong file type
+            msg = (
+                "The Activity-Browser is attempting to import a scenario file.<p>During the attempted import"
+                " another file type was detected. Please check the file type of the attempted import, if it is"
+                " a scenario file make sure it contains a valid format.</p>"
+                "<p>A flow exchange scenario file requires the following headers:<br>"
+                + edit_superstructure_for_string(sep=", ", fhighlight='"')
+                + "</p>"
+                "<p>A parameter scenario file requires the following:<br>"
+                + edit_superstructure_for_string(
+                    ["name", "group"], sep=", ", fhighlight='"'
+                )
+                + "</p>"
+            )
+            critical = ABPopup.abCritical(
+                "Wrong file type", msg, QtWidgets.QPushButton("Cancel")
+            )
+            QtWidgets.QApplication.restoreOverrideCursor()
+            critical.exec_()
+            return False
+        return True
+
     @_time_it_
-    def sync_superstructure(self, df: pd.DataFrame) -> None:
+    def sync_superstructure(self, df: pd.DataFrame, digest: str = None) -> None:
         """synchronizes the contents of either a single, or multiple scenario files to create a single scenario
-        dataframe"""
+        dataframe
+
+        With the `digest` of the scenario file, the validated dataframe is
+        cached unless its databases had to be relinked."""
         # TODO: Move the 'scenario_df' into the model itself.
         QtWidgets.QApplication.restoreOverrideCursor()
-        df = self.scenario_db_check(df)
+        checked = self.scenario_db_check(df)
+        relinked = checked is not df
+        df = checked
         QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
         df = SuperstructureManager.fill_empty_process_keys_in_exchanges(df)
         SuperstructureManager.verify_scenario_process_keys(df)
@@ -691,6 +706,13 @@ class ScenarioImportWidget(QtWidgets.QWidget):
         # If we've cancelled the import then we don't want to load the dataframe
         if df.empty:
             return
+        df = SuperstructureManager.format_dataframe(df)
+        self.set_superstructure(df)
+        if digest and not relinked:
+            store_validated_scenarios(digest, df)
+
+    def set_superstructure(self, df: pd.DataFrame) -> None:
+        """Show a validated scenario dataframe in this table."""
         self.scenario_df = df
         cols = scenario_names_from_df(self.scenario_df)
         self.table.model.sync(cols)
@@ -427,18 +427,110 @@ class BaseTreeModel(QAbstractItemModel):
 
 
 class ABSortProxyModel(QSortFilterProxyModel):
-    """Reimplementation to allow for sorting on the actual data in cells instead of the visible data.
+    """Reimplementation to allow for sorting on the actual data in cells
+    instead of the visible data.
 
-    See this for context: https://github.com/LCA-ActivityBrowser/activity-browser/pull/1151
+    See this for context:
+    https://github.com/LCA-ActivityBrowser/activity-browser/pull/1151
+
+    For a `PandasModel` the rank of every row in a column is computed once
+    with pandas, comparisons then only compare the ranks of the rows. This
+    sorts a column of 20k rows well within a second, comparing the cells took
+    several seconds. Columns that cannot be ranked this way are compared cell
+    by cell.
     """
 
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # the rank of every source row, by column
+        self._ranks = {}
+
+    def setSourceModel(self, model) -> None:
+        self._ranks.clear()
+        previous = self.sourceModel()
+        if previous is not None:
+            for signal in self.rank_signals(previous):
+                try:
+                    signal.disconnect(self.clear_ranks)
+                except (RuntimeError, TypeError):
+                    # the previous model was never connected or is already deleted
+                    pass
+        super().setSourceModel(model)
+        if model is not None:
+            for signal in self.rank_signals(model):
+                signal.connect(self.clear_ranks)
+
+    @staticmethod
+    def rank_signals(model) -> tuple:
+        """The signals of the source model after which the ranks are outdated."""
+        return (
+            model.dataChanged,
+            model.modelReset,
+            model.layoutChanged,
+            model.rowsInserted,
+            model.rowsRemoved,
+        )
+
+    def clear_ranks(self, *args) -> None:
+        self._ranks.clear()
+
+    def column_ranks(self, column: int) -> Optional[list]:
+        """Return the rank of every source row in the column, or None if the
+        column cannot be ranked.
+        """
+        df = getattr(self.sourceModel(), "_dataframe", None)
+        if df is None:
+            return None
+        ranks = self._ranks.get(column)
+        if column not in self._ranks or (ranks is not None and len(ranks) != len(df)):
+            ranks = self.rank_values(df.iloc[:, column])
+            self._ranks[column] = ranks
+        return ranks
+
+    @staticmethod
+    def rank_values(series: pd.Series) -> Optional[list]:
+        """Rank the values of the series the way `lessThan` compares them:
+        tuples are compared as strings, empty values as 0 among numbers and as
+        "" among strings. Equal values share a rank so the sorting stays stable
+        and NaN values are ranked last. Returns None if the values are not of
+        comparable types.
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # rank the categories like the values they stand for
+            series = series.astype(object)
+        if series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+            series = series.map(lambda x: str(x) if isinstance(x, tuple) else x)
+            empty = series.map(
+                lambda x: x is None or (x is not pd.NA and not x)
+            ).astype(bool)
+            kind = pd.api.types.infer_dtype(series[~empty], skipna=True)
+            if kind in ("string", "empty"):
+                series = series.where(~empty, "")
+            elif kind in ("integer", "floating", "mixed-integer-float", "boolean"):
+                series = pd.to_numeric(series.where(~empty, 0))
+            else:
+                return None
+        elif not (
+            pd.api.types.is_numeric_dtype(series)
+            or pd.api.types.is_datetime64_any_dtype(series)
+        ):
+            return None
+        return series.rank(method="min", na_option="bottom").tolist()
+
     def lessThan(self, left: QModelIndex, right: QModelIndex) -> bool:
         """Override to sort actual data, expects `left` and `right` are comparable.
 
-        If `left` and `right` are not the same type, we check if numerical and empty string are compared, if that is the
-        case, we assume empty string == 0.
-        Added this case for: https://github.com/LCA-ActivityBrowser/activity-browser/issues/1215
+        If `left` and `right` are not the same type, we check if numerical and
+        empty string are compared, if that is the case, we assume empty
+        string == 0.
+        Added this case for:
+        https://github.com/LCA-ActivityBrowser/activity-browser/issues/1215
         """
+        # the ranks are looked up directly as this is called for every comparison
+        ranks = self._ranks.get(left.column()) or self.column_ranks(left.column())
+        if ranks is not None:
+            return ranks[left.row()] < ranks[right.row()]
+
         left_data = self.sourceModel().data(left, "sorting")
         right_data = self.sourceModel().data(right, "sorting")
 
@@ -455,7 +547,8 @@ class ABSortProxyModel(QSortFilterProxyModel):
         if (isinstance(left_data, str)
                 and not right_data
         ):  # comparing left str with nothing, compare against "" instead
-            return left_data < ""  # note we use '>' instead of '<', content should be above empty fields
+            # note we use '>' instead of '<', content should be above empty fields
+            return left_data < ""
         if (isinstance(right_data, (int, float))
                 and not left_data
         ):  # comparing right number with nothing, compare against '0' instead
@@ -463,7 +556,8 @@ class ABSortProxyModel(QSortFilterProxyModel):
         if (isinstance(right_data, str)
                 and not left_data
         ):  # comparing right str with nothing, compare against "" instead
-            return right_data < ""  # note we use '>' instead of '<', content should be above empty fields
+            # note we use '>' instead of '<', content should be above empty fields
+            return right_data < ""
 
         raise ValueError(
             f"Cannot compare {left_data} and {right_data}, incompatible types."
@@ -134,7 +134,7 @@ class ActivitiesBiosphereListModel(DragPandasModel):
             df = df.loc[mask].reset_index(drop=True)
 
         # remove empty columns
-        df.replace("", np.nan, inplace=True)
+        df = df.mask(df == "")
         df.dropna(how="all", axis=1, inplace=True)
         self._dataframe = df.reset_index(drop=True)
         self.filterable_columns = {
@@ -161,13 +161,20 @@ class ActivitiesBiosphereListModel(DragPandasModel):
         search_columns = (bc.bw_keys_to_AB_names.get(c, c) for c in self.fields)
         mask = functools.reduce(
             np.logical_or,
-            [
-                df[col].apply(lambda x: pattern.lower() in str(x).lower())
-                for col in search_columns
-            ],
+            [self._contains(df[col], pattern.lower()) for col in search_columns],
         )
         return mask
 
+    @staticmethod
+    def _contains(column: pd.Series, pattern: str) -> pd.Series:
+        """Return a mask that is True where the pattern is found in the column."""
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # test every distinct value only once, the extra False is picked by the -1 code of empty cells
+            found = [pattern in str(x).lower() for x in column.cat.categories]
+            found = np.array(found + [False], dtype=bool)
+            return pd.Series(found[column.cat.codes], index=column.index)
+        return column.apply(lambda x: pattern in str(x).lower())
+
     def copy_exchanges_for_SDF(self, proxies: list) -> None:
         if len(proxies) > 1:
             keys = {self.get_key(p) for p in proxies}
@@ -342,7 +349,7 @@ class ActivitiesBiosphereTreeModel(BaseTreeModel):
 
         QApplication.setOverrideCursor(Qt.WaitCursor)
         # remove empty columns
-        df.replace("", np.nan, inplace=True)
+        df = df.mask(df == "")
         df.dropna(how="all", axis=1, inplace=True)
         df["tree_order"] = df.apply(lambda row: self.tree_order(row), axis=1)
         df["tree_path_tuple"] = df.apply(lambda row: self.tree_path_tuple(row), axis=1)
@@ -10,6 +10,7 @@ from PySide2 import QtWidgets
 from PySide2.QtCore import QModelIndex, Slot
 
 from activity_browser import actions, application
+from activity_browser.bwutils.utils import ParameterActivities
 from activity_browser.mod import bw2data as bd
 from activity_browser.mod.bw2data.parameters import (ActivityParameter,
                                                      DatabaseParameter, Group,
@@ -214,14 +215,15 @@ class ActivityParameterModel(BaseParameterModel):
 
     def sync(self) -> None:
         """Build a dataframe using the ActivityParameters set in brightway"""
-        generate = (
-            self.parse_parameter(p)
-            for p in (
-                ActivityParameter.select(ActivityParameter, Group.order)
-                .join(Group, on=(ActivityParameter.group == Group.name))
-                .namedtuples()
-            )
+        rows = list(
+            ActivityParameter.select(ActivityParameter, Group.order)
+            .join(Group, on=(ActivityParameter.group == Group.name))
+            .namedtuples()
         )
+        # Read all activities and parameters at once instead of for every row
+        activities = ParameterActivities((p.database, p.code) for p in rows)
+        parameters = {p.id: p for p in ActivityParameter.select()}
+        generate = (self.parse_parameter(p, activities, parameters) for p in rows)
         data = [x for x in generate if "key" in x]
         self._dataframe = pd.DataFrame(data, columns=self.columns())
         # Convert the 'order' column from list into string
@@ -234,14 +236,29 @@ class ActivityParameterModel(BaseParameterModel):
         self.updated.emit()
 
     @classmethod
-    def parse_parameter(cls, parameter) -> dict:
-        """Override the base method to add more steps."""
+    def parse_parameter(
+        cls,
+        parameter,
+        activities: ParameterActivities = None,
+        parameters: dict = None,
+    ) -> dict:
+        """Override the base method to add more steps.
+
+        The activity and ActivityParameter of the row are taken from
+        `activities` and `parameters` if given, otherwise they are read from
+        the database.
+        """
         row = super().parse_parameter(parameter)
         # Combine the 'database' and 'code' fields of the parameter into a 'key'
         row["key"] = (parameter.database, parameter.code)
-        try:
-            act = bd.get_activity(row["key"])
-        except:
+        if activities is not None:
+            act = activities.activity(row["key"])
+        else:
+            try:
+                act = bd.get_activity(row["key"])
+            except:
+                act = None
+        if act is None:
             # Can occur if an activity parameter exists for a removed activity.
             log.info(
                 "Activity {} no longer exists, removing parameter.".format(row["key"])
@@ -252,7 +269,10 @@ class ActivityParameterModel(BaseParameterModel):
         row["activity"] = act.get("name")
         row["location"] = act.get("location", "unknown")
         # Replace the namedtuple with the actual ActivityParameter
-        row["parameter"] = ActivityParameter.get_by_id(parameter.id)
+        if parameters is not None and parameter.id in parameters:
+            row["parameter"] = parameters[parameter.id]
+        else:
+            row["parameter"] = ActivityParameter.get_by_id(parameter.id)
         return row
 
     def get_activity_groups(self, proxy, ignore_groups: list = None) -> Iterable[str]:
@@ -311,7 +331,9 @@ class ParameterItem(TreeItem):
         return item
 
     @classmethod
-    def build_item(cls, param, parent: TreeItem) -> "ParameterItem":
+    def build_item(
+        cls, param, parent: TreeItem, activities: ParameterActivities = None
+    ) -> "ParameterItem":
         """Depending on the parameter type, the group is changed, defaults to
         'project'.
 
@@ -342,21 +364,35 @@ class ParameterItem(TreeItem):
 
         # If the variable is found, we're working on an activity parameter
         if "database" in locals():
-            cls.build_exchanges(param, item)
+            cls.build_exchanges(param, item, activities)
 
         parent.appendChild(item)
         return item
 
     @classmethod
-    def build_exchanges(cls, act_param, parent: TreeItem) -> None:
+    def build_exchanges(
+        cls, act_param, parent: TreeItem, activities: ParameterActivities = None
+    ) -> None:
         """Take the given activity parameter, retrieve the matching activity
         and construct tree-items for each exchange with a `formula` field.
-        """
-        act = bd.get_activity((act_param.database, act_param.code))
 
-        for exc in [exc for exc in act.exchanges() if "formula" in exc]:
+        The exchanges and their inputs are taken from `activities` if given.
+        """
+        key = (act_param.database, act_param.code)
+        if activities is None:
+            act = bd.get_activity(key)
+            exchanges = [exc for exc in act.exchanges() if "formula" in exc]
+        else:
+            exchanges = activities.exchanges(key)
+
+        for exc in exchanges:
             try:
-                act_input = bd.get_activity(exc.input)
+                if activities is None:
+                    act_input = bd.get_activity(exc.input)
+                else:
+                    act_input = activities.activity(exc["input"])
+                    if act_input is None:
+                        raise DoesNotExist(exc["input"])
                 item = cls(
                     [
                         act_input.get("name"),
@@ -405,12 +441,13 @@ class ParameterTreeModel(BaseTreeModel):
             ParameterItem.build_item(param, self.root)
         for param in self._data.get("database", []):
             ParameterItem.build_item(param, self.root)
-        for param in self._data.get("activity", []):
-            try:
-                _ = bd.get_activity((param.database, param.code))
-            except:
+        params = list(self._data.get("activity", []))
+        # Read the activities and exchanges of all parameters at once
+        activities = ParameterActivities((p.database, p.code) for p in params)
+        for param in params:
+            if activities.activity((param.database, param.code)) is None:
                 continue
-            ParameterItem.build_item(param, self.root)
+            ParameterItem.build_item(param, self.root, activities)
 
     def sync(self, *args, **kwargs) -> None:
         self.beginResetModel()
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""Entry points of the worker processes of the Activity Browser.
+
+Worker processes are spawned, so everything they are given is imported
+again in a new interpreter. Importing `activity_browser` starts the Qt
+application, which is why the modules of this package only depend on
+numpy, scipy and brightway and must never import from `activity_browser`.
+"""
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+from logging import getLogger
+from typing import Optional, Union
+
+import bw2calc as bc
+import bw2data as bd
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, bicgstab, factorized, spsolve
+from stats_arrays import MCRandomNumberGenerator
+
+log = getLogger(__name__)
+
+
+class SampleStore(object):
+    """Chunked on-disk store of the values sampled in a Monte Carlo run.
+
+    Every chunk of iterations is written to its own memory-mapped `.npy`
+    file in `directory`, holding one row of sampled values per iteration.
+    Chunks are named after the position of their first iteration, so they
+    can be written by different processes and are read back in order.
+
+    An index with the matrix (row, col, type) of every value can be stored,
+    so that matrix cells can be read back from the values with `cells`.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self._chunk: Optional[np.memmap] = None
+        self._position = 0
+
+    def _path(self, part: str) -> str:
+        return os.path.join(self.directory, f"{self.name}_{part}.npy")
+
+    @property
+    def chunk_paths(self) -> list:
+        return sorted(glob.glob(self._path("[0-9]" * 9)))
+
+    def start_chunk(self, offset: int, iterations: int, length: int) -> None:
+        """Start writing a chunk of `iterations` rows of `length` values."""
+        self._chunk = np.lib.format.open_memmap(
+            self._path(f"{offset:09d}"),
+            mode="w+",
+            dtype=np.float64,
+            shape=(iterations, length),
+        )
+        self._position = 0
+
+    def append(self, values: np.ndarray) -> None:
+        """Write the values of the next iteration of the current chunk."""
+        self._chunk[self._position] = values
+        self._position += 1
+        if self._position == len(self._chunk):
+            self._chunk.flush()
+            self._chunk = None
+
+    def write_index(self, index: np.ndarray) -> None:
+        np.save(self._path("index"), index)
+
+    def columns(self, positions) -> np.ndarray:
+        """Return the values at the given positions for every iteration."""
+        chunks = [np.load(path, mmap_mode="r") for path in self.chunk_paths]
+        return np.vstack([chunk[:, positions] for chunk in chunks])
+
+    def matrices(self, shape: tuple) -> list:
+        """Return the matrix of every iteration, built from the values like
+        the LCA builds its matrices, see `cells`.
+        """
+        index = np.load(self._path("index"))
+        signs = np.where(index["type"] == 1, -1.0, 1.0)
+        cells = (index["row"], index["col"])
+        return [
+            sparse.csr_matrix((values * signs, cells), shape=shape)
+            for values in self.columns(slice(None))
+        ]
+
+    def cells(self, indices: list) -> np.ndarray:
+        """Return the matrix values at the (row, col) `indices` for every
+        iteration.
+
+        As in the matrices, values of the same cell are summed and
+        technosphere inputs (type 1) are negated.
+        """
+        index = np.load(self._path("index"))
+        keys = (index["row"].astype(np.int64) << 32) | index["col"]
+        wanted = np.array([(int(r) << 32) | int(c) for r, c in indices], np.int64)
+        unique, inverse = np.unique(wanted, return_inverse=True)
+        positions = np.flatnonzero(np.isin(keys, unique))
+        signs = np.where(index["type"][positions] == 1, -1.0, 1.0)
+        # sums the values of every position into the column of its cell
+        rows = np.arange(len(positions))
+        cols = np.searchsorted(unique, keys[positions])
+        to_cells = sparse.csr_matrix(
+            (signs, (rows, cols)), shape=(len(positions), len(unique))
+        )
+        values = (to_cells.T @ self.columns(positions).T).T
+        return values[:, inverse]
+
+
+class MonteCarloIterations(object):
+    """The Monte Carlo iterations of an LCA for multiple reference flows and
+    methods.
+
+    Samples the technosphere, biosphere and characterization factors of every
+    iteration, stores the sampled values in `SampleStore`s and calculates
+    the scores of every reference flow and method. Parameterized exchanges
+    are sampled elsewhere and are given to `run_iterations` as overrides of
+    the sampled values, see `MonteCarloLCA` of the Activity Browser.
+    """
+
+    # Default relative tolerance of the iterative solver
+    SOLVER_TOLERANCE = 1e-8
+
+    def __init__(self, func_units: list, methods: list):
+        self.seed = None
+        self.cf_rngs = {}
+        self.cf_params = {}
+        self.include_technosphere = True
+        self.include_biosphere = True
+        self.include_cfs = True
+        self.include_parameters = True
+        self.param_cols = ["row", "col", "type"]
+
+        # Iterative solver, preconditioned with the static technosphere
+        self.iterative_solver = False
+        self.solver_tolerance = self.SOLVER_TOLERANCE
+        self.preconditioner: Optional[LinearOperator] = None
+        self.static_supplies = []
+        self.supplies = []
+
+        self.tech_rng: Optional[Union[MCRandomNumberGenerator, np.ndarray]] = None
+        self.bio_rng: Optional[Union[MCRandomNumberGenerator, np.ndarray]] = None
+
+        # reference flows
+        self.func_units = func_units
+        self.rev_fu_index = {i: fu for i, fu in enumerate(self.func_units)}
+
+        # methods
+        self.methods = methods
+        self.method_index = {m: i for i, m in enumerate(self.methods)}
+        self.rev_method_index = {i: m for i, m in enumerate(self.methods)}
+
+        # sampled values are stored on disk
+        self.tech_samples: Optional[SampleStore] = None
+        self.bio_samples: Optional[SampleStore] = None
+        self.cf_samples = {}
+
+        self.lca = bc.LCA(demand=self.func_units_dict, method=self.methods[0])
+
+    @property
+    def func_units_dict(self) -> dict:
+        """Return a dictionary of reference flows (key, demand)."""
+        return {key: 1 for func_unit in self.func_units for key in func_unit}
+
+    def load_data(self) -> None:
+        """Constructs the random number generators for all of the matrices that
+        can be altered by uncertainty.
+
+        If any of these uncertain calculations are not included, the initial
+        amounts of the 'params' matrices are used in place of generating
+        a vector
+        """
+        self.lca.load_lci_data()
+
+        # we need the cf_params of every impact category, because they are of different size
+        self.cf_params = {}
+        if self.lca.lcia:
+            for m in self.methods:
+                self.lca.switch_method(m)
+                self.lca.load_lcia_data()
+                self.cf_params[m] = self.lca.cf_params.copy()
+
+        (
+            self.lca.activity_dict_rev,
+            self.lca.product_dict_rev,
+            self.lca.biosphere_dict_rev,
+        ) = self.lca.reverse_dict()
+
+        if self.iterative_solver:
+            self.prepare_iterative_solver()
+
+        self.seed_generators(self.seed)
+
+    def prepare_iterative_solver(self) -> None:
+        """Factorize the static technosphere matrix to precondition the
+        iterative solver with, and solve the static supply of every
+        reference flow as the starting point of the iterations.
+        """
+        solve = factorized(self.lca.technosphere_matrix.tocsc())
+        self.preconditioner = LinearOperator(
+            self.lca.technosphere_matrix.shape, matvec=solve
+        )
+        self.static_supplies = []
+        for func_unit in self.func_units:
+            self.lca.build_demand_array(func_unit)
+            self.static_supplies.append(solve(self.lca.demand_array))
+
+    def solve_iterative(self, row: int, func_unit: dict) -> None:
+        """Solve the supply of a reference flow with an iterative solver that
+        is warm-started from the previous supply of the reference flow.
+
+        Falls back to a direct solve when the solver does not converge, the
+        supply and inventory are set on the LCA object as `redo_lci` would.
+        """
+        self.lca.build_demand_array(func_unit)
+        demand = self.lca.demand_array
+        matrix = self.lca.technosphere_matrix
+        tolerance = self.solver_tolerance
+        kwargs = {"x0": self.supplies[row], "M": self.preconditioner, "atol": 0.0}
+        try:
+            supply, info = bicgstab(matrix, demand, rtol=tolerance, **kwargs)
+        except TypeError:
+            # scipy < 1.12
+            supply, info = bicgstab(matrix, demand, tol=tolerance, **kwargs)
+        if info != 0:
+            log.debug(f"Iterative solver did not converge ({info}), solving directly.")
+            supply = spsolve(matrix.tocsc(), demand)
+        self.supplies[row] = supply
+        self.lca.supply_array = supply
+        self.lca.inventory = self.lca.biosphere_matrix @ sparse.diags(supply)
+
+    def seed_generators(self, seed: Optional[int]) -> None:
+        """(Re)create the random number generators, all drawing from a stream
+        started with the given seed.
+        """
+        self.tech_rng = (
+            MCRandomNumberGenerator(self.lca.tech_params, seed=seed)
+            if self.include_technosphere
+            else self.lca.tech_params["amount"].copy()
+        )
+        self.bio_rng = (
+            MCRandomNumberGenerator(self.lca.bio_params, seed=seed)
+            if self.include_biosphere
+            else self.lca.bio_params["amount"].copy()
+        )
+        self.cf_rngs = {
+            m: (
+                MCRandomNumberGenerator(params, seed=seed)
+                if self.include_cfs
+                else params["amount"].copy()
+            )
+            for m, params in self.cf_params.items()
+        }
+
+    def set_solver(self, iterative: bool = False, tolerance: float = None) -> None:
+        """Choose between the direct solver and the preconditioned iterative
+        solver for the Monte Carlo iterations.
+        """
+        self.iterative_solver = iterative
+        self.solver_tolerance = tolerance or self.SOLVER_TOLERANCE
+
+    def set_includes(
+        self, technosphere=True, biosphere=True, cf=True, parameters=True, **kwargs
+    ) -> None:
+        """Set which uncertainties are included in the Monte Carlo sampling."""
+        self.include_technosphere = technosphere
+        self.include_biosphere = biosphere
+        self.include_cfs = cf
+        self.include_parameters = parameters
+
+    @property
+    def includes(self) -> dict:
+        return {
+            "technosphere": self.include_technosphere,
+            "biosphere": self.include_biosphere,
+            "cf": self.include_cfs,
+            "parameters": self.include_parameters,
+        }
+
+    def open_sample_stores(self, directory: str) -> None:
+        self.tech_samples = SampleStore(directory, "technosphere")
+        self.bio_samples = SampleStore(directory, "biosphere")
+        self.cf_samples = {
+            m: SampleStore(directory, f"cf_{i}") for i, m in enumerate(self.methods)
+        }
+
+    def run_iterations(
+        self, results: np.ndarray, offset: int, overrides: Optional[list] = None
+    ) -> None:
+        """Perform an iteration for every row of the `results` array and
+        store the scores in it, `offset` is the number of the first
+        iteration in the whole run.
+
+        The `overrides` are, per iteration, the positions and values of the
+        technosphere and biosphere params that replace the sampled values,
+        as (tech positions, tech values, bio positions, bio values).
+        """
+        # every run starts from the static supply, so the results do not
+        # depend on how the iterations are divided
+        self.supplies = list(self.static_supplies)
+
+        # sampled values are stored for GSA
+        iterations = len(results)
+        if offset == 0:
+            self.tech_samples.write_index(self.lca.tech_params[self.param_cols])
+            self.bio_samples.write_index(self.lca.bio_params[self.param_cols])
+        self.tech_samples.start_chunk(offset, iterations, len(self.lca.tech_params))
+        self.bio_samples.start_chunk(offset, iterations, len(self.lca.bio_params))
+        for m in self.methods:
+            self.cf_samples[m].start_chunk(offset, iterations, len(self.cf_params[m]))
+
+        for iteration in range(iterations):
+            tech_vector = (
+                self.tech_rng.next()
+                if self.include_technosphere
+                else self.tech_rng.copy()
+            )
+            bio_vector = (
+                self.bio_rng.next() if self.include_biosphere else self.bio_rng.copy()
+            )
+            if overrides is not None:
+                tech_idx, tech_values, bio_idx, bio_values = overrides[iteration]
+                tech_vector[tech_idx] = tech_values
+                bio_vector[bio_idx] = bio_values
+
+            self.lca.rebuild_technosphere_matrix(tech_vector)
+            self.lca.rebuild_biosphere_matrix(bio_vector)
+
+            # store sampled values for GSA
+            self.tech_samples.append(tech_vector)
+            self.bio_samples.append(bio_vector)
+
+            if not self.iterative_solver:
+                if not hasattr(self.lca, "demand_array"):
+                    self.lca.build_demand_array()
+                self.lca.lci_calculation()
+
+            # pre-calculating CF vectors enables the use of the SAME CF vector for each FU in a given run
+            cf_vectors = {}
+            for m in self.methods:
+                cf_vectors[m] = (
+                    self.cf_rngs[m].next() if self.include_cfs else self.cf_rngs[m]
+                )
+                # store CFs for GSA
+                self.cf_samples[m].append(cf_vectors[m])
+
+            # iterate over FUs
+            for row, func_unit in self.rev_fu_index.items():
+                if self.iterative_solver:
+                    self.solve_iterative(row, func_unit)
+                else:
+                    self.lca.redo_lci(func_unit)  # lca calculation
+
+                # iterate over methods
+                for col, m in self.rev_method_index.items():
+                    self.lca.switch_method(m)
+                    self.lca.rebuild_characterization_matrix(cf_vectors[m])
+                    self.lca.lcia_calculation()
+                    results[iteration, row, col] = self.lca.score
+
+
+def open_project(base_dir: str, project: str) -> None:
+    """Open the project in the brightway directory used by the Activity
+    Browser, which can differ from the default directory.
+    """
+    if bd.projects._base_data_dir != base_dir:
+        bd.projects._base_data_dir = base_dir
+        bd.projects._base_logs_dir = os.path.join(base_dir, "logs")
+        bd.projects.db.change_path(os.path.join(base_dir, "projects.db"))
+    # workers only read from the project
+    bd.projects.set_current(project, writable=False, update=False)
+
+
+# The Monte Carlo iterations of a worker process
+_worker_mc: Optional[MonteCarloIterations] = None
+
+
+def init_worker(
+    base_dir: str,
+    project: str,
+    func_units: list,
+    methods: list,
+    includes: dict,
+    solver: tuple,
+    directory: str,
+) -> None:
+    """Load the LCA data once for every worker process."""
+    global _worker_mc
+    open_project(base_dir, project)
+    _worker_mc = MonteCarloIterations(func_units, methods)
+    _worker_mc.set_includes(**includes)
+    _worker_mc.set_solver(*solver)
+    _worker_mc.open_sample_stores(directory)
+    _worker_mc.load_data()
+
+
+def calculate_chunk(chunk: tuple) -> np.ndarray:
+    """Calculate a chunk of (offset, iterations, seed, overrides) in a worker
+    process and return the scores of these iterations, the sampled values
+    are written to the sample stores directly.
+    """
+    offset, size, seed, overrides = chunk
+    mc = _worker_mc
+    results = np.zeros((size, len(mc.func_units), len(mc.methods)))
+    mc.seed_generators(seed)
+    mc.run_iterations(results, offset, overrides)
+    return results
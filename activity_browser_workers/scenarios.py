@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import atexit
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Union
+
+import numpy as np
+from scipy import sparse
+
+try:
+    # the solver bw2calc uses when it is installed
+    from pypardiso import factorized
+except ImportError:
+    from scipy.sparse.linalg import factorized
+
+
+class ScenarioCombiner(object):
+    """Builds the values of the combined scenarios of several scenario files
+    from the values of the separate files, see `ScenarioProduct` of the
+    Activity Browser for the meaning of the arrays.
+    """
+
+    def __init__(
+        self,
+        combinations: np.ndarray,
+        owned: List[np.ndarray],
+        blocks: List[np.ndarray],
+        keep: np.ndarray,
+        technosphere: np.ndarray,
+        production: np.ndarray,
+        defaults: np.ndarray,
+    ):
+        self.combinations = combinations
+        self.owned = owned
+        self.blocks = blocks
+        self.keep = keep
+        self.technosphere = technosphere
+        self.production = production
+        self.defaults = defaults
+        self.size = sum(len(rows) for rows in owned)
+
+    @property
+    def scenarios(self) -> int:
+        return len(self.combinations)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Return the arrays of the combiner by name, see `from_arrays`."""
+        arrays = {
+            "combinations": self.combinations,
+            "keep": self.keep,
+            "technosphere": self.technosphere,
+            "production": self.production,
+            "defaults": self.defaults,
+        }
+        for i, (rows, block) in enumerate(zip(self.owned, self.blocks)):
+            arrays[f"owned {i}"] = rows
+            arrays[f"block {i}"] = block
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "ScenarioCombiner":
+        """Build the combiner from the arrays returned by `arrays`."""
+        files = range(arrays["combinations"].shape[1])
+        return cls(
+            arrays["combinations"],
+            [arrays[f"owned {i}"] for i in files],
+            [arrays[f"block {i}"] for i in files],
+            arrays["keep"],
+            arrays["technosphere"],
+            arrays["production"],
+            arrays["defaults"],
+        )
+
+    def column(self, position: int) -> np.ndarray:
+        """Return the values of all combined flows of the combined scenario
+        at `position`.
+        """
+        raw = np.full(self.size, np.nan)
+        files = zip(self.owned, self.blocks, self.combinations[position])
+        for rows, block, col in files:
+            raw[rows] = block[:, col]
+        production = np.where(
+            self.production >= 0, raw[self.production], self.defaults
+        )
+        denominator = production + raw[self.technosphere]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # if we did divide by 0 then use 0
+            merged = np.where(denominator == 0, 0, production / denominator)
+        return np.concatenate([raw[self.keep], merged])
+
+
+class ScenarioValues(object):
+    """Stand-in for the (exchanges x scenarios) values of an LCA matrix that
+    are taken from combined scenarios.
+
+    Only whole scenarios can be taken, with `values[:, scenario]`, which are
+    built by the `combiner` when asked for. `rows` are the positions of the
+    exchanges in the combined flows. Like the prepared values, inputs are
+    made negative and absent values are replaced by `defaults`.
+    """
+
+    def __init__(
+        self,
+        combiner: ScenarioCombiner,
+        rows: np.ndarray,
+        signs: np.ndarray,
+        defaults: np.ndarray,
+    ):
+        self.combiner = combiner
+        self.rows = rows
+        self.signs = signs
+        self.defaults = defaults
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.rows), self.combiner.scenarios
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Return the arrays of the values and their combiner by name, so they
+        can be shared with other processes, see `from_arrays`."""
+        arrays = {f"combiner {k}": v for k, v in self.combiner.arrays().items()}
+        arrays.update(rows=self.rows, signs=self.signs, defaults=self.defaults)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "ScenarioValues":
+        """Build the values from the arrays returned by `arrays`."""
+        prefix = "combiner "
+        combiner = ScenarioCombiner.from_arrays(
+            {k[len(prefix) :]: v for k, v in arrays.items() if k.startswith(prefix)}
+        )
+        return cls(combiner, arrays["rows"], arrays["signs"], arrays["defaults"])
+
+    def __getitem__(self, item: tuple) -> np.ndarray:
+        rows, scenario = item
+        values = self.combiner.column(scenario)[self.rows] * self.signs
+        missing = np.isnan(values)
+        values[missing] = self.defaults[missing]
+        return values[rows]
+
+
+class SharedArray(object):
+    """A numpy array in shared memory, which can be attached to by other
+    processes through its `spec`.
+    """
+
+    def __init__(self, shm: SharedMemory, shape: tuple, dtype: str):
+        self.shm = shm
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, array: np.ndarray) -> "SharedArray":
+        """Copy the array into a new block of shared memory."""
+        shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = cls(shm, array.shape, array.dtype.str)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec: tuple) -> "SharedArray":
+        """Attach to a shared array created by another process.
+
+        The creating process owns the memory and unlinks it, so the attached
+        memory is not registered with the resource tracker. Otherwise it is
+        reported as leaked, or unlinked, when the attaching process exits.
+        """
+        name, shape, dtype = spec
+        if sys.version_info >= (3, 13):
+            return cls(SharedMemory(name=name, track=False), shape, dtype)
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            shm = SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+        return cls(shm, shape, dtype)
+
+    @property
+    def spec(self) -> tuple:
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    def close(self) -> None:
+        del self.array
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.shm.unlink()
+
+
+# The shared arrays, technosphere matrix and scenario values of a worker process
+_worker_arrays: dict = {}
+
+
+def init_worker(specs: dict, shape: tuple) -> None:
+    """Attach to the shared arrays once for every worker process.
+
+    The scenario values are either shared as the dense "values" array, or as
+    the arrays of `ScenarioValues`, prefixed with "values ".
+    """
+    _worker_arrays.update(
+        {name: SharedArray.attach(spec) for name, spec in specs.items()}
+    )
+    atexit.register(close_worker)
+    arrays = {name: shared.array for name, shared in _worker_arrays.items()}
+    _worker_arrays["technosphere"] = sparse.csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]), shape=shape
+    )
+    if "values" in arrays:
+        _worker_arrays["scenario values"] = arrays["values"]
+    else:
+        prefix = "values "
+        _worker_arrays["scenario values"] = ScenarioValues.from_arrays(
+            {k[len(prefix) :]: v for k, v in arrays.items() if k.startswith(prefix)}
+        )
+
+
+def close_worker() -> None:
+    """Detach the worker process from the shared arrays."""
+    shared = [a for a in _worker_arrays.values() if isinstance(a, SharedArray)]
+    # drop the matrix and values viewing the shared memory first
+    _worker_arrays.clear()
+    for array in shared:
+        array.close()
+
+
+def solve_scenarios(columns: list) -> None:
+    """Factorize the technosphere of the given scenario columns and write the
+    supply of all demands into the shared supplies.
+    """
+    positions = _worker_arrays["positions"].array
+    values: Union[np.ndarray, ScenarioValues] = _worker_arrays["scenario values"]
+    demands = _worker_arrays["demands"].array
+    supplies = _worker_arrays["supplies"].array
+    for column in columns:
+        matrix = _worker_arrays["technosphere"].copy()
+        matrix.data[positions] = values[:, column]
+        solver = factorized(matrix.tocsc())
+        for i in range(demands.shape[1]):
+            supplies[:, i, column] = solver(demands[:, i])
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from SALib.analyze import delta
+
+
+def delta_analysis(problem, X, Y):
+    """Perform the delta analysis, a separate function so it can be run in
+    worker processes."""
+    return delta.analyze(problem, X, Y, print_to_console=False)
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
-from activity_browser import run_activity_browser
+# Worker processes are spawned and import this script again, importing
+# activity_browser there would start another Qt application.
+if __name__ == "__main__":
+    from activity_browser import run_activity_browser
 
-run_activity_browser()
+    run_activity_browser()
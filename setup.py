@@ -9,15 +9,16 @@ if root_dir:
     os.chdir(root_dir)
 accepted_filetypes = (".html", ".png", ".svg", ".js", ".css", ".txt", ".zip", ".md")
 
-for dirpath, dirnames, filenames in os.walk("activity_browser"):
-    # Ignore dirnames that start with '.'
-    if "__init__.py" in filenames or any(
-        x.endswith(accepted_filetypes) for x in filenames
-    ):
-        pkg = dirpath.replace(os.path.sep, ".")
-        if os.path.altsep:
-            pkg = pkg.replace(os.path.altsep, ".")
-        packages.append(pkg)
+for root in ("activity_browser", "activity_browser_workers"):
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Ignore dirnames that start with '.'
+        if "__init__.py" in filenames or any(
+            x.endswith(accepted_filetypes) for x in filenames
+        ):
+            pkg = dirpath.replace(os.path.sep, ".")
+            if os.path.altsep:
+                pkg = pkg.replace(os.path.altsep, ".")
+            packages.append(pkg)
 
 if "VERSION" in os.environ:
     version = os.environ["VERSION"]
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the batched calculation of all reference flows and impact categories
+in the MLCA with separate brightway LCA calculations.
+"""
+import bw2calc as bc
+import bw2data as bd
+import numpy as np
+import pandas as pd
+import pytest
+
+from activity_browser.bwutils import MLCA, SuperstructureMLCA
+from activity_browser.bwutils.multilca import LazyResults
+
+METHODS = [("mlca", "climate change"), ("mlca", "carbon dioxide")]
+REFERENCE_FLOWS = [
+    {("mlca_tech", "a"): 1},
+    {("mlca_tech", "b"): 2.5},
+    {("mlca_tech", "c"): -1},
+]
+
+
+def activity(code: str, production: float, inputs: list, emissions: list) -> dict:
+    return {
+        "name": code,
+        "reference product": code,
+        "location": "GLO",
+        "unit": "kilogram",
+        "exchanges": [
+            {"input": ("mlca_tech", code), "amount": production, "type": "production"}
+        ]
+        + [
+            {"input": ("mlca_tech", other), "amount": amount, "type": "technosphere"}
+            for other, amount in inputs
+        ]
+        + [
+            {"input": ("mlca_bio", flow), "amount": amount, "type": "biosphere"}
+            for flow, amount in emissions
+        ],
+    }
+
+
+@pytest.fixture()
+def mlca_setup(bw2test):
+    bd.projects.set_current("mlca_tests")
+    bd.Database("mlca_bio").write(
+        {
+            ("mlca_bio", flow): {"name": flow, "unit": "kilogram", "type": "emission"}
+            for flow in ("co2", "ch4")
+        }
+    )
+    bd.Database("mlca_tech").write(
+        {
+            ("mlca_tech", "a"): activity("a", 1, [("b", 0.5)], [("co2", 2)]),
+            ("mlca_tech", "b"): activity(
+                "b", 2, [("c", 0.2)], [("ch4", 1), ("co2", 0.5)]
+            ),
+            ("mlca_tech", "c"): activity(
+                "c", 1, [("a", 0.1), ("c", 0.25)], [("co2", 1)]
+            ),
+        }
+    )
+    cfs = {
+        METHODS[0]: [(("mlca_bio", "co2"), 1.0), (("mlca_bio", "ch4"), 25.0)],
+        METHODS[1]: [(("mlca_bio", "co2"), 1.0)],
+    }
+    for name, data in cfs.items():
+        method = bd.Method(name)
+        method.register(unit="kg CO2-eq")
+        method.write(data)
+    bd.calculation_setups["mlca_setup"] = {"inv": REFERENCE_FLOWS, "ia": METHODS}
+    return "mlca_setup"
+
+
+@pytest.mark.parametrize("lazy", [True, False])
+def test_mlca_matches_separate_lca(mlca_setup, monkeypatch, lazy):
+    """The scores, supply and contributions of the batched calculation equal
+    those of one LCA per reference flow and impact category."""
+    monkeypatch.setattr(MLCA, "lazy_results", lazy)
+    mlca = MLCA(mlca_setup)
+    mlca.calculate()
+
+    assert mlca.lca_scores.shape == (len(REFERENCE_FLOWS), len(METHODS))
+    for row, func_unit in enumerate(REFERENCE_FLOWS):
+        for col, method in enumerate(METHODS):
+            lca = bc.LCA(func_unit, method)
+            lca.lci()
+            lca.lcia()
+            assert np.isclose(mlca.lca_scores[row, col], lca.score)
+            assert np.allclose(mlca.scaling_factors[str(func_unit)], lca.supply_array)
+            inventory = np.asarray(lca.inventory.sum(axis=1)).ravel()
+            assert np.allclose(mlca.inventory[str(func_unit)], inventory)
+            assert np.isclose(
+                mlca.elementary_flow_contributions[row, col].sum(), lca.score
+            )
+            assert np.isclose(mlca.process_contributions[row, col].sum(), lca.score)
+            assert np.isclose(
+                mlca.characterized_inventories[(row, col)].sum(), lca.score
+            )
+
+
+def test_mlca_keeps_last_lca_state(mlca_setup):
+    """The LCA object is left in the state of the last reference flow and
+    impact category."""
+    mlca = MLCA(mlca_setup)
+    mlca.calculate()
+
+    lca = bc.LCA(REFERENCE_FLOWS[-1], METHODS[-1])
+    lca.lci()
+    lca.lcia()
+    assert np.allclose(mlca.lca.supply_array, lca.supply_array)
+    assert np.isclose(mlca.lca.score, lca.score)
+
+
+def test_scenario_inventories_are_lazy(mlca_setup):
+    """The inventories of every reference flow, impact category and scenario
+    are calculated when they are requested, not stored by the calculation."""
+    flows = [
+        (("mlca_bio", "co2"), ("mlca_tech", "a"), "biosphere"),
+        (("mlca_tech", "b"), ("mlca_tech", "a"), "technosphere"),
+    ]
+    df = pd.DataFrame(
+        {"low": [1.0, 0.2], "base": [2.0, 0.5], "high": [3.0, 0.8]},
+        index=pd.MultiIndex.from_tuples(flows, names=["input", "output", "flow"]),
+    )
+    mlca = SuperstructureMLCA(mlca_setup, df)
+    mlca.calculate()
+
+    for results in (mlca.inventories, mlca.characterized_inventories):
+        assert isinstance(results, LazyResults)
+        assert not results._cache
+    assert len(mlca.inventories) == len(REFERENCE_FLOWS) * 3
+    assert len(mlca.characterized_inventories) == len(REFERENCE_FLOWS) * 6
+
+    scores = {}
+    for row, func_unit in enumerate(REFERENCE_FLOWS):
+        for scenario in range(3):
+            key = (str(func_unit), scenario)
+            supply = mlca.scaling_factors[key]
+            inventory = mlca.inventories[key]
+            expected = mlca.scenario_biosphere(scenario) @ np.diag(supply)
+            assert np.allclose(inventory.toarray(), expected)
+            for col in range(len(METHODS)):
+                characterized = mlca.characterized_inventories[(row, col, scenario)]
+                scores[(row, col, scenario)] = characterized.sum()
+                assert np.isclose(
+                    characterized.sum(), mlca.lca_scores[row, col, scenario]
+                )
+    # the scenario values change the results
+    assert not np.isclose(scores[(0, 0, 0)], scores[(0, 0, 2)])
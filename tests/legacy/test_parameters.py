@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluate the parameter formulas of a project with the FormulaGraph and compare
+the results with the brightway recalculation.
+"""
+import bw2data as bd
+import numpy as np
+import pytest
+from bw2data.backends.peewee import ExchangeDataset
+from bw2data.parameters import (ActivityParameter, DatabaseParameter, Group,
+                                ParameterizedExchange, ProjectParameter)
+
+from activity_browser.bwutils.formulas import FormulaGraph
+from activity_browser.bwutils.manager import (formula_graph,
+                                               invalidate_formula_graph,
+                                               recalculate_downstream)
+from activity_browser.bwutils.utils import Parameters, StaticParameters
+
+
+@pytest.fixture()
+def parameter_project(bw2test):
+    bd.projects.set_current("parameter_tests")
+    bd.Database("param_db").write(
+        {
+            ("param_db", "act"): {
+                "name": "act",
+                "unit": "kilogram",
+                "exchanges": [
+                    {"input": ("param_db", "act"), "amount": 1, "type": "production"},
+                    {
+                        "input": ("param_db", "other"),
+                        "amount": 1,
+                        "type": "technosphere",
+                        "formula": "d / 2",
+                    },
+                    {
+                        "input": ("param_db", "third"),
+                        "amount": 1,
+                        "type": "technosphere",
+                        "formula": "b + c",
+                    },
+                ],
+            },
+            ("param_db", "other"): {"name": "other", "unit": "kilogram"},
+            ("param_db", "third"): {"name": "third", "unit": "kilogram"},
+        }
+    )
+    # 'b' is defined before the parameter it depends on
+    bd.parameters.new_project_parameters(
+        [
+            {"name": "b", "formula": "a * 3"},
+            {"name": "a", "amount": 2},
+            {"name": "unused", "amount": 7},
+        ]
+    )
+    bd.parameters.new_database_parameters(
+        [{"name": "c", "formula": "a + 1"}], "param_db"
+    )
+    bd.parameters.new_activity_parameters(
+        [
+            {
+                "name": "d",
+                "database": "param_db",
+                "code": "act",
+                "formula": "b * c + e",
+            },
+            {"name": "e", "database": "param_db", "code": "act", "amount": 4},
+        ],
+        "act_group",
+    )
+    bd.parameters.add_exchanges_to_group("act_group", ("param_db", "act"))
+    bd.parameters.recalculate()
+    invalidate_formula_graph()
+    yield
+    invalidate_formula_graph()
+
+
+def stored_amounts() -> dict:
+    """Return the stored amounts of all parameters and parameterized exchanges."""
+    amounts = {("project", p.name): p.amount for p in ProjectParameter.select()}
+    amounts.update(
+        {(p.database, p.name): p.amount for p in DatabaseParameter.select()}
+    )
+    amounts.update({(p.group, p.name): p.amount for p in ActivityParameter.select()})
+    for p in ParameterizedExchange.select():
+        amounts[p.exchange] = ExchangeDataset.get_by_id(p.exchange).data["amount"]
+    return amounts
+
+
+def full_recalculation() -> dict:
+    """Recalculate all parameters with brightway and return the amounts."""
+    Group.update(fresh=False).execute()
+    bd.parameters.recalculate()
+    return stored_amounts()
+
+
+def test_formula_graph_order(parameter_project):
+    graph = FormulaGraph(StaticParameters(), Parameters.from_bw_parameters())
+    position = {key: i for i, key in enumerate(graph.order)}
+    assert set(position) == set(graph.nodes)
+    for key, node in graph.nodes.items():
+        for dependency in node.symbols.values():
+            assert position[dependency] < position[key]
+
+    project = ("project",)
+    activity = ("activity", "act_group", "param_db")
+    assert graph.nodes[(project, "b")].symbols == {"a": (project, "a")}
+    assert graph.nodes[(activity, "d")].symbols == {
+        "b": (project, "b"),
+        "c": (("database", "param_db"), "c"),
+        "e": (activity, "e"),
+    }
+
+
+def test_formula_graph_evaluate(parameter_project):
+    """Evaluating several columns of amounts at once gives the exchange
+    amounts brightway calculates for each of them."""
+    parameters = Parameters.from_bw_parameters()
+    graph = FormulaGraph(StaticParameters(), parameters)
+    amounts = np.tile(parameters.amounts()[:, None], (1, 2))
+    amounts[[p.name for p in parameters].index("a"), 1] = 5
+    result = graph.evaluate(amounts)
+
+    exchanges = [key[3] for key in graph.exchanges]
+    expected = stored_amounts()
+    assert np.allclose(result[:, 0], [expected[exc] for exc in exchanges])
+    # d = 6 * 3 + 4, b + c = 6 + 3
+    assert sorted(result[:, 0]) == [9, 11]
+
+    ProjectParameter.update(amount=5).where(ProjectParameter.name == "a").execute()
+    expected = full_recalculation()
+    assert np.allclose(result[:, 1], [expected[exc] for exc in exchanges])
+
+
+def test_recalculate_downstream(parameter_project):
+    """Recalculating only the downstream parameters after edits stores the same
+    amounts as the full brightway recalculation."""
+    parameter = ProjectParameter.get(name="a")
+    parameter.amount = 5
+    parameter.save()
+    recalculate_downstream(parameter)
+    graph = formula_graph()
+
+    parameter = ActivityParameter.get(name="e", group="act_group")
+    parameter.amount = 1.5
+    parameter.save()
+    recalculate_downstream(parameter)
+    # the graph is kept between the edits
+    assert formula_graph() is graph
+
+    downstream = stored_amounts()
+    assert downstream[("project", "b")] == 15
+    assert downstream[("param_db", "c")] == 6
+    assert downstream[("act_group", "d")] == 91.5
+    assert downstream == pytest.approx(full_recalculation())
+
+
+def test_formula_graph_invalidation(parameter_project):
+    graph = formula_graph()
+    assert formula_graph() is graph
+    bd.parameters.new_project_parameters([{"name": "f", "amount": 1}], overwrite=False)
+    assert formula_graph() is not graph
+
+    graph = formula_graph()
+    invalidate_formula_graph()
+    assert formula_graph() is not graph
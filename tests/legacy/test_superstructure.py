@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Combine scenario files by product and cache scenario files.
+"""
+import itertools
+import os
+
+import bw2data as bd
+import numpy as np
+import pandas as pd
+import pytest
+
+from activity_browser.bwutils.superstructure import cache
+from activity_browser.bwutils.superstructure.dataframe import ScenarioProduct
+from activity_browser.bwutils.superstructure.manager import \
+    SuperstructureManager
+from activity_browser.bwutils.superstructure.utils import SUPERSTRUCTURE
+
+A, B, C, D = (("ss_db", code) for code in "abcd")
+# The production amount of every activity in the database
+PRODUCTION = {A: 1.0, B: 0.5, C: 2.0, D: 1.0}
+
+
+@pytest.fixture()
+def scenario_db(bw2test):
+    bd.projects.set_current("superstructure_tests")
+    bd.Database("ss_db").write(
+        {
+            key: {
+                "name": key[1],
+                "unit": "kilogram",
+                "exchanges": [{"input": key, "amount": amount, "type": "production"}],
+            }
+            for key, amount in PRODUCTION.items()
+        }
+    )
+    return "ss_db"
+
+
+def scenario_frame(flows: list, scenarios: dict) -> pd.DataFrame:
+    """Build a scenario dataframe like the scenario file importers do."""
+    df = pd.DataFrame(
+        [
+            {
+                "from key": source,
+                "to key": target,
+                "flow type": flow,
+                "from database": source[0],
+                "to database": target[0],
+            }
+            for source, target, flow in flows
+        ],
+        columns=SUPERSTRUCTURE,
+    )
+    for name, values in scenarios.items():
+        df[name] = values
+    df.index = SuperstructureManager.build_index(df)
+    return df
+
+
+def eager_product(frames: list) -> pd.DataFrame:
+    """Combine the scenario files the way it was done before `ScenarioProduct`,
+    by filling every combined scenario for every flow.
+    """
+    index = frames[0].index
+    for f in frames[1:]:
+        index = index.union(f.index)
+    names = [[c for c in f.columns if c not in SUPERSTRUCTURE] for f in frames]
+    combinations = list(itertools.product(*names))
+    df = pd.DataFrame(np.nan, index=index, columns=[str(c) for c in combinations])
+    for combination in combinations:
+        # shared flows are taken from the last file
+        for f, name in zip(frames, combination):
+            df.loc[f.index, str(combination)] = f.loc[:, name].to_numpy()
+
+    # merge the technosphere flows to self with their production flow
+    merged = []
+    for source, target, flow in list(df.index):
+        if source != target or flow != "technosphere":
+            continue
+        technosphere = df.loc[(source, target, flow)]
+        production_key = (source, target, "production")
+        if production_key in df.index:
+            production = df.loc[production_key]
+            df = df.drop(index=[production_key])
+        else:
+            production = pd.Series(PRODUCTION[source], index=df.columns)
+        denominator = production + technosphere
+        values = (production / denominator).where(denominator != 0, 0)
+        merged.append(values.rename(production_key))
+        df = df.drop(index=[(source, target, flow)])
+    if merged:
+        df = pd.concat([df, pd.DataFrame(merged)])
+    return df
+
+
+@pytest.fixture()
+def scenario_frames():
+    first = scenario_frame(
+        [
+            (A, B, "technosphere"),
+            (A, A, "technosphere"),
+            (A, A, "production"),
+            (C, D, "biosphere"),
+        ],
+        {"s1": [0.1, 0.2, 1.5, 3.0], "s2": [0.3, -0.4, 1.0, 4.0]},
+    )
+    # the flow to self of B has no production flow in any of the files
+    second = scenario_frame(
+        [(B, B, "technosphere"), (A, B, "technosphere"), (D, C, "technosphere")],
+        {"t1": [0.2, 0.6, 0.7], "t2": [-0.1, 0.8, 0.9], "t3": [0.0, 1.0, 1.1]},
+    )
+    # the production flow of A replaces the one of the first file, the flows
+    # to self of D cancel out
+    third = scenario_frame(
+        [
+            (C, C, "technosphere"),
+            (A, A, "production"),
+            (D, D, "technosphere"),
+            (D, D, "production"),
+        ],
+        {"u1": [0.5, 2.0, -1.0, 1.0], "u2": [-2.0, 3.0, 0.5, 1.5]},
+    )
+    return [first, second, third]
+
+
+def test_product_matches_eager_combination(scenario_db, scenario_frames):
+    manager = SuperstructureManager(*scenario_frames)
+    product = manager.combined_data(kind="product", skip_checks=True)
+    assert isinstance(product, ScenarioProduct)
+
+    expected = eager_product(scenario_frames)
+    result = product.to_frame()
+    assert result.shape == (len(expected), 2 * 3 * 2)
+    assert set(result.index) == set(expected.index)
+    pd.testing.assert_frame_equal(
+        result, expected.loc[result.index, result.columns], check_names=False
+    )
+    for position, name in enumerate(result.columns):
+        assert np.array_equal(product.column(position), result[name].to_numpy())
+
+
+def test_product_without_flows_to_self(scenario_db, scenario_frames):
+    frames = [
+        f.loc[[i for i in f.index if i[0] != i[1]], :] for f in scenario_frames
+    ]
+    product = SuperstructureManager(*frames).combined_data(
+        kind="product", skip_checks=True
+    )
+    expected = eager_product(frames)
+    result = product.to_frame()
+    pd.testing.assert_frame_equal(
+        result, expected.loc[result.index, result.columns], check_names=False
+    )
+
+
+def test_product_take(scenario_db, scenario_frames):
+    product = SuperstructureManager(*scenario_frames).combined_data(
+        kind="product", skip_checks=True
+    )
+    positions = np.array([4, 0, 2])
+    view = product.take(positions)
+    assert view.shape == (3, product.shape[1])
+    pd.testing.assert_frame_equal(view.to_frame(), product.to_frame().iloc[positions])
+
+
+@pytest.fixture()
+def scenario_cache(tmp_path, monkeypatch):
+    directory = tmp_path / "scenario_cache"
+    monkeypatch.setattr(cache, "_cache_directory", lambda: str(directory))
+    return directory
+
+
+def test_file_digest(scenario_cache, tmp_path):
+    path = tmp_path / "scenarios.csv"
+    path.write_text("from key;amount\nx;1.0\n")
+    digest = cache.file_digest(path, "read", ";")
+    assert digest == cache.file_digest(path, "read", ";")
+    assert digest != cache.file_digest(path, "read", ",")
+
+    # files are identified by their contents
+    copy = tmp_path / "copy.csv"
+    copy.write_text(path.read_text())
+    assert digest == cache.file_digest(copy, "read", ";")
+
+    stat = os.stat(path)
+    path.write_text("from key;amount\nx;2.0\n")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert digest != cache.file_digest(path, "read", ";")
+
+
+def test_content_digest_is_remembered(scenario_cache, tmp_path):
+    """The contents are only hashed again if the size or the modification time
+    of the file changed."""
+    path = tmp_path / "scenarios.csv"
+    path.write_text("from key;amount\nx;1.0\n")
+    stat = os.stat(path)
+    digest = cache.content_digest(path)
+
+    path.write_text("from key;amount\nx;2.0\n")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.content_digest(path) == digest
+
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.content_digest(path) != digest
+
+
+def test_validated_scenarios_invalidation(scenario_db, scenario_cache):
+    df = pd.DataFrame(
+        {"from database": [scenario_db], "to database": [scenario_db], "s1": [1.0]}
+    )
+    cache.store_validated_scenarios("validated", df)
+    pd.testing.assert_frame_equal(cache.load_validated_scenarios("validated"), df)
+
+    # the cache is only valid in the same project
+    bd.projects.set_current("other_superstructure_tests")
+    assert cache.load_validated_scenarios("validated") is None
+    bd.projects.set_current("superstructure_tests")
+    assert cache.load_validated_scenarios("validated") is not None
+
+    # and as long as the databases it refers to are unchanged
+    bd.Database(scenario_db).new_activity("e", name="e", unit="kilogram").save()
+    assert cache.load_validated_scenarios("validated") is None
+
+
+def test_scenario_cache_eviction(scenario_cache):
+    df = pd.DataFrame({"s1": np.arange(1000.0)})
+    for i, digest in enumerate(["first", "second", "third"]):
+        cache.store_read_scenarios(digest, df)
+        mtime = (i + 1) * 10**12
+        os.utime(cache._cache_path(digest), ns=(mtime, mtime))
+    # reading an entry marks it as recently used
+    pd.testing.assert_frame_equal(cache.load_read_scenarios("first"), df)
+
+    paths = [cache._cache_path(d) for d in ["first", "second", "third"]]
+    size = sum(os.path.getsize(p) for p in paths)
+    cache.evict_scenario_cache(size=size - 1)
+    assert cache.load_read_scenarios("second") is None
+    assert cache.load_read_scenarios("first") is not None
+    assert cache.load_read_scenarios("third") is not None
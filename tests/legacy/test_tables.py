@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Sort table columns on their precomputed ranks and compare the order with
+sorting cell by cell.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from PySide2.QtCore import Qt
+
+from activity_browser.ui.tables.models.base import ABSortProxyModel, PandasModel
+
+COLUMNS = {
+    # numbers with empty cells, which are sorted as 0
+    "amount": [2.5, "", -1.0, 0.5, 10.0],
+    # strings with empty cells, which are sorted as ""
+    "name": ["beta", "alpha", "", "gamma", "Alpha"],
+    # tuples are sorted as their string
+    "categories": [("water",), ("air", "urban"), ("air",), ("soil",), ("air", "rural")],
+    "location": pd.Categorical(["GLO", "CH", "RER", "DE", "CH"]),
+    "score": [3, 1, 4, 1, 5],
+}
+EXPECTED = {
+    "amount": [2, 1, 3, 0, 4],
+    "name": [2, 4, 1, 0, 3],
+    "categories": [4, 1, 2, 3, 0],
+    "location": [1, 4, 3, 0, 2],
+    "score": [1, 3, 0, 2, 4],
+}
+
+
+def sorted_rows(column: int) -> list:
+    """Sort the test table on the column and return the source rows in their
+    sorted order."""
+    model = PandasModel(pd.DataFrame(COLUMNS))
+    proxy = ABSortProxyModel()
+    proxy.setSourceModel(model)
+    proxy.sort(column, Qt.AscendingOrder)
+    return [
+        proxy.mapToSource(proxy.index(row, column)).row()
+        for row in range(proxy.rowCount())
+    ]
+
+
+@pytest.mark.parametrize("column", range(len(COLUMNS)))
+def test_rank_matches_cell_comparison(qtbot, monkeypatch, column):
+    ranked = sorted_rows(column)
+    assert ranked == EXPECTED[list(COLUMNS)[column]]
+
+    # without ranks every pair of cells is compared with `lessThan`
+    monkeypatch.setattr(
+        ABSortProxyModel, "rank_values", staticmethod(lambda series: None)
+    )
+    assert sorted_rows(column) == ranked
+
+
+def test_rank_values():
+    ranks = ABSortProxyModel.rank_values(pd.Series([3.0, np.nan, 1.0, 3.0]))
+    # equal values share a rank and NaN is ranked last
+    assert ranks == [2.0, 4.0, 1.0, 2.0]
+    # values that cannot be compared are not ranked
+    assert ABSortProxyModel.rank_values(pd.Series([1.0, "a", 2.0])) is None
+    assert ABSortProxyModel.rank_values(pd.Series([[1], [2]])) is None
+
+
+def test_ranks_follow_source_model(qtbot):
+    proxy = ABSortProxyModel()
+    # only the ranks are cleared on changes of the source model, without sorting again
+    proxy.setDynamicSortFilter(False)
+    first = PandasModel(pd.DataFrame({"value": [2, 1]}))
+    second = PandasModel(pd.DataFrame({"value": [1, 2, 3]}))
+    proxy.setSourceModel(first)
+    proxy.sort(0)
+    assert proxy._ranks
+
+    proxy.setSourceModel(second)
+    proxy.sort(0)
+    ranks = dict(proxy._ranks)
+    # changes to the previous model no longer clear the ranks
+    first.layoutChanged.emit()
+    assert proxy._ranks == ranks
+    second.layoutChanged.emit()
+    assert not proxy._ranks
+
+
+def test_large_sort_is_fast(qtbot):
+    """Sorting 20k rows on their ranks takes well within a second, comparing
+    the cells of every pair of rows took several seconds."""
+    rows = 20000
+    order = np.random.default_rng(0).permutation(rows)
+    df = pd.DataFrame(
+        {
+            "name": [f"activity {i}" for i in order],
+            "amount": np.where(order % 10, order / 7, np.nan),
+        }
+    )
+    proxy = ABSortProxyModel()
+    proxy.setSourceModel(PandasModel(df))
+    # "activity 0" sorts first by name, the amount of "activity 0" is empty
+    for column, first in enumerate([0, 1]):
+        start = time.perf_counter()
+        proxy.sort(column, Qt.AscendingOrder)
+        assert time.perf_counter() - start < 1
+        row = proxy.mapToSource(proxy.index(0, column)).row()
+        assert order[row] == first